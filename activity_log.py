@@ -0,0 +1,280 @@
+"""Activity-log reads: the shared recent-entries mirror and the paginated explorer.
+
+Every entry is stored under its push key together with three denormalized
+index fields, ``user_key`` / ``role_key`` / ``kind_key`` = ``"<value>|<push key>"``.
+Push keys sort by time, so one ``order_by_child`` range query on such a field
+filters by that value *and* a time range, newest first, with the push key as
+the page cursor. The fields must be indexed on the server; merge this into the
+project's Realtime Database rules (Firebase console > Rules)::
+
+    "activity_logs": { ".indexOn": ["user_key", "role_key", "kind_key"] }
+
+Without the index RTDB still answers, but by downloading the whole node.
+
+Entries written before these fields existed can be indexed once with
+``python activity_log.py --backfill``.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from pushid import key_bound
+
+INDEX_FIELDS = {'user': 'user_key', 'role': 'role_key', 'kind': 'kind_key'}
+_SEP = '|'
+_HIGH = '\uf8ff'   # สูงกว่าทุกตัวอักษรที่ใช้ใน key จึงใช้ปิดช่วง prefix ได้
+
+# ประเภทของ action สำหรับกรอง (เทียบจากข้อความที่ write_log ใช้)
+ACTION_KINDS = (
+    ('emergency', ('EMERGENCY',)),
+    ('command', ('Manual Command',)),
+    ('mode', ('Auto Mode',)),
+    ('schedule', ('Schedule',)),
+    ('login', ('Logged In',)),
+    ('alarm', ('ALARM',)),
+)
+
+
+def action_kind(action):
+    action = str(action or '')
+    for kind, markers in ACTION_KINDS:
+        if any(marker in action for marker in markers):
+            return kind
+    return 'other'
+
+
+def index_fields(key, entry):
+    """The denormalized index fields stored alongside ``entry`` under ``key``."""
+    return {
+        'user_key': f"{entry.get('user', 'Unknown')}{_SEP}{key}",
+        'role_key': f"{entry.get('role', 'Unknown')}{_SEP}{key}",
+        'kind_key': f"{action_kind(entry.get('action'))}{_SEP}{key}",
+    }
+
+
+def strip_index(entry):
+    return {k: v for k, v in entry.items() if k not in INDEX_FIELDS.values()}
+
+
+def _matches(entry, filters):
+    for name, value in filters.items():
+        current = action_kind(entry.get('action')) if name == 'kind' else entry.get(name, 'Unknown')
+        if current != value:
+            return False
+    return True
+
+
+def query_page(log_ref, page_size=25, before=None, user=None, role=None, kind=None,
+               start_ms=None, end_ms=None, max_queries=8):
+    """One page of log entries, newest first, older than the cursor ``before``.
+
+    Returns ``(items, next_cursor)`` where items are ``(key, entry)`` pairs and
+    ``next_cursor`` is the key to pass as ``before`` for the next older page
+    (None when there is nothing older). The first filter that is set (user,
+    then kind, then role) is served by its index together with the time range;
+    any further filter is checked on the fetched rows, which may take a few
+    extra page-sized queries (at most ``max_queries``).
+    """
+    filters = {name: value for name, value in (('user', user), ('kind', kind), ('role', role)) if value}
+    primary = next(iter(filters), None)
+    secondary = {name: value for name, value in filters.items() if name != primary}
+    low = key_bound(start_ms) if start_ms is not None else ''
+    high = key_bound(end_ms, upper=True) if end_ms is not None else _HIGH
+    prefix = f'{filters[primary]}{_SEP}' if primary else ''
+
+    items, cursor = [], before
+    for _ in range(max_queries):
+        upper = min(high, cursor) if cursor else high
+        query = log_ref.order_by_child(INDEX_FIELDS[primary]) if primary else log_ref.order_by_key()
+        if low or prefix:
+            query = query.start_at(prefix + low)
+        # end_at รวมค่าที่ cursor ด้วย จึงขอเกินมา 1 แล้วตัดตัวที่เป็น cursor ทิ้ง
+        batch = query.end_at(prefix + upper).limit_to_last(page_size + 1).get() or {}
+        keys = [key for key in reversed(batch.keys()) if key != cursor][:page_size]
+        for key in keys:
+            if _matches(batch[key], secondary):
+                items.append((key, strip_index(batch[key])))
+                if len(items) == page_size:
+                    return items, key
+        if len(keys) < page_size:
+            return items, None   # ไม่มีข้อมูลเก่ากว่านี้แล้ว
+        cursor = keys[-1]
+    return items, cursor
+
+
+def backfill_index(log_ref, batch_size=500):
+    """Add missing index fields to old entries, paging by key; returns the number updated."""
+    updated, start = 0, None
+    while True:
+        query = log_ref.order_by_key()
+        if start is not None:
+            query = query.start_at(start)
+        batch = query.limit_to_first(batch_size + 1).get() or {}
+        keys = [key for key in batch if key != start]
+        patch = {}
+        for key in keys:
+            entry = batch[key]
+            if isinstance(entry, dict):
+                for field, value in index_fields(key, entry).items():
+                    if entry.get(field) != value:
+                        patch[f'{key}/{field}'] = value
+        if patch:
+            log_ref.update(patch)
+            updated += len({path.split('/')[0] for path in patch})
+        if len(keys) < batch_size:
+            return updated
+        start = keys[-1]
+
+
+class RecentLogs:
+    """Newest activity-log entries shared by every session in the process.
+
+    Keeps an incremental mirror of the newest ``keep`` entries: the first fetch
+    reads the last ``keep`` keys, after that each refresh only asks for keys
+    after the newest one already held. The RTDB query runs at most once per
+    ``min_interval`` seconds no matter how many log panels are open;
+    ``version`` only moves when something new arrived, so panels can skip
+    rebuilding their table when nothing new was logged.
+    """
+
+    def __init__(self, log_ref, limit=10, min_interval=2.0, keep=200, batch_size=100):
+        self.log_ref = log_ref
+        self.limit = limit
+        self.min_interval = min_interval
+        self.keep = max(keep, limit)
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._mirror = OrderedDict()   # push key -> entry เรียงจากเก่าไปใหม่
+        self._entries = []
+        self._fetched_at = 0.0
+        self._complete = False         # True = mirror มีทุก entry ที่มีใน RTDB
+        self.version = 0
+
+    def invalidate(self):
+        """Force the next get() to query, e.g. right after this process wrote a log."""
+        self._fetched_at = 0.0
+
+    def _fetch_new(self):
+        newest = next(reversed(self._mirror), None)
+        if newest is None:
+            logs = self.log_ref.order_by_key().limit_to_last(self.keep).get() or {}
+            self._complete = len(logs) < self.keep
+            return list(logs.items())
+        added = []
+        while True:
+            logs = self.log_ref.order_by_key().start_at(newest).limit_to_first(self.batch_size + 1).get() or {}
+            fresh = [(key, entry) for key, entry in logs.items() if key != newest]
+            added.extend(fresh)
+            if len(fresh) < self.batch_size:
+                return added
+            newest = fresh[-1][0]
+
+    def _refresh(self):
+        added = self._fetch_new()
+        if not added:
+            return
+        for key, entry in added:
+            if isinstance(entry, dict):
+                self._mirror[key] = strip_index(entry)
+        while len(self._mirror) > self.keep:
+            self._mirror.popitem(last=False)
+            self._complete = False
+        self._entries = [self._mirror[key] for key in reversed(self._mirror)][:self.limit]
+        self.version += 1
+
+    def get(self):
+        """Return (version, entries) with entries newest first."""
+        if time.time() - self._fetched_at >= self.min_interval and self._lock.acquire(blocking=False):
+            try:
+                self._fetched_at = time.time()
+                self._refresh()
+            except Exception:
+                pass
+            finally:
+                self._lock.release()
+        return self.version, self._entries
+
+    def page(self, page_size, before=None):
+        """An unfiltered page served from the mirror, or None if it is not covered.
+
+        Same return shape as ``query_page``.
+        """
+        self.get()
+        with self._lock:
+            keys = list(reversed(self._mirror))
+            complete = self._complete
+            items = [(key, self._mirror[key]) for key in keys]
+        if before is not None:
+            if before not in self._mirror:
+                return None
+            items = items[keys.index(before) + 1:]
+        if len(items) > page_size or (len(items) == page_size and not complete):
+            return items[:page_size], items[page_size - 1][0]
+        return (items, None) if complete else None
+
+
+# --- Benchmark: reads ต่อการเปิดหน้า log เมื่อมี entry จำนวนมาก / --backfill สำหรับ entry เก่า ---
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backfill', action='store_true', help='index old entries in the real database')
+    parser.add_argument('--entries', type=int, default=200_000, help='benchmark size')
+    args = parser.parse_args()
+
+    if args.backfill:
+        import streamlit as st
+        import firebase_admin
+        from firebase_admin import credentials, db
+
+        fb_dict = dict(st.secrets["firebase"])
+        fb_dict["private_key"] = fb_dict["private_key"].replace("\\n", "\n")
+        firebase_admin.initialize_app(credentials.Certificate(fb_dict), {
+            'databaseURL': 'https://dbsensor-eb39d-default-rtdb.firebaseio.com'})
+        print('entries indexed:', backfill_index(db.reference('activity_logs')))
+        raise SystemExit
+
+    from fake_rtdb import FakeDatabase
+    from pushid import push_key
+
+    users = [('admin', 'super_admin')] + [(f'operator{i:02d}', 'user') for i in range(20)]
+    actions = ['Manual Command: OPEN', 'Manual Command: CLOSE', 'Auto Mode set to True', 'User Logged In',
+               'EMERGENCY STOP', 'Updated Schedule Configuration']
+    base_ms = 1_704_067_200_000
+    logs = {}
+    for i in range(args.entries):
+        user, role = users[i % len(users)]
+        key = push_key(now_ms=base_ms + i * 1000)
+        entry = {'user': user, 'role': role, 'action': actions[i % len(actions)], 'timestamp': ''}
+        logs[key] = dict(entry, **index_fields(key, entry))
+    database = FakeDatabase({'activity_logs': logs})
+    log_ref = database.reference('activity_logs')
+
+    def measure(label, run):
+        database.reset_counters()
+        t0 = time.perf_counter()
+        items, cursor = run()
+        stats = database.stats()
+        print(f"{label:<44} rows={len(items):>3} queries={stats['reads']:>2} "
+              f"KB={stats['bytes_read'] / 1024:>6.1f}  ({(time.perf_counter() - t0) * 1000:.0f} ms fake)")
+        return cursor
+
+    print(f'{args.entries} entries (before: limit_to_last(10) only, older entries unreachable)')
+    cursor = measure('first page, 25 rows', lambda: query_page(log_ref, 25))
+    measure('next page via cursor', lambda: query_page(log_ref, 25, before=cursor))
+    measure("user='operator07'", lambda: query_page(log_ref, 25, user='operator07'))
+    measure("kind='emergency', last 24 h of data", lambda: query_page(
+        log_ref, 25, kind='emergency', start_ms=base_ms + (args.entries - 86400) * 1000))
+    measure("user='admin' + kind='command' (2nd filter local)",
+            lambda: query_page(log_ref, 25, user='admin', kind='command'))
+
+    recent = RecentLogs(log_ref, min_interval=0)
+    database.reset_counters()
+    recent.get()
+    first = database.stats()['bytes_read']
+    key, entry = push_key(), {'user': 'admin', 'role': 'super_admin', 'action': 'User Logged In'}
+    log_ref.child(key).set(dict(entry, **index_fields(key, entry)))
+    database.reset_counters()
+    recent.get()
+    print(f"mirror: first fill {first / 1024:.1f} KB, refresh after 1 new entry "
+          f"{database.stats()['bytes_read'] / 1024:.2f} KB")
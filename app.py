@@ -1,69 +1,244 @@
 import streamlit as st
-import pandas as pd
-import numpy as np
+import os
+import threading
 import time
+from collections import OrderedDict
 import pytz
 from datetime import datetime, timedelta
 import firebase_admin
 from firebase_admin import credentials, db
+# หน้า login ใช้แค่โมดูลเบาด้านล่าง; pandas/numpy (history, rollup, fleet, schedule, anomaly)
+# import ภายในฟังก์ชัน/หน้า dashboard เมื่อถูกใช้ครั้งแรก process ใหม่จึงแสดงหน้า login ได้เร็ว
+from state_cache import TELEMETRY_FIELDS
+from activity_log import ACTION_KINDS, RecentLogs, index_fields, query_page
+from log_shipper import DEFAULT_SPOOL as LOG_SPOOL_PATH, LogShipper
+from command_channel import CommandChannel
+from user_directory import UserDirectory
+from write_ahead import WriteAheadLog
+from perf import record, timed, timing_report
+from metrics import REGISTRY, instrument, serve as serve_metrics
 
 # --- 0. SETTINGS & TIMEZONE ---
 local_tz = pytz.timezone('Asia/Bangkok')
+# คำสั่ง OPEN/CLOSE ที่ค้างในคิวออฟไลน์นานกว่านี้จะถูกทิ้ง ไม่ส่งย้อนหลัง (STOP ไม่หมดอายุ)
+OFFLINE_COMMAND_TTL = 300
+# Prometheus endpoint (http://127.0.0.1:<port>/metrics); 0 = ปิด
+METRICS_PORT = int(os.environ.get('VALVE_METRICS_PORT', '9464'))
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
 
 def get_now():
     """ดึงเวลาปัจจุบันเป็นเวลาไทย"""
     return datetime.now(local_tz)
 
 # --- 1. FIREBASE INITIALIZATION ---
-if not firebase_admin._apps:
-    try:
+@st.cache_resource
+def init_firebase():
+    # credential + initialize_app ครั้งเดียวต่อ process; exception ไม่ถูก cache จึงลองใหม่ได้ใน rerun ถัดไป
+    if not firebase_admin._apps:
         fb_dict = dict(st.secrets["firebase"])
         fb_dict["private_key"] = fb_dict["private_key"].replace("\\n", "\n")
         cred = credentials.Certificate(fb_dict)
         firebase_admin.initialize_app(cred, {
             'databaseURL': 'https://dbsensor-eb39d-default-rtdb.firebaseio.com'
         })
-    except Exception as e:
-        st.error(f"❌ Firebase Connection Error: {e}")
-        st.stop()
+    # ทุก reference วัด latency / bytes / error ต่อ operation (ดู metrics.py)
+    return (instrument(db.reference('valve_system'), 'valve_system'),
+            instrument(db.reference('valve_system/users'), 'users'),
+            instrument(db.reference('activity_logs'), 'activity_logs'))
+
+try:
+    # Database References
+    ref, user_ref, log_ref = init_firebase()
+except Exception as e:
+    st.error(f"❌ Firebase Connection Error: {e}")
+    st.stop()
 
-# Database References
-ref = db.reference('valve_system')
-user_ref = db.reference('valve_system/users')
-log_ref = db.reference('activity_logs')
+@st.cache_resource
+def get_metrics_server():
+    # HTTP server ครั้งเดียวต่อ process; None ถ้าปิดไว้หรือ port ถูกใช้อยู่
+    return serve_metrics(METRICS_PORT) if METRICS_PORT else None
+
+get_metrics_server()
 
 # --- 2. HELPER FUNCTIONS ---
+@st.cache_resource
+def get_user_directory():
+    # รายชื่อผู้ใช้โหลดครั้งเดียวต่อ process แล้วอัปเดตด้วย listener; login ไม่อ่าน RTDB ทุกครั้งที่กด
+    return UserDirectory(user_ref).start()
+
+@st.cache_resource
 def init_default_user():
+    # ทำครั้งเดียวต่อ process ไม่ใช่ทุก rerun (shallow=True ดึงเฉพาะชื่อ key)
     try:
-        if user_ref.get() is None:
-            user_ref.child('admin').set({'password': 'papak123', 'role': 'super_admin'})
+        get_user_directory().ensure_default_admin()
     except: pass
 
+@st.cache_resource
+def get_log_shipper():
+    # เขียน log ผ่าน thread เบื้องหลัง (spool บนดิสก์ + batch update) ปุ่มควบคุมไม่ต้องรอ Firebase
+    # enrich: เก็บ user_key/role_key/kind_key ไว้ใน entry สำหรับ query แบบมี index ใน log explorer
+    shipper = LogShipper(log_ref, LOG_SPOOL_PATH, on_flush=lambda keys: get_recent_logs().invalidate(),
+                         enrich=index_fields)
+    shipper.start()
+    return shipper
+
 def write_log(action):
-    try:
-        log_ref.push({
-            "user": st.session_state.get('username', 'Unknown'),
-            "role": st.session_state.get('user_role', 'Unknown'),
-            "action": action,
+    get_log_shipper().submit({
+        "user": st.session_state.get('username', 'Unknown'),
+        "role": st.session_state.get('user_role', 'Unknown'),
+        "action": action,
+        "timestamp": get_now().strftime("%Y-%m-%d %H:%M:%S")
+    })
+
+@st.cache_resource
+def _version_memo():
+    # ค่าที่กำหนดได้ด้วย (key, version) อย่างเดียว: ใช้ร่วมกันทุก session ใน process แทนการเก็บใน session_state
+    return OrderedDict(), threading.Lock()
+
+def memo_by_version(key, version, build, keep=64):
+    """คืนค่าที่สร้างไว้แล้วถ้า version ของข้อมูลยังไม่เปลี่ยน (ไม่ต้องสร้าง DataFrame ใหม่ทุก tick)"""
+    memo, lock = _version_memo()
+    with lock:
+        if (key, version) in memo:
+            memo.move_to_end((key, version))
+            return memo[(key, version)]
+    value = build()
+    with lock:
+        memo[(key, version)] = value
+        while len(memo) > keep:
+            memo.popitem(last=False)
+    return value
+
+@st.cache_resource
+def get_recent_logs():
+    # mirror log ล่าสุด 200 รายการ: ดึงเฉพาะ key ที่ใหม่กว่าตัวล่าสุด ไม่เกิน 1 ครั้งต่อ 2 วินาทีต่อ process
+    return RecentLogs(log_ref, limit=10, keep=200)
+
+@st.cache_resource
+def prewarm_dashboard():
+    # ระหว่างที่ผู้ใช้กรอกรหัสผ่าน import โมดูลหนักของ dashboard ใน thread เบื้องหลัง (ครั้งเดียวต่อ process)
+    def run():
+        try:
+            import pandas, altair  # st.data_editor / st.line_chart
+            import history_store, rollup, anomaly, fleet, schedule_sync, schedule_engine
+        except Exception:
+            pass   # ไม่สำเร็จก็แค่ไป import ตอนเปิด dashboard ตามปกติ
+    thread = threading.Thread(target=run, name='prewarm-imports', daemon=True)
+    thread.start()
+    return thread
+
+@st.cache_resource
+def load_css(name):
+    # อ่าน stylesheet ใน static/ ครั้งเดียวต่อ process (ฟอนต์ประกาศใน .streamlit/config.toml)
+    with open(os.path.join(STATIC_DIR, name), encoding='utf-8') as f:
+        return f"<style>\n{f.read()}</style>"
+
+@st.cache_resource
+def get_history_store():
+    # ring buffer บนไฟล์ memory-mapped ใช้ร่วมกันทุก session และไม่หายเมื่อ restart
+    from history_store import DEFAULT_PATH as HISTORY_PATH, HistoryStore
+    return HistoryStore(HISTORY_PATH)
+
+@st.cache_resource
+def _raw_store_slot():
+    return {}
+
+def get_raw_store():
+    # ไฟล์ full-resolution ของ ingest.py (ทุก sample) ถ้ามี gateway รันบนเครื่องนี้; ยังไม่มีไฟล์ก็ลองเปิดใหม่รอบหน้า
+    slot = _raw_store_slot()
+    if slot.get('store') is None:
+        from history_store import INGEST_PATH, open_existing
+        slot['store'] = open_existing(INGEST_PATH)
+    return slot['store']
+
+@st.cache_resource
+def get_rollups():
+    # min/max/mean/last ที่ 1 วินาที, 1 นาที, 15 นาที, 1 ชั่วโมง สร้างจากประวัติเดิมครั้งเดียว
+    from rollup import RollupEngine
+    rollups = RollupEngine()
+    rollups.backfill(get_history_store())
+    return rollups
+
+@st.cache_resource
+def get_anomaly_detector():
+    # EWMA/CUSUM ต่อ sample ใน listener thread; alarm ใหม่ลง activity log ในนามของ system
+    from anomaly import AnomalyDetector
+    shipper = get_log_shipper()
+    def on_alarm(alarm):
+        # ทุก worker ตรวจจับจากข้อมูลชุดเดียวกัน แต่บันทึก log เฉพาะ worker ที่เป็น leader
+        if not get_state_cache().is_leader():
+            return
+        shipper.submit({
+            "user": "system",
+            "role": "system",
+            "action": f"ALARM: {alarm['message']} ({alarm['value']:.2f})",
+            "timestamp": datetime.fromtimestamp(alarm['ts'], local_tz).strftime("%Y-%m-%d %H:%M:%S")
+        })
+    detector = AnomalyDetector(on_alarm=on_alarm)
+    detector.backfill(get_history_store(), seconds=timedelta(hours=6).total_seconds())
+    return detector
+
+@st.cache_resource
+def get_state_cache():
+    """Listener เดียวต่อเครื่อง: worker ที่ชนะ election ฟัง Firebase และเขียน snapshot ลง shared memory
+    worker อื่นอ่าน snapshot นั้น และป้อน rollups/detector จาก history file ที่ใช้ร่วมกัน (ดู shared_state.py)"""
+    from history_store import telemetry_sink
+    from shared_state import SharedTelemetry
+    detector = get_anomaly_detector()
+    consumers = (get_rollups().add, detector.add)
+    cache = SharedTelemetry(ref, fields=TELEMETRY_FIELDS + ('command_ack',))
+    cache.subscribe(telemetry_sink(get_history_store(), also=consumers))
+    cache.follow(get_history_store(), consumers)
+    # ค่าที่นิ่งอยู่ไม่มี event ตามมา: ให้ detector ประเมิน sample ล่าสุดทุกรอบ poll
+    cache.on_poll(detector.flush)
+    return cache.start()
+
+@st.cache_resource
+def get_write_ahead():
+    # write ที่เปลี่ยนสถานะระบบ: ส่งตรงเมื่อออนไลน์, ออฟไลน์เก็บลงไฟล์ (fsync) แล้ว replay ตามลำดับ
+    shipper = get_log_shipper()
+    def on_drop(record, reason):
+        shipper.submit({
+            "user": "system",
+            "role": "system",
+            "action": f"Offline change discarded ({reason}): {record.get('k', '')}",
             "timestamp": get_now().strftime("%Y-%m-%d %H:%M:%S")
         })
-    except: pass
+    return WriteAheadLog(ref, online=get_state_cache().is_online, on_drop=on_drop).start()
+
+@st.cache_resource
+def get_command_channel():
+    # คิวคำสั่งเดียวต่อ process: STOP แซงคิว และรอ ack จาก controller ผ่าน command_ack
+    # ส่งไม่สำเร็จ (ออฟไลน์) ให้ write-ahead log เก็บไว้ส่งเมื่อกลับมาออนไลน์
+    wal = get_write_ahead()
+    channel = CommandChannel(ref, listen=False, fallback=lambda update, state: wal.submit(
+        update, label=f"command {state.command}", ttl=None if state.command == 'STOP' else OFFLINE_COMMAND_TTL))
+    channel.start()
+    # ack มาทาง shared tier (listener เดียวต่อเครื่อง): leader ได้ทันทีจาก listener ของ state cache
+    # worker อื่นอ่าน command_ack จาก shared memory ทุกรอบ poll (ช้าได้ไม่เกิน 0.5 วินาที)
+    cache = get_state_cache()
+    cache.subscribe(lambda path, state: channel.ack(state.get('command_ack'))
+                    if path.strip('/').split('/')[0] == 'command_ack' else None)
+    cache.on_poll(lambda: channel.ack(cache.get('command_ack')))
+    return channel
+
+def send_command(command, action):
+    get_command_channel().submit(command, st.session_state.get('username', 'Unknown'))
+    write_log(action)
+
+@st.cache_resource
+def get_fleet():
+    # fleet mode: listener เดียวที่ VALVE_FLEET_ROOT กระจายค่าให้แต่ละ valve ในหน่วยความจำ
+    from fleet import FLEET_ROOT, FleetState
+    return FleetState(instrument(db.reference(FLEET_ROOT), 'fleet')).start()
 
 def get_safe_data():
-    if 'cached_data' not in st.session_state:
-        st.session_state.cached_data = {
-            'live_pressure': 0.0, 'valve_rotation': 0.0, 'auto_mode': True,
-            'motor_load': 0.0, 'schedule': [], 'online': False
-        }
-    try:
-        data = ref.get()
-        if data:
-            st.session_state.cached_data.update(data)
-            st.session_state.cached_data['online'] = True
-        return st.session_state.cached_data
-    except:
-        st.session_state.cached_data['online'] = False
-        return st.session_state.cached_data
+    # อ่านจาก snapshot ในหน่วยความจำ; 'online' มาจากอายุข้อมูลของ listener
+    # ค่าที่ยังค้างในคิวออฟไลน์ (เช่น auto_mode) แสดงแทนค่าเดิม เพื่อไม่ให้ toggle เด้งกลับ
+    data = get_state_cache().snapshot()
+    data.update(get_write_ahead().overlay())
+    return data
 
 # --- 3. LOGIN SYSTEM ---
 def check_login():
@@ -71,18 +246,8 @@ def check_login():
         st.session_state.logged_in = False
 
     if not st.session_state.logged_in:
-        st.markdown("""
-            <style>
-            @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+Thai:wght@300;400;700&display=swap');
-            html, body, [class*="st-"] { font-family: 'Noto Sans Thai', sans-serif; }
-            .login-container {
-                background-color: rgba(30, 39, 46, 0.9);
-                padding: 40px; border-radius: 15px;
-                border: 1px solid #00ff88; text-align: center;
-                margin-top: 50px;
-            }
-            </style>
-        """, unsafe_allow_html=True)
+        login_started, login_calls = time.perf_counter(), REGISTRY.session_calls()
+        st.markdown(load_css('login.css'), unsafe_allow_html=True)
         
         _, col2, _ = st.columns([1, 1.2, 1])
         with col2:
@@ -91,84 +256,369 @@ def check_login():
             u = st.text_input("Username", key="login_u")
             p = st.text_input("Password", type="password", key="login_p")
             if st.button("Login", use_container_width=True):
-                user_data = user_ref.child(u).get()
-                if user_data and user_data.get('password') == p:
+                user_data, retry_after = get_user_directory().authenticate(u, p)
+                if user_data:
                     st.session_state.logged_in = True
                     st.session_state.username = u
                     st.session_state.user_role = user_data.get('role', 'user') # เก็บ Role
                     write_log("User Logged In")
                     st.rerun()
+                elif retry_after:
+                    st.error(f"ใส่รหัสผิดหลายครั้ง กรุณารอ {retry_after:.0f} วินาที (Too many attempts)")
                 else:
                     st.error("Invalid Username or Password")
             st.markdown('</div>', unsafe_allow_html=True)
+        prewarm_dashboard()
+        record('login page', time.perf_counter() - login_started, REGISTRY.session_calls() - login_calls)
         return False
     return True
 
-# --- 4. MAIN INTERFACE ---
+# --- 4. LIVE PANELS (FRAGMENTS) ---
+# แต่ละส่วนรีเฟรชเองตามรอบของตัวเอง แทน time.sleep(5) + st.rerun() ทั้งสคริปต์
+
+@st.fragment(run_every=5)
+def status_badge():
+    with timed('fragment: status'):
+        data = get_safe_data()
+        if not data['online']:
+            age = data.get('age')
+            st.warning("⚠️ โหมดออฟไลน์ (Offline)" + (f" · ข้อมูลล่าสุด {age:.0f} วินาทีที่แล้ว" if age is not None else ""))
+        else:
+            st.success("● ระบบออนไลน์ (Online)")
+        shipper = get_log_shipper().stats()
+        flush = f" · flush p95 {shipper['flush_p95_ms']:.0f} ms" if shipper['flush_p95_ms'] is not None else ""
+        st.caption(f"📨 คิวบันทึกกิจกรรม (Log queue): {shipper['pending']}{flush}")
+        wal = get_write_ahead().stats()
+        if wal['depth']:
+            st.warning(f"🗃️ คำสั่งรอส่ง (Offline queue): {wal['depth']} รายการ · "
+                       f"เก่าสุด {wal['oldest_age']:.0f} วินาที")
+        else:
+            st.caption(f"🗃️ คำสั่งรอส่ง (Offline queue): 0 · replay แล้ว {wal['applied']}")
+
+@st.fragment(run_every=1)
+def alarm_panel():
+    with timed('fragment: alarms'):
+        alarms = get_anomaly_detector().snapshot()
+        for alarm in alarms['active']:
+            since = datetime.fromtimestamp(alarm['ts'], local_tz).strftime("%H:%M:%S")
+            st.error(f"🚨 {alarm['message']} · ตั้งแต่ {since} · ค่า {alarm['value']:.2f}")
+        if alarms['recent'] and not alarms['active']:
+            last = alarms['recent'][0]
+            st.caption(f"ℹ️ alarm ล่าสุด: {last['message']} เมื่อ "
+                       f"{datetime.fromtimestamp(last['ts'], local_tz).strftime('%Y-%m-%d %H:%M:%S')}")
+
+@st.fragment(run_every=1)
+def metrics_panel():
+    with timed('fragment: metrics'):
+        data = get_safe_data()
+        m1, m2, m3, m4 = st.columns(4)
+        with m1: st.metric("แรงดันน้ำขณะนี้", f"{data.get('live_pressure', 0.0):.2f} บาร์")
+        with m2: st.metric("รอบการหมุนวาล์ว", f"{data.get('valve_rotation', 0.0):.1f} รอบ")
+        with m3: st.metric("ภาระโหลดมอเตอร์", f"{data.get('motor_load', 0.0)} แอมป์")
+        with m4: st.metric("เวลาปัจจุบัน (ไทย)", get_now().strftime("%H:%M:%S"))
+
+RAW_TREND_SECONDS = 600
+
+@st.fragment(run_every=10)
+def trend_panel():
+    with timed('fragment: trend'):
+        rollups = get_rollups()
+        def build():
+            # เลือก tier ตามช่วงเวลาและความกว้างกราฟ ไม่เกิน 2,000 จุดต่อกราฟ
+            now_ts = get_now().timestamp()
+            return rollups.chart_frame('live_pressure', now_ts - timedelta(days=3).total_seconds(),
+                                       now_ts, width_px=1000, tz=local_tz)
+        trend_df = memo_by_version('_trend_df', rollups.version, build)
+        if len(trend_df):
+            st.line_chart(trend_df, color="#ff3e3e", height=250)
+        else:
+            st.info("ยังไม่มีข้อมูลประวัติแรงดัน (No pressure history yet)")
+
+        # gateway ส่งเข้า RTDB แค่ 1 ครั้ง/วินาที: ช่วงสั้นล่าสุดอ่านจากไฟล์ raw ของ ingest.py ให้เห็นทุก sample
+        raw = get_raw_store()
+        last = raw.last_ts() if raw is not None else None
+        if last is not None and get_now().timestamp() - last < RAW_TREND_SECONDS:
+            from rollup import raw_chart_frame
+            raw_df = memo_by_version('_raw_trend_df', raw.count, lambda: raw_chart_frame(
+                raw, 'live_pressure', last - RAW_TREND_SECONDS, last, width_px=1000, tz=local_tz))
+            st.caption(f"ความละเอียดเต็มจาก ingest gateway {RAW_TREND_SECONDS // 60} นาทีล่าสุด "
+                       f"(Full resolution, last {RAW_TREND_SECONDS // 60} min)")
+            st.line_chart(raw_df, color="#ff3e3e", height=200)
+
+@st.fragment(run_every=2)
+def control_panel(is_super_admin):
+    with timed('fragment: controls'):
+        mode_remote = get_safe_data().get('auto_mode', True)
+        ctrl_1, ctrl_2, ctrl_3, ctrl_4 = st.columns([1, 1, 1, 1])
+
+        with ctrl_3:
+            # Toggle จะถูกปิดถ้าไม่ใช่ super_admin
+            is_auto = st.toggle("Auto Mode (โหมดอัตโนมัติ)", value=mode_remote, disabled=not is_super_admin)
+            if is_super_admin and is_auto != mode_remote:
+                try:
+                    get_write_ahead().write({'auto_mode': is_auto}, label='auto_mode')
+                    write_log(f"Auto Mode set to {is_auto}")
+                except: pass
+
+        # ปุ่มแค่เข้าคิวคำสั่ง (ไม่รอ network); สถานะส่ง/ack แสดงใน command_status
+        with ctrl_1:
+            # ปุ่ม Open จะทำงานเฉพาะ admin และต้องไม่อยู่ในโหมด auto
+            if st.button("🔼 Open Valve (เปิด)", use_container_width=True, disabled=(not is_super_admin or is_auto)):
+                send_command('OPEN', "Manual Command: OPEN")
+
+        with ctrl_2:
+            if st.button("🔽 Close Valve (ปิด)", use_container_width=True, disabled=(not is_super_admin or is_auto)):
+                send_command('CLOSE', "Manual Command: CLOSE")
+
+        with ctrl_4:
+            # Emergency Stop ควรให้เฉพาะ admin กดเช่นกัน เพื่อป้องกันการกลั่นแกล้ง
+            if st.button("🚨 Emergency Stop (หยุด)", type="primary", use_container_width=True, disabled=not is_super_admin):
+                send_command('STOP', "EMERGENCY STOP")
+                st.error("ส่งคำสั่งหยุดฉุกเฉินแล้ว")
+
+@st.fragment(run_every=0.5)
+def command_status():
+    with timed('fragment: commands'):
+        import pandas as pd
+        channel = get_command_channel()
+        recent = channel.recent(5)
+        if recent:
+            st.dataframe(memo_by_version('_commands_df', channel.version, lambda: pd.DataFrame([{
+                'seq': c['seq'], 'command': c['command'], 'user': c['user'], 'status': c['status'],
+                'rtt ms': None if c['rtt_ms'] is None else round(c['rtt_ms'], 1),
+            } for c in recent])), hide_index=True, use_container_width=True)
+        rtt = channel.rtt_percentiles()
+        if rtt:
+            st.caption(f"⏱️ Command → ack (n={rtt['n']}): p50 {rtt['p50']:.0f} ms · "
+                       f"p95 {rtt['p95']:.0f} ms · p99 {rtt['p99']:.0f} ms")
+
+@st.fragment(run_every=2)
+def fleet_panel():
+    with timed('fragment: fleet'):
+        import pandas as pd
+        fleet = get_fleet()
+        grid = fleet.overview()
+        f1, f2, f3 = st.columns(3)
+        with f1: st.metric("จำนวนประตูน้ำ (Valves)", len(grid))
+        with f2: st.metric("ออนไลน์ (Online)", int(grid['online'].sum()))
+        with f3: st.metric("แรงดันเฉลี่ย", f"{grid['live_pressure'].mean():.2f} บาร์" if len(grid) else "-")
+        if len(grid):
+            view = pd.DataFrame({
+                'สถานะ': grid['online'].map({True: '🟢', False: '🔴'}),
+                'แรงดัน (บาร์)': grid['live_pressure'].round(2),
+                'รอบวาล์ว': grid['valve_rotation'].round(1),
+                'โหลด (แอมป์)': grid['motor_load'].round(2),
+                'Auto': grid['auto_mode'] == 1,
+                'อัปเดต (วินาที)': grid['age_s'].round(0),
+            })
+            st.dataframe(view, use_container_width=True, height=min(600, 38 + 35 * len(view)))
+
+@st.fragment(run_every=30)
+def active_target_panel(compiled):
+    now = get_now()
+    offset = now.utcoffset().total_seconds()
+    target = compiled.target_at(now.timestamp(), offset)
+    if len(compiled):
+        change = compiled.next_change(now.timestamp(), offset)
+        upcoming = f" · ถัดไป {change[1]:.2f} บาร์ ในอีก {int(change[0] // 3600)} ชม. {int(change[0] % 3600 // 60)} นาที" if change else ""
+        st.caption(f"🎯 เป้าหมายตอนนี้ (Active target): {float(target):.2f} บาร์{upcoming}")
+
+def what_if_panel(current_rows, edited_rows):
+    # เทียบตารางปัจจุบันกับตารางที่แก้ไข (ยังไม่บันทึก) บนประวัติแรงดัน 7 วัน ที่ความละเอียด 1 นาที
+    import pandas as pd
+    from schedule_engine import what_if
+    now_ts = get_now().timestamp()
+    ts, history = get_rollups().means(now_ts - timedelta(days=7).total_seconds(), now_ts, width=60)
+    if len(ts) < 60:
+        st.info("ประวัติยังไม่พอสำหรับการจำลอง (Not enough history yet)")
+        return
+    scores = what_if([current_rows, edited_rows], ts, history['live_pressure'], history['valve_rotation'],
+                     history['motor_load'], utc_offset=get_now().utcoffset().total_seconds())
+    st.dataframe(pd.DataFrame({
+        'RMSE (บาร์)': scores['rmse'].round(3),
+        'อยู่ในช่วง ±0.2 บาร์': [f"{v:.1%}" for v in scores['within_band']],
+        'รอบวาล์วรวม': scores['travel'].round(1),
+        'โหลดเฉลี่ย (แอมป์)': scores['mean_load'].round(2),
+    }, index=['ตารางปัจจุบัน', 'ตารางที่แก้ไข']), use_container_width=True)
+
+LOG_PAGE_SIZE = 25
+
+def _log_range_ms(days):
+    # ช่วงวันที่ (เวลาไทย) -> epoch ms สำหรับแปลงเป็นช่วง push key
+    if not days:
+        return None, None
+    start = local_tz.localize(datetime.combine(days[0], datetime.min.time()))
+    end = local_tz.localize(datetime.combine(days[-1], datetime.max.time()))
+    return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+@st.fragment
+def export_panel():
+    # ส่งออกข้อมูลสำหรับรายงาน: ไฟล์สร้างตอนกดดาวน์โหลด ใน thread แยกจาก rerun ทีละ chunk
+    # Streamlit เก็บไฟล์ที่ได้ไว้ในหน่วยความจำทั้งไฟล์ จึงจำกัดช่วงวันที่/จำนวนแถว (ช่วงยาวใช้ python export.py)
+    from export import FORMATS, UI_MAX_DAYS, UI_MAX_ROWS, export_history, export_logs, to_download
+    raw = get_raw_store()
+    sources = ["Telemetry history", "Activity logs"] + (["Raw ingest (full resolution)"] if raw is not None else [])
+    e1, e2, e3 = st.columns([1.2, 1.4, 0.8])
+    with e1: source = st.selectbox("ข้อมูล (Data)", sources, key="export_source")
+    with e2: days = st.date_input("ช่วงวันที่ (Date range)", value=[get_now().date() - timedelta(days=1), get_now().date()],
+                                  key="export_days")
+    with e3: fmt = st.selectbox("รูปแบบ (Format)", list(FORMATS), key="export_format")
+    start_ms, end_ms = _log_range_ms(days)
+    if start_ms is None:
+        st.caption("เลือกช่วงวันที่ก่อน (Pick a date range)")
+        return
+    if (days[-1] - days[0]).days + 1 > UI_MAX_DAYS:
+        st.warning(f"ดาวน์โหลดได้ครั้งละไม่เกิน {UI_MAX_DAYS} วัน (Max {UI_MAX_DAYS} days per download); "
+                   "ช่วงที่ยาวกว่านั้นใช้ python export.py")
+        return
+    store = {"Telemetry history": get_history_store(), "Activity logs": None}.get(source, raw)
+    if store is not None:
+        # นับแถวจาก index ของ ring ได้ทันที (searchsorted): เกินเพดานก็บอกก่อน ไม่ต้องรอกดดาวน์โหลดแล้ว error
+        rows = len(store.window(start_ms / 1000, end_ms / 1000)['ts'])
+        if rows > UI_MAX_ROWS:
+            st.warning(f"ช่วงนี้มี {rows:,} แถว เกิน {UI_MAX_ROWS:,} แถวต่อการดาวน์โหลด (Too many rows); "
+                       "เลือกช่วงที่สั้นลงหรือใช้ python export.py")
+            return
+    kind = {"Telemetry history": "telemetry", "Activity logs": "activity_logs"}.get(source, "telemetry_raw")
+    label = f"{kind}_{days[0]:%Y%m%d}_{days[-1]:%Y%m%d}.{fmt}"
+    user, role = st.session_state.get('username', 'Unknown'), st.session_state.get('user_role', 'Unknown')
+
+    def build():
+        # callable นี้รันนอก script thread: ใช้ session_state ไม่ได้ จึงส่ง log ผ่าน shipper โดยตรง
+        if store is not None:
+            data = to_download(export_history, store, start_ms / 1000, end_ms / 1000, fmt=fmt)
+        else:
+            data = to_download(export_logs, log_ref, start_ms, end_ms, fmt=fmt)
+        get_log_shipper().submit({"user": user, "role": role, "action": f"Exported {label}",
+                                  "timestamp": get_now().strftime("%Y-%m-%d %H:%M:%S")})
+        return data
+
+    st.download_button(f"📥 ดาวน์โหลด {label}", data=build, file_name=label, mime=FORMATS[fmt],
+                       on_click="ignore", use_container_width=True)
+    st.caption(f"Telemetry: ความละเอียด 1 วินาที ย้อนหลังได้ 30 วัน · Raw ingest: ทุก sample จาก gateway "
+               f"ย้อนหลังตามขนาดไฟล์ · ดาวน์โหลดได้ครั้งละไม่เกิน {UI_MAX_DAYS} วัน / {UI_MAX_ROWS:,} แถว "
+               "(มากกว่านั้นใช้ python export.py)")
+
+def _log_page_move(step, cursor=None):
+    stack = st.session_state['_log_cursors']
+    if step > 0:
+        stack.append(cursor)
+    elif stack:
+        stack.pop()
+
+@st.fragment(run_every=2)
+def logs_panel():
+    with timed('fragment: logs'):
+        f1, f2, f3, f4 = st.columns([1, 1, 1, 1.4])
+        with f1: user = st.text_input("ผู้ใช้ (User)", key="log_user").strip()
+        with f2: role = st.selectbox("สิทธิ์ (Role)", ["", "super_admin", "user"], key="log_role")
+        with f3: kind = st.selectbox("ประเภท (Action)", [""] + [k for k, _ in ACTION_KINDS] + ["other"], key="log_kind")
+        with f4: days = st.date_input("ช่วงวันที่ (Date range)", value=[], key="log_days")
+        start_ms, end_ms = _log_range_ms(days)
+        filters = (user, role, kind, start_ms, end_ms)
+
+        # cursor = push key ของแถวสุดท้ายในหน้าก่อน; เปลี่ยนตัวกรองแล้วกลับไปหน้าแรก
+        if st.session_state.get('_log_filters') != filters:
+            st.session_state['_log_filters'] = filters
+            st.session_state['_log_cursors'] = []
+        stack = st.session_state['_log_cursors']
+        before = stack[-1] if stack else None
+
+        recent = get_recent_logs()
+        version, _ = recent.get()
+        def build():
+            # หน้าที่ไม่มีตัวกรองมาจาก mirror ในหน่วยความจำ; ที่เหลือ query ตาม index ทีละหน้า
+            page = None if any(filters) else recent.page(LOG_PAGE_SIZE, before)
+            return page or query_page(log_ref, LOG_PAGE_SIZE, before=before, user=user or None,
+                                      role=role or None, kind=kind or None, start_ms=start_ms, end_ms=end_ms)
+        # หน้าแรกอัปเดตเมื่อมี log ใหม่; หน้าเก่ากว่าไม่เปลี่ยนจึง query ครั้งเดียว
+        try:
+            items, next_cursor = memo_by_version('_log_page', (filters, before, version if before is None else 0), build)
+        except Exception:
+            st.warning("โหลดประวัติกิจกรรมไม่สำเร็จ (Log query failed)")
+            return
+        if items:
+            import pandas as pd
+            st.dataframe(pd.DataFrame([entry for _, entry in items]), hide_index=True, use_container_width=True)
+        else:
+            st.caption("ไม่พบรายการ (No entries)")
+        p1, p2, p3 = st.columns([1, 2, 1])
+        with p1:
+            st.button("◀ ใหม่กว่า (Newer)", key="log_newer", disabled=not stack,
+                      on_click=_log_page_move, args=(-1,), use_container_width=True)
+        with p2:
+            st.caption(f"หน้า {len(stack) + 1} · {len(items)} รายการ")
+        with p3:
+            st.button("เก่ากว่า (Older) ▶", key="log_older", disabled=next_cursor is None,
+                      on_click=_log_page_move, args=(1, next_cursor), use_container_width=True)
+
+@st.fragment(run_every=5)
+def timing_panel():
+    rows = timing_report()
+    if rows:
+        import pandas as pd
+        st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+
+@st.fragment(run_every=5)
+def diagnostics_panel():
+    # ค่ารวมทั้ง process (ทุก session) จาก metrics registry
+    import pandas as pd
+    traffic = REGISTRY.counters('rtdb_bytes_total')
+    errors = REGISTRY.counters('rtdb_errors_total')
+    rows = []
+    for row in REGISTRY.summary():
+        if row['name'] != 'rtdb_request_duration_seconds':
+            continue
+        labels = (('op', row['op']), ('ref', row['ref']))
+        rows.append({
+            'ref': row['ref'], 'op': row['op'], 'calls': row['count'],
+            'errors': sum(n for key, n in errors.items() if key[:2] == labels),
+            'p50 ms': round(row['p50'] * 1000, 1), 'p95 ms': round(row['p95'] * 1000, 1),
+            'p99 ms': round(row['p99'] * 1000, 1),
+            'KB': round(sum(n for key, n in traffic.items() if key[:2] == labels) / 1024, 1),
+        })
+    if rows:
+        st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+    by_type = {}
+    for key, n in errors.items():
+        labels = dict(key)
+        by_type[f"{labels['op']}/{labels['type']}"] = by_type.get(f"{labels['op']}/{labels['type']}", 0) + n
+    if by_type:
+        st.caption("Errors by type: " + ", ".join(f"{name} × {n}" for name, n in sorted(by_type.items())))
+    events = sum(REGISTRY.counters('rtdb_events_total').values())
+    st.caption(f"RTDB calls (this session): {REGISTRY.session_calls()} · listener events: {events}")
+    cache = get_state_cache()
+    st.caption(f"Worker pid {os.getpid()} · {'leader (Firebase listener)' if cache.is_leader() else 'follower'}"
+               f" · leader pid {cache.buffer.leader_pid()}")
+    server = get_metrics_server()
+    st.caption(f"Prometheus: http://127.0.0.1:{server.server_address[1]}/metrics" if server
+               else "Prometheus endpoint: ปิดอยู่ (VALVE_METRICS_PORT)")
+
+# --- 5. MAIN INTERFACE ---
 st.set_page_config(page_title="GATE VALVE CONTROL", layout="wide")
 init_default_user()
 
 if check_login():
+    rerun_started, rerun_calls = time.perf_counter(), REGISTRY.session_calls()
+    # โมดูลที่ใช้ pandas/numpy: import เมื่อเข้าหน้า dashboard ครั้งแรกของ process เท่านั้น
+    from fleet import FLEET_ROOT
+    from schedule_sync import ScheduleConflict, apply_schedule, fingerprint, legacy_list, load_editor, queue_schedule
+    from schedule_engine import compile_schedule
     firebase_data = get_safe_data()
-    now_th = get_now()
-    
+
     # ตรวจสอบสิทธิ์ว่าเป็น Super Admin หรือไม่
     is_super_admin = st.session_state.get('user_role') == "super_admin"
 
     # --- CSS STYLING ---
-    st.markdown("""
-        <style>
-        @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+Thai:wght@400;600;700&family=Orbitron:wght@400;700&family=Rajdhani:wght@400;600;700&display=swap');
-        svg, [data-testid="stSidebarNav"] svg, [data-testid="collapsedControl"] svg {
-            display: inline-block !important;
-            fill: currentColor !important;
-            color: inherit !important;
-        }
-        html, body, .stMarkdown p, .stMarkdown span, label {
-            font-family: 'Rajdhani', 'Noto Sans Thai', sans-serif !important;
-        }
-        [data-testid="stMetricLabel"] p {
-            color: #FFFFFF !important;
-            font-family: 'Noto Sans Thai', sans-serif !important;
-            font-size: 1.15rem !important;
-            font-weight: 600 !important;
-            opacity: 1 !important;
-        }
-        [data-testid="stMetricValue"] {
-            color: #00ff88 !important;
-            font-family: 'Orbitron', sans-serif !important;
-        }
-        [data-testid="stSidebar"] .stMarkdown p, [data-testid="stSidebar"] strong {
-            color: #000000 !important;
-            font-family: 'Noto Sans Thai', sans-serif !important;
-        }
-        .stButton>button { 
-            background: linear-gradient(135deg, #1e272e 0%, #2f3640 100%) !important; 
-            color: #00ff88 !important; 
-            border: 1px solid #00ff88 !important; 
-            font-family: 'Segoe UI Emoji', 'Orbitron', 'Noto Sans Thai', sans-serif !important; 
-        }
-        /* ปรับสีปุ่มที่โดน Disable ให้ดูจางลง */
-        .stButton>button:disabled {
-            color: #444444 !important;
-            border-color: #444444 !important;
-            background: #1a1a1a !important;
-        }
-        .stApp { background: radial-gradient(circle, #1a1f25 0%, #0d0f12 100%); color: #e0e0e0; }
-        [data-testid="stSidebar"] a { color: #000000 !important; text-decoration: underline; font-weight: bold; }
-        .section-head-red { border-bottom: 1px solid #333; color: #ff3e3e; font-family: 'Orbitron', 'Noto Sans Thai'; font-size: 1.1rem; margin-bottom: 10px;}
-        </style>
-        """, unsafe_allow_html=True)
+    # stylesheet อ่านครั้งเดียวต่อ process และส่งเฉพาะตอน rerun ทั้งหน้า (fragment ไม่ส่งซ้ำ)
+    st.markdown(load_css('dashboard.css'), unsafe_allow_html=True)
 
     # --- SIDEBAR & LINKS ---
     st.sidebar.markdown(f"### 👤 ผู้ใช้งาน: {st.session_state.username}")
     st.sidebar.markdown(f"**สถานะสิทธิ์:** {'🟢 ผู้ดูแลระบบ' if is_super_admin else '🟡 ผู้ชมทั่วไป'}")
-    
-    if not firebase_data['online']:
-        st.sidebar.warning("⚠️ โหมดออฟไลน์ (Offline)")
-    else:
-        st.sidebar.success("● ระบบออนไลน์ (Online)")
-    
+    with st.sidebar:
+        status_badge()
+
     st.sidebar.markdown("---")
     st.sidebar.markdown("🔗 **ลิงก์ข้อมูลเพิ่มเติม**")
     st.sidebar.markdown("- [ข้อมูลถังน้ำใสเรณู](https://water-aimonitor-leak.onrender.com/showWater)")
@@ -179,101 +629,89 @@ if check_login():
         st.session_state.logged_in = False
         st.rerun()
 
+    with st.sidebar.expander("⏱️ Rerun timing (ms)"):
+        timing_panel()
+    if is_super_admin:
+        with st.sidebar.expander("📈 Diagnostics (RTDB)"):
+            diagnostics_panel()
+
     # --- MAIN CONTENT ---
     st.markdown('<h1 style="font-family:\'Orbitron\', \'Noto Sans Thai\'; text-shadow: 0 0 10px #00ff88;">ระบบควบคุมประตูน้ำแบบเรลไทม์ น.ปลาปาก</h1>', unsafe_allow_html=True)
 
-    # Metrics
-    m1, m2, m3, m4 = st.columns(4)
-    with m1: st.metric("แรงดันน้ำขณะนี้", f"{firebase_data.get('live_pressure', 0.0):.2f} บาร์")
-    with m2: st.metric("รอบการหมุนวาล์ว", f"{firebase_data.get('valve_rotation', 0.0):.1f} รอบ")
-    with m3: st.metric("ภาระโหลดมอเตอร์", f"{firebase_data.get('motor_load', 0.0)} แอมป์")
-    with m4: st.metric("เวลาปัจจุบัน (ไทย)", now_th.strftime("%H:%M:%S"))
+    # Fleet overview (เปิดด้วย VALVE_FLEET_ROOT)
+    if FLEET_ROOT:
+        st.markdown('<div class="section-head-red">🌐 FLEET OVERVIEW (ภาพรวมประตูน้ำทั้งหมด)</div>', unsafe_allow_html=True)
+        fleet_panel()
+
+    # Alarms (pressure drop / overload / stall) + Metrics
+    alarm_panel()
+    metrics_panel()
 
     col_left, col_right = st.columns([1.5, 1])
     
     with col_left:
         st.markdown('<div class="section-head-red">🚨 PRESSURE TREND (แนวโน้มแรงดัน)</div>', unsafe_allow_html=True)
-        if 'history_df' not in st.session_state:
-            time_index = pd.date_range(start=now_th-timedelta(days=3), end=now_th, freq='1H')
-            st.session_state.history_df = pd.DataFrame({'Pressure': np.random.uniform(3.5, 4.5, size=len(time_index))}, index=time_index)
-        st.line_chart(st.session_state.history_df, color="#ff3e3e", height=250)
+        trend_panel()
 
     with col_right:
         st.markdown('### 📋 SCHEDULE SETTING (ตั้งค่าเวลา)')
         # ถ้าไม่ใช่ super_admin จะแก้ไขตารางไม่ได้ (disabled)
-        schedule_raw = firebase_data.get('schedule', [{"START_TIME": "00:00", "TARGET": 0.0}])
-        current_schedule = pd.DataFrame(schedule_raw)
+        # ตารางสร้างใหม่เฉพาะเมื่อ schedule_version เปลี่ยน (ไม่ใช่ทุก rerun)
+        loaded, current_schedule = memo_by_version('_schedule', fingerprint(firebase_data),
+                                                   lambda: load_editor(firebase_data))
         edited_df = st.data_editor(
             current_schedule, 
+            key=f"schedule_editor_{loaded['version']}",
             use_container_width=True, 
+            hide_index=True,
+            column_config={"key": None},  # key ของแถวใช้ทำ diff ไม่ต้องแสดง
             num_rows="dynamic", 
             disabled=not is_super_admin  # สั่งปิดการแก้ไขถ้าไม่ใช่ admin
         )
         
-        # ปุ่มบันทึกจะกดได้เฉพาะ super_admin
+        # ปุ่มบันทึกจะกดได้เฉพาะ super_admin; ส่งเฉพาะแถวที่เปลี่ยน และล้มเหลวถ้ามีคนอื่นบันทึกก่อน
         if st.button("Apply & Sync to Firebase", use_container_width=True, disabled=not is_super_admin):
+            records = edited_df.to_dict('records')
             try:
-                ref.update({'schedule': edited_df.to_dict('records')})
-                write_log("Updated Schedule Configuration")
-                st.success("✅ บันทึกข้อมูลสำเร็จ!")
+                if get_state_cache().is_online() and not len(get_write_ahead()):
+                    new_version, update = apply_schedule(ref, loaded, records)
+                    status = f"✅ บันทึกข้อมูลสำเร็จ! (v{new_version}, {len(update)} รายการ)"
+                else:
+                    # ออฟไลน์ (หรือยัง replay คิวไม่หมด): เข้าคิว write-ahead log; ตอน replay จะเช็ก schedule_version เหมือน Apply ปกติ
+                    _, update = queue_schedule(get_write_ahead(), loaded, records)
+                    status = f"🗃️ ออฟไลน์: เก็บไว้ในคิว จะส่งเมื่อกลับมาออนไลน์ ({len(update)} รายการ)"
+                if update:
+                    write_log("Updated Schedule Configuration")
+                    st.success(status)
+                else:
+                    st.info("ไม่มีการเปลี่ยนแปลง (No changes)")
+            except ScheduleConflict as e:
+                st.error(f"❌ ตารางถูกแก้ไขโดยผู้ใช้อื่นแล้ว (v{e.current}) กรุณาตรวจสอบแล้วบันทึกอีกครั้ง")
             except:
                 st.error("❌ บันทึกล้มเหลว!")
         if not is_super_admin:
             st.caption("🔒 คุณไม่มีสิทธิ์ในการแก้ไขการตั้งค่าเวลา")
 
+        # breakpoint เรียงแล้วคอมไพล์ใหม่เฉพาะเมื่อตารางเปลี่ยน; lookup เป้าหมายด้วย searchsorted
+        active_target_panel(memo_by_version('_schedule_compiled', fingerprint(firebase_data),
+                                            lambda: compile_schedule(legacy_list(loaded['rows']))))
+        with st.expander("🔬 What-if: จำลองตารางที่แก้ไขย้อนหลัง 7 วัน"):
+            if st.button("จำลอง (Simulate)", use_container_width=True):
+                what_if_panel(legacy_list(loaded['rows']), edited_df.to_dict('records'))
+
     # Manual Control Panel
     st.markdown('### 🛠️ MANUAL OVERRIDE (ควบคุมด้วยตนเอง)')
     if not is_super_admin:
         st.info("ℹ️ เฉพาะผู้ดูแลระบบ (Super Admin) เท่านั้นที่สามารถควบคุมประตูน้ำได้")
 
-    mode_remote = firebase_data.get('auto_mode', True)
-    ctrl_1, ctrl_2, ctrl_3, ctrl_4 = st.columns([1, 1, 1, 1])
-
-    with ctrl_3:
-        # Toggle จะถูกปิดถ้าไม่ใช่ super_admin
-        is_auto = st.toggle("Auto Mode (โหมดอัตโนมัติ)", value=mode_remote, disabled=not is_super_admin)
-        if is_super_admin and is_auto != mode_remote:
-            try:
-                ref.update({'auto_mode': is_auto})
-                write_log(f"Auto Mode set to {is_auto}")
-            except: pass
-
-    with ctrl_1:
-        # ปุ่ม Open จะทำงานเฉพาะ admin และต้องไม่อยู่ในโหมด auto
-        if st.button("🔼 Open Valve (เปิด)", use_container_width=True, disabled=(not is_super_admin or is_auto)):
-            try:
-                ref.update({'command': 'OPEN', 'last_command_time': now_th.strftime("%Y-%m-%d %H:%M:%S")})
-                write_log("Manual Command: OPEN")
-            except: pass
-
-    with ctrl_2:
-        if st.button("🔽 Close Valve (ปิด)", use_container_width=True, disabled=(not is_super_admin or is_auto)):
-            try:
-                ref.update({'command': 'CLOSE', 'last_command_time': now_th.strftime("%Y-%m-%d %H:%M:%S")})
-                write_log("Manual Command: CLOSE")
-            except: pass
-
-    with ctrl_4:
-        # Emergency Stop ควรให้เฉพาะ admin กดเช่นกัน เพื่อป้องกันการกลั่นแกล้ง
-        if st.button("🚨 Emergency Stop (หยุด)", type="primary", use_container_width=True, disabled=not is_super_admin):
-            try:
-                ref.update({'command': 'STOP', 'emergency': True})
-                write_log("EMERGENCY STOP")
-                st.error("ส่งคำสั่งหยุดฉุกเฉินแล้ว")
-            except: pass
+    control_panel(is_super_admin)
+    command_status()
 
     # Logs
     st.markdown("---")
     st.markdown("### 📜 RECENT ACTIVITY LOGS (ประวัติกิจกรรม)")
-    try:
-        logs = log_ref.order_by_key().limit_to_last(10).get()
-        if logs:
-            log_list = [logs[key] for key in reversed(logs.keys())]
-            st.table(pd.DataFrame(log_list))
-    except: pass
-
-    time.sleep(5) 
-    st.rerun()
-
-
+    logs_panel()
+    with st.expander("📤 EXPORT (ส่งออกข้อมูลสำหรับรายงาน)"):
+        export_panel()
 
+    record('full rerun', time.perf_counter() - rerun_started, REGISTRY.session_calls() - rerun_calls)
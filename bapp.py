@@ -1,15 +1,26 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
+import os
 import time
 import pytz  # สำหรับจัดการเวลาประเทศไทย
 from datetime import datetime, timedelta
 import firebase_admin
 from firebase_admin import credentials, db
+from state_cache import TELEMETRY_FIELDS, TelemetryCache
+from history_store import DEFAULT_PATH as HISTORY_PATH, HistoryStore, telemetry_sink
+from rollup import RollupEngine
+from user_directory import UserDirectory
+from activity_log import index_fields
+from pushid import push_key
+from schedule_sync import ScheduleConflict, apply_schedule, load_editor
 
 # --- 0. ตั้งค่า Timezone ---
 local_tz = pytz.timezone('Asia/Bangkok')
 
+# bapp มี listener ของตัวเอง ไม่ได้อยู่ใน election ของ app.py (shared_state.py) ที่ให้ worker เดียวเขียน history
+# จึงใช้ ring buffer แยกไฟล์ ไม่ให้มีสองคนเขียนไฟล์เดียวกันเมื่อรันคู่กัน
+BAPP_HISTORY_PATH = os.environ.get('VALVE_BAPP_HISTORY_PATH', os.path.splitext(HISTORY_PATH)[0] + '.bapp.bin')
+
 def get_now():
     """ดึงเวลาปัจจุบันเป็นเวลาไทย"""
     return datetime.now(local_tz)
@@ -36,14 +47,15 @@ user_ref = db.reference('valve_system/users')
 log_ref = db.reference('activity_logs')
 
 # --- 2. ฟังก์ชัน Initialize User ---
+@st.cache_resource
+def get_user_directory():
+    # โหลดรายชื่อผู้ใช้ครั้งเดียวต่อ process แล้วอัปเดตด้วย listener (รหัสผ่านเก็บแบบ hash)
+    return UserDirectory(user_ref).start()
+
+@st.cache_resource
 def init_default_user():
     try:
-        users = user_ref.get()
-        if users is None:
-            user_ref.child('admin').set({
-                'password': 'papak123',
-                'role': 'super_admin'
-            })
+        get_user_directory().ensure_default_admin()
     except: pass
 
 init_default_user()
@@ -51,11 +63,14 @@ init_default_user()
 # --- 3. ฟังก์ชันบันทึกประวัติ (ใช้เวลาไทย) ---
 def write_log(action):
     try:
-        log_ref.push({
+        entry = {
             "user": st.session_state.get('username', 'Unknown'),
             "action": action,
             "timestamp": get_now().strftime("%Y-%m-%d %H:%M:%S")
-        })
+        }
+        # key สร้างเองเพื่อเก็บ index field (user_key/kind_key) ไว้ใน entry เดียวกัน
+        key = push_key()
+        log_ref.child(key).set(dict(entry, **index_fields(key, entry)))
     except: pass
 
 # --- 4. ฟังก์ชันระบบ Login ---
@@ -82,12 +97,14 @@ def check_login():
             u = st.text_input("Username", key="login_u")
             p = st.text_input("Password", type="password", key="login_p")
             if st.button("Login", use_container_width=True):
-                user_data = user_ref.child(u).get()
-                if user_data and user_data.get('password') == p:
+                user_data, retry_after = get_user_directory().authenticate(u, p)
+                if user_data:
                     st.session_state.logged_in = True
                     st.session_state.username = u
                     write_log("User Logged In")
                     st.rerun()
+                elif retry_after:
+                    st.error(f"ใส่รหัสผิดหลายครั้ง กรุณารอ {retry_after:.0f} วินาที (Too many attempts)")
                 else:
                     st.error("Invalid Username or Password")
             st.markdown('</div>', unsafe_allow_html=True)
@@ -95,21 +112,28 @@ def check_login():
     return True
 
 # --- 5. ฟังก์ชันดึงข้อมูลแบบ Safety ---
+@st.cache_resource
+def get_history_store():
+    # ring buffer บนไฟล์ memory-mapped ใช้ร่วมกันทุก session และไม่หายเมื่อ restart
+    return HistoryStore(BAPP_HISTORY_PATH)
+
+@st.cache_resource
+def get_rollups():
+    # min/max/mean/last ที่ 1 วินาที, 1 นาที, 15 นาที, 1 ชั่วโมง สร้างจากประวัติเดิมครั้งเดียว
+    rollups = RollupEngine()
+    rollups.backfill(get_history_store())
+    return rollups
+
+@st.cache_resource
+def get_state_cache():
+    # listen เฉพาะ field ของ telemetry + schedule ไม่ดึง users มาด้วย
+    cache = TelemetryCache(ref, fields=TELEMETRY_FIELDS)
+    cache.subscribe(telemetry_sink(get_history_store(), also=(get_rollups().add,)))
+    cache.start()
+    return cache
+
 def get_safe_data():
-    if 'cached_data' not in st.session_state:
-        st.session_state.cached_data = {
-            'live_pressure': 0.0, 'valve_rotation': 0.0, 'auto_mode': True,
-            'motor_load': 0.0, 'schedule': [], 'online': False
-        }
-    try:
-        data = ref.get()
-        if data:
-            st.session_state.cached_data.update(data)
-            st.session_state.cached_data['online'] = True
-        return st.session_state.cached_data
-    except:
-        st.session_state.cached_data['online'] = False
-        return st.session_state.cached_data
+    return get_state_cache().snapshot()
 
 # --- เริ่มการทำงานหลัก ---
 # หมายเหตุ: st.set_page_config ต้องอยู่บรรทัดแรกๆ ของสคริปต์
@@ -156,23 +180,31 @@ if check_login():
     
     with col_left:
         st.markdown('<div class="section-head-red">🚨 PRESSURE TREND</div>', unsafe_allow_html=True)
-        if 'history_df' not in st.session_state:
-            # สร้างข้อมูลจำลองอิงตามเวลาไทย
-            time_index = pd.date_range(start=now_th-timedelta(days=3), end=now_th, freq='1H')
-            st.session_state.history_df = pd.DataFrame({'Pressure': np.random.uniform(3.5, 4.5, size=len(time_index))}, index=time_index)
-        st.line_chart(st.session_state.history_df, color="#ff3e3e", height=250)
+        # ข้อมูลจริงย้อนหลัง 3 วันจาก history store (เวลาไทย)
+        # เลือก tier ตามช่วงเวลาและความกว้างกราฟ ไม่เกิน 2,000 จุดต่อกราฟ
+        trend_df = get_rollups().chart_frame('live_pressure', (now_th - timedelta(days=3)).timestamp(),
+                                             now_th.timestamp(), width_px=1000, tz=local_tz)
+        if len(trend_df):
+            st.line_chart(trend_df, color="#ff3e3e", height=250)
+        else:
+            st.info("No pressure history yet")
 
     with col_right:
         st.markdown('### 📋 SCHEDULE SETTING')
-        schedule_raw = firebase_data.get('schedule', [{"START_TIME": "00:00", "TARGET": 0.0}])
-        current_schedule = pd.DataFrame(schedule_raw)
-        edited_df = st.data_editor(current_schedule, use_container_width=True, num_rows="dynamic")
+        loaded, current_schedule = load_editor(firebase_data)
+        edited_df = st.data_editor(current_schedule, key=f"schedule_editor_{loaded['version']}",
+                                   use_container_width=True, hide_index=True, column_config={"key": None},
+                                   num_rows="dynamic")
         
         if st.button("Apply & Sync to Firebase", use_container_width=True):
             try:
-                ref.update({'schedule': edited_df.to_dict('records')})
-                write_log("Updated Schedule Configuration")
+                # ส่งเฉพาะแถวที่เปลี่ยน; ล้มเหลวถ้ามีคนอื่นบันทึกตารางก่อน
+                _, update = apply_schedule(ref, loaded, edited_df.to_dict('records'))
+                if update:
+                    write_log("Updated Schedule Configuration")
                 st.success("✅ Synced & Logged!")
+            except ScheduleConflict:
+                st.error("❌ Schedule was changed by someone else, please review and apply again")
             except:
                 st.error("❌ Sync Failed!")
 
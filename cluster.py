@@ -0,0 +1,209 @@
+"""Run several dashboard worker processes behind a local load balancer.
+
+    python cluster.py --workers 4 --port 8501
+
+Each worker is ``streamlit run app.py`` on 127.0.0.1:<worker-port + i>, with its
+own activity-log spool, write-ahead log and metrics port. Telemetry, history,
+schedule state and command acks are shared: one elected worker listens to
+Firebase and the others read shared memory (see shared_state.py). Followers see
+a ``command_ack`` up to one poll (0.5 s) after the leader does.
+
+Still one per worker, so Firebase connections and their load grow with
+``--workers``:
+
+- the ``users`` listener (UserDirectory). Sharing it would copy the users
+  node, passwords included, into the shared state file on disk.
+- RecentLogs queries for the log panel: at most one every 2 s per worker,
+  and only while a session shows the panel.
+- LogShipper writes and the write-ahead log. Each worker ships the actions
+  of its own sessions from its own spool, so a crash loses nothing that
+  another process would have had to hand over.
+
+The balancer is an asyncio TCP proxy that reads only the request head of each
+new connection. A Streamlit session lives in one process (its websocket, its
+widget state, its download files), so a browser without a ``valve_worker``
+cookie is sent to the healthy worker with the fewest open connections and gets
+the cookie on its first response. After that the page, the websocket and media
+requests all reach the same worker. Workers that exit are restarted, and a
+worker failing ``/_stcore/health`` gets no new browsers until it recovers.
+"""
+import asyncio
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+COOKIE = 'valve_worker'
+MAX_HEAD = 64 * 1024
+
+
+def worker_env(i, data_dir=DATA_DIR, metrics_port=9464, cookie_secret=None):
+    """Environment for worker ``i``: per-worker spool/WAL/metrics, shared history and state."""
+    env = dict(os.environ)
+    env.update({
+        'VALVE_WORKER': str(i),
+        'VALVE_LOG_SPOOL': os.path.join(data_dir, f'activity_log.{i}.spool'),
+        'VALVE_WAL_PATH': os.path.join(data_dir, f'control.{i}.wal'),
+        'VALVE_METRICS_PORT': str(metrics_port + i if metrics_port else 0),
+    })
+    env.setdefault('VALVE_HISTORY_PATH', os.path.join(data_dir, 'valve_history.bin'))
+    env.setdefault('VALVE_SHARED_STATE', os.path.join(data_dir, 'shared_state.bin'))
+    if cookie_secret:
+        # XSRF/cookie ของ Streamlit ต้องใช้ secret เดียวกันทุก worker
+        env['STREAMLIT_SERVER_COOKIE_SECRET'] = cookie_secret
+    return env
+
+
+def spawn_worker(i, port, app_path=APP_PATH, **env_kwargs):
+    return subprocess.Popen(
+        [sys.executable, '-m', 'streamlit', 'run', app_path, '--server.port', str(port),
+         '--server.address', '127.0.0.1', '--server.headless', 'true',
+         '--browser.gatherUsageStats', 'false'],
+        env=worker_env(i, **env_kwargs), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _cookie_worker(head):
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() != b'cookie':
+            continue
+        for part in value.split(b';'):
+            key, _, val = part.strip().partition(b'=')
+            if key == COOKIE.encode() and val.isdigit():
+                return int(val)
+    return None
+
+
+class Balancer:
+    """Sticky least-connections TCP proxy in front of ``backends`` [(host, port), ...]."""
+
+    def __init__(self, backends, health_interval=2.0):
+        self.backends = list(backends)
+        self.healthy = [True] * len(self.backends)
+        self.connections = [0] * len(self.backends)
+        self.assigned = [0] * len(self.backends)   # browser ใหม่ที่ส่งไปแต่ละ worker
+        self.health_interval = health_interval
+
+    def pick(self, wanted=None):
+        if wanted is not None and 0 <= wanted < len(self.backends) and self.healthy[wanted]:
+            return wanted
+        candidates = [i for i, ok in enumerate(self.healthy) if ok] or list(range(len(self.backends)))
+        return min(candidates, key=lambda i: (self.connections[i], self.assigned[i]))
+
+    async def handle(self, reader, writer):
+        upstream = None
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        wanted = _cookie_worker(head)
+        i = self.pick(wanted)
+        if i != wanted:
+            self.assigned[i] += 1
+        self.connections[i] += 1
+        try:
+            up_reader, upstream = await asyncio.open_connection(*self.backends[i])
+            upstream.write(head)
+            cookie = None if i == wanted else f'Set-Cookie: {COOKIE}={i}; Path=/; HttpOnly; SameSite=Lax\r\n'.encode()
+            await asyncio.gather(self._pipe(reader, upstream), self._pipe(up_reader, writer, cookie))
+        except (ConnectionError, OSError):
+            if upstream is None:
+                writer.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        finally:
+            self.connections[i] -= 1
+            for stream in (writer, upstream):
+                if stream is not None:
+                    stream.close()
+
+    @staticmethod
+    async def _pipe(reader, writer, inject=None):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                if inject is not None and data.startswith(b'HTTP/'):
+                    # ใส่ cookie หลัง status line ของ response แรก
+                    end = data.find(b'\r\n') + 2
+                    data = data[:end] + inject + data[end:]
+                    inject = None
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if writer.can_write_eof():
+                try:
+                    writer.write_eof()
+                except (ConnectionError, OSError):
+                    pass
+
+    async def check_health(self):
+        while True:
+            for i, (host, port) in enumerate(self.backends):
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), 2.0)
+                    writer.write(f'GET /_stcore/health HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n'.encode())
+                    status = await asyncio.wait_for(reader.readline(), 2.0)
+                    writer.close()
+                    self.healthy[i] = b' 200 ' in status
+                except (OSError, asyncio.TimeoutError):
+                    self.healthy[i] = False
+            await asyncio.sleep(self.health_interval)
+
+
+async def run_cluster(workers, port, worker_port, app_path=APP_PATH, data_dir=DATA_DIR, metrics_port=9464):
+    secret = os.environ.get('STREAMLIT_SERVER_COOKIE_SECRET') or secrets.token_hex(16)
+    ports = [worker_port + i for i in range(workers)]
+    options = dict(app_path=app_path, data_dir=data_dir, metrics_port=metrics_port, cookie_secret=secret)
+    procs = [spawn_worker(i, p, **options) for i, p in enumerate(ports)]
+    balancer = Balancer([('127.0.0.1', p) for p in ports])
+    server = await asyncio.start_server(balancer.handle, '0.0.0.0', port, limit=MAX_HEAD)
+    health = asyncio.create_task(balancer.check_health())
+    print(f"balancer :{port} -> workers {ports} (data {data_dir})")
+    try:
+        while True:
+            await asyncio.sleep(1.0)
+            for i, proc in enumerate(procs):
+                if proc.poll() is not None:
+                    print(f"worker {i} exited ({proc.returncode}), restarting")
+                    procs[i] = spawn_worker(i, ports[i], **options)
+    finally:
+        health.cancel()
+        server.close()
+        for proc in procs:
+            proc.terminate()
+        deadline = time.time() + 10
+        for proc in procs:
+            try:
+                proc.wait(max(0.1, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--port', type=int, default=8501, help='public port of the balancer')
+    parser.add_argument('--worker-port', type=int, default=8601, help='first worker port')
+    parser.add_argument('--metrics-port', type=int, default=9464, help='first worker metrics port (0 = off)')
+    parser.add_argument('--app', default=APP_PATH)
+    parser.add_argument('--data', default=DATA_DIR, help='directory for shared and per-worker files')
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    main = loop.create_task(run_cluster(args.workers, args.port, args.worker_port, args.app, args.data,
+                                        args.metrics_port))
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, main.cancel)
+    try:
+        loop.run_until_complete(main)
+    except asyncio.CancelledError:
+        pass
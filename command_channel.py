@@ -0,0 +1,323 @@
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+
+# คำสั่งหยุดฉุกเฉินมาก่อนเสมอ
+PRIORITY = {'STOP': 0, 'OPEN': 1, 'CLOSE': 1}
+
+QUEUED, SENDING, SENT, ACKED = 'queued', 'sending', 'sent', 'acked'
+FAILED, SUPERSEDED, TIMEOUT = 'failed', 'superseded', 'timeout'
+OFFLINE = 'offline'   # ส่งไม่ได้ เก็บไว้ใน write-ahead log รอ replay
+
+
+class CommandState:
+    __slots__ = ('seq', 'command', 'user', 'status', 'submitted_at', 'sent_at', 'acked_at', 'error')
+
+    def __init__(self, seq, command, user):
+        self.seq = seq
+        self.command = command
+        self.user = user
+        self.status = QUEUED
+        self.submitted_at = time.time()
+        self.sent_at = None
+        self.acked_at = None
+        self.error = None
+
+    @property
+    def rtt_ms(self):
+        """Dispatch-to-ack latency (time the record hit the RTDB until the controller acked)."""
+        if self.sent_at is None or self.acked_at is None:
+            return None
+        return (self.acked_at - self.sent_at) * 1000.0
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__} | {'rtt_ms': self.rtt_ms}
+
+
+class CommandChannel:
+    """Sequence-numbered manual commands with controller acknowledgement.
+
+    Commands are written as ``valve_system/command_record`` = {seq, command,
+    issued_at, issued_by} together with the legacy ``command`` /
+    ``last_command_time`` / ``emergency`` fields in one multi-path update. The
+    controller confirms by writing ``command_ack`` = {seq, status}; a listener on
+    that node stamps the ack time the moment it arrives. With ``listen=False``
+    the caller feeds ``ack(record)`` from a listener it already has instead
+    (e.g. the shared telemetry tier, so a machine holds one ``command_ack``
+    listener however many worker processes it runs).
+
+    A single dispatcher thread sends in priority order. STOP jumps ahead of
+    anything queued and cancels queued OPEN/CLOSE commands that it supersedes,
+    including one the dispatcher is still retrying: that one is abandoned at
+    its next attempt instead of finishing its backoff first. STOP still goes
+    through the same dispatcher, so an older OPEN/CLOSE can never land after it.
+
+    When every retry fails, ``fallback(update, state)`` (e.g. a WriteAheadLog)
+    gets the multi-path update to deliver later; the command then stays
+    ``offline`` until the controller acks it.
+    """
+
+    def __init__(self, root_ref, ack_timeout=10.0, send_retries=3, history=200, fallback=None, listen=True):
+        self.root_ref = root_ref
+        self.fallback = fallback
+        self.listen = listen
+        self.ack_timeout = ack_timeout
+        self.send_retries = send_retries
+        self._queue = queue.PriorityQueue()
+        self._preempt = threading.Event()   # มี STOP รอในคิว: OPEN/CLOSE ที่กำลัง retry ให้หยุด
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._commands = {}
+        self._recent = deque(maxlen=history)
+        self._rtts = deque(maxlen=history)
+        self._last_seq = 0
+        self._registration = None
+        self._thread = None
+        self.version = 0
+
+    # --- lifecycle ---
+    def start(self):
+        if self._thread is not None:
+            return
+        try:
+            if self.listen:
+                self._registration = self.root_ref.child('command_ack').listen(self._on_ack)
+        except Exception:
+            self._registration = None   # ยังส่งคำสั่งได้ แต่จะไม่เห็น ack จนกว่าจะ start ใหม่
+        self._thread = threading.Thread(target=self._run, name='command-dispatch', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put((-1, -1, None))
+        if self._thread is not None:
+            self._thread.join(5)
+        if self._registration is not None:
+            self._registration.close()
+
+    # --- submit side ---
+    def _next_seq(self):
+        # เลขลำดับอิงเวลา (ms) จึงเรียงกันได้แม้มีหลาย process ส่งคำสั่ง
+        with self._lock:
+            self._last_seq = max(self._last_seq + 1, int(time.time() * 1000))
+            return self._last_seq
+
+    def submit(self, command, user='Unknown'):
+        """Queue ``command`` for dispatch and return its CommandState immediately."""
+        state = CommandState(self._next_seq(), command, user)
+        priority = PRIORITY.get(command, 1)
+        with self._lock:
+            if len(self._recent) == self._recent.maxlen:
+                self._commands.pop(self._recent[0].seq, None)
+            self._commands[state.seq] = state
+            self._recent.append(state)
+            if priority == 0:
+                for other in self._commands.values():
+                    if other.status == QUEUED and other is not state and PRIORITY.get(other.command, 1) > 0:
+                        other.status = SUPERSEDED
+            self.version += 1
+        self._queue.put((priority, next(self._order), state))
+        if priority == 0:
+            self._preempt.set()
+        return state
+
+    # --- dispatcher ---
+    def _run(self):
+        while True:
+            _, _, state = self._queue.get()
+            if state is None:
+                return
+            if PRIORITY.get(state.command, 1) == 0:
+                self._preempt.clear()
+            with self._lock:
+                if state.status != QUEUED:
+                    continue   # ถูก STOP แทนที่ไปแล้ว
+                state.status = SENDING
+            self._send(state)
+
+    def _record(self, state):
+        issued = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state.submitted_at))
+        update = {
+            'command_record': {'seq': state.seq, 'command': state.command,
+                               'issued_at': state.submitted_at, 'issued_by': state.user},
+            'command': state.command,
+            'last_command_time': issued,
+        }
+        if state.command == 'STOP':
+            update['emergency'] = True
+        return update
+
+    def _send(self, state):
+        update = self._record(state)
+        retries = self.send_retries * (3 if state.command == 'STOP' else 1)
+        preemptible = PRIORITY.get(state.command, 1) > 0
+        delay = 0.2
+        for attempt in range(retries):
+            if preemptible and self._preempt.is_set():
+                # STOP มาระหว่าง retry: ไม่ส่งต่อและไม่เข้า write-ahead log (STOP แทนที่คำสั่งนี้แล้ว)
+                with self._lock:
+                    state.status = SUPERSEDED
+                    self.version += 1
+                return
+            try:
+                self.root_ref.update(update)
+            except Exception as e:
+                state.error = f'{type(e).__name__}: {e}'
+                if preemptible:
+                    self._preempt.wait(delay)   # ตื่นทันทีเมื่อมี STOP
+                else:
+                    time.sleep(delay)
+                delay = min(delay * 2, 2.0)
+                continue
+            with self._lock:
+                if state.sent_at is None:
+                    state.sent_at = time.time()
+                if state.status == SENDING:
+                    state.status = SENT
+                self.version += 1
+            return
+        if self.fallback is not None:
+            try:
+                self.fallback(update, state)
+                with self._lock:
+                    state.status = OFFLINE
+                    self.version += 1
+                return
+            except Exception as e:
+                state.error = f'{type(e).__name__}: {e}'
+        with self._lock:
+            state.status = FAILED
+            self.version += 1
+
+    # --- ack listener ---
+    def _on_ack(self, event):
+        if event.path in ('/', ''):   # controller เขียน command_ack ทั้ง node ทุกครั้ง
+            self.ack(event.data)
+
+    def ack(self, ack, now=None):
+        """Apply one ``command_ack`` record; repeats and other processes' seqs are ignored."""
+        now = time.time() if now is None else now
+        if not isinstance(ack, dict) or 'seq' not in ack:
+            return
+        seq = ack.get('seq')
+        with self._lock:
+            state = self._commands.get(seq)
+            if state is None or state.acked_at is not None:
+                return
+            state.acked_at = now
+            if state.sent_at is None:
+                state.sent_at = now   # ack มาก่อน update() return (เครือข่ายช้า)
+            state.status = ACKED if ack.get('status', 'ok') in ('ok', 'done') else FAILED
+            if state.status == FAILED:
+                state.error = str(ack.get('status'))
+            self._rtts.append(state.rtt_ms)
+            self.version += 1
+
+    # --- read side ---
+    def recent(self, n=5):
+        now = time.time()
+        with self._lock:
+            for state in self._recent:
+                if state.status == SENT and now - state.sent_at > self.ack_timeout:
+                    state.status = TIMEOUT
+                    self.version += 1
+            return [s.as_dict() for s in list(self._recent)[-n:]][::-1]
+
+    def rtt_percentiles(self):
+        with self._lock:
+            ordered = sorted(self._rtts)
+        n = len(ordered)
+        if not n:
+            return {}
+        pick = lambda q: ordered[min(n - 1, int(q * n))]
+        return {'n': n, 'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': ordered[-1]}
+
+
+class SimulatedController:
+    """Local stand-in for the field controller: acks each command_record it sees.
+
+    Also applies OPEN/CLOSE/STOP to ``valve_rotation`` so dashboards under test
+    show a visible effect.
+    """
+
+    def __init__(self, root_ref, delay=0.05, reject=()):
+        self.root_ref = root_ref
+        self.delay = delay
+        self.reject = set(reject)
+        self.handled = []
+        self._registration = None
+        self._rotation = 0.0
+
+    def start(self):
+        self._registration = self.root_ref.child('command_record').listen(self._on_command)
+        return self
+
+    def stop(self):
+        if self._registration is not None:
+            self._registration.close()
+
+    def _on_command(self, event):
+        record = event.data
+        if not isinstance(record, dict) or 'seq' not in record:
+            return
+        timer = threading.Timer(self.delay, self._ack, args=(record,))
+        timer.daemon = True
+        timer.start()
+
+    def _ack(self, record):
+        command = record.get('command')
+        self.handled.append(record['seq'])
+        step = {'OPEN': 1.0, 'CLOSE': -1.0}.get(command, 0.0)
+        self._rotation = max(0.0, self._rotation + step)
+        status = 'rejected' if command in self.reject else 'done'
+        self.root_ref.update({
+            'command_ack': {'seq': record['seq'], 'status': status, 'acked_at': time.time()},
+            'valve_rotation': self._rotation,
+        })
+
+
+# --- Benchmark: dispatch-to-ack latency และลำดับความสำคัญของ STOP ---
+if __name__ == '__main__':
+    from fake_rtdb import FakeDatabase
+
+    database = FakeDatabase({'valve_system': {'auto_mode': False}}, latency=0.002)
+    root = database.reference('valve_system')
+    controller = SimulatedController(root, delay=0.01).start()
+    channel = CommandChannel(root)
+    channel.start()
+
+    for i in range(200):
+        state = channel.submit('OPEN' if i % 2 else 'CLOSE', 'bench')
+        while state.status in (QUEUED, SENDING, SENT):
+            time.sleep(0.0005)
+    stats = channel.rtt_percentiles()
+    print(f"round trip (n={stats['n']}): p50 {stats['p50']:.1f} ms  p95 {stats['p95']:.1f} ms  "
+          f"p99 {stats['p99']:.1f} ms  (simulated RTDB 2 ms/call, controller 10 ms)")
+
+    # คิวคำสั่ง OPEN 50 รายการแล้วกด STOP: STOP ต้องถูกส่งก่อนและยกเลิก OPEN ที่ค้าง
+    database.latency = 0.02
+    queued = [channel.submit('OPEN', 'bench') for _ in range(50)]
+    stop = channel.submit('STOP', 'bench')
+    t0 = time.time()
+    while stop.status in (QUEUED, SENDING, SENT):
+        time.sleep(0.0005)
+    sent_open = sum(1 for s in queued if s.status not in (QUEUED, SUPERSEDED))
+    superseded = sum(1 for s in queued if s.status == SUPERSEDED)
+    print(f"STOP behind 50 queued OPEN: acked in {(stop.acked_at - stop.submitted_at) * 1000:.1f} ms, "
+          f"OPEN sent before STOP={sent_open}, superseded={superseded}")
+
+    # RTDB ล่มระหว่างส่ง OPEN (dispatcher อยู่ใน backoff) แล้วกด STOP: STOP ต้องไม่รอ retry ของ OPEN
+    database.latency = 0.002
+    database.fail = True
+    stuck = channel.submit('OPEN', 'bench')
+    while stuck.error is None:
+        time.sleep(0.0005)
+    stop = channel.submit('STOP', 'bench')
+    database.fail = False
+    while stop.status in (QUEUED, SENDING):
+        time.sleep(0.0005)
+    print(f"STOP while OPEN is retrying: sent in {(stop.sent_at - stop.submitted_at) * 1000:.1f} ms, "
+          f"OPEN {stuck.status}")
+    channel.stop()
+    controller.stop()
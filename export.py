@@ -0,0 +1,233 @@
+"""Chunked export of telemetry history and activity logs to Parquet or CSV.
+
+Rows are read from the source in fixed-size chunks and handed one at a time to
+a pyarrow ``ParquetWriter`` (one row group per chunk, zstd) or ``CSVWriter``,
+so working memory depends on ``chunk_rows`` and not on the length of the range.
+That holds end to end for the command line below; a dashboard download is
+held in memory by Streamlit, so the UI range is capped (see ``to_download``).
+
+    python export.py history 2024-01-01 2024-02-01 -o pressure_jan.parquet
+    python export.py history 2024-01-01 2024-01-02 -o day.csv --store data/ingest_raw.bin
+    python export.py logs 2024-01-01 2024-12-31 -o logs_2024.csv
+    python export.py --bench            # one year of 1 s data, peak memory per range
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from activity_log import strip_index
+from history_store import SAMPLE_FIELDS
+from pushid import key_bound
+
+TIMEZONE = 'Asia/Bangkok'
+CHUNK_ROWS = 1 << 18          # ~8 MB ของ float64 4 คอลัมน์ต่อ chunk
+LOG_PAGE = 1000
+LOG_COLUMNS = ('key', 'timestamp', 'user', 'role', 'action')
+
+HISTORY_SCHEMA = pa.schema([('time', pa.timestamp('ms', tz=TIMEZONE))] +
+                           [(field, pa.float64()) for field in SAMPLE_FIELDS])
+LOG_SCHEMA = pa.schema([(column, pa.string()) for column in LOG_COLUMNS])
+FORMATS = {'parquet': 'application/vnd.apache.parquet', 'csv': 'text/csv'}
+UI_MAX_DAYS = 7               # ช่วงที่ดาวน์โหลดจากหน้าเว็บได้ ยาวกว่านี้ใช้ CLI
+UI_MAX_ROWS = 1_000_000       # 7 วันของข้อมูล 1 วินาที = 604,800 แถว (CSV ~40 MB)
+
+
+# --- sources ---
+def history_chunks(store, start_ts, end_ts, chunk_rows=CHUNK_ROWS):
+    """HistoryStore rows with start_ts <= ts <= end_ts as pyarrow record batches."""
+    view = store.window(start_ts, end_ts)
+    n = len(view['ts'])
+    for lo in range(0, n, chunk_rows):
+        hi = min(n, lo + chunk_rows)
+        # copy ทีละ chunk: ถ้า ring วนทับระหว่าง export จะเสียแค่แถวเก่าสุด ไม่ใช่ทั้งไฟล์
+        ms = (view['ts'][lo:hi] * 1000.0).astype(np.int64)
+        columns = [pa.array(ms, type=pa.timestamp('ms', tz=TIMEZONE))]
+        columns += [pa.array(np.array(view[field][lo:hi])) for field in SAMPLE_FIELDS]
+        yield pa.record_batch(columns, schema=HISTORY_SCHEMA)
+
+
+def log_chunks(log_ref, start_ms=None, end_ms=None, page_size=LOG_PAGE):
+    """Activity-log entries in the time range, oldest first, one key-range query per page."""
+    low = key_bound(start_ms) if start_ms is not None else None
+    high = key_bound(end_ms, upper=True) if end_ms is not None else None
+    cursor = None
+    while True:
+        query = log_ref.order_by_key()
+        if cursor or low:
+            query = query.start_at(cursor or low)
+        if high:
+            query = query.end_at(high)
+        # start_at รวม cursor ด้วย จึงขอเกินมา 1 แล้วตัดตัวที่เป็น cursor ทิ้ง
+        page = query.limit_to_first(page_size + 1).get() or {}
+        keys = [key for key in page if key != cursor][:page_size]
+        if not keys:
+            return
+        rows = [dict(strip_index(page[key]), key=key) for key in keys]
+        yield pa.record_batch([pa.array([str(row.get(c, '')) for row in rows], type=pa.string())
+                               for c in LOG_COLUMNS], schema=LOG_SCHEMA)
+        if len(keys) < page_size:
+            return
+        cursor = keys[-1]
+
+
+# --- writers ---
+def write_batches(batches, schema, sink, fmt, max_rows=None):
+    """Stream record batches to ``sink`` (path or binary file); returns the row count.
+
+    Raises ValueError before writing a batch that would go past ``max_rows``.
+    """
+    rows = 0
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    elif fmt == 'csv':
+        writer = pa_csv.CSVWriter(sink, schema)
+    else:
+        raise ValueError(f'unknown format: {fmt!r}')
+    try:
+        for batch in batches:
+            if max_rows is not None and rows + len(batch) > max_rows:
+                raise ValueError(f'export is over {max_rows:,} rows; use python export.py for larger ranges')
+            if fmt == 'parquet':
+                writer.write_batch(batch, row_group_size=len(batch))
+            else:
+                writer.write_batch(batch)
+            rows += len(batch)
+    finally:
+        writer.close()
+    return rows
+
+
+def export_history(store, start_ts, end_ts, sink, fmt='parquet', chunk_rows=CHUNK_ROWS, max_rows=None):
+    return write_batches(history_chunks(store, start_ts, end_ts, chunk_rows), HISTORY_SCHEMA, sink, fmt, max_rows)
+
+
+def export_logs(log_ref, start_ms, end_ms, sink, fmt='csv', page_size=LOG_PAGE, max_rows=None):
+    return write_batches(log_chunks(log_ref, start_ms, end_ms, page_size), LOG_SCHEMA, sink, fmt, max_rows)
+
+
+def to_download(export, *args, max_rows=UI_MAX_ROWS, **kwargs):
+    """Run ``export(..., sink)`` into an anonymous temp file and return it rewound.
+
+    Meant as the body of a ``st.download_button`` data callable, which Streamlit
+    runs off the script thread when the button is clicked. The rows are written
+    to disk chunk by chunk, but Streamlit then reads the whole file into memory
+    to serve it, so this is not streaming: the dashboard limits the range to
+    ``UI_MAX_DAYS`` and the export stops with ValueError past ``max_rows``.
+    Larger ranges go through the command line, which streams to the output file.
+    """
+    sink = tempfile.TemporaryFile()
+    export(*args, sink, max_rows=max_rows, **kwargs)
+    sink.seek(0)
+    return sink
+
+
+# --- Benchmark: ปีของข้อมูล 1 วินาที (31.5 ล้านแถว) หน่วยความจำสูงสุดต้องไม่โตตามช่วงเวลา ---
+def _bench_child(path, capacity, days, fmt, out):
+    import tracemalloc
+    from history_store import HistoryStore
+
+    store = HistoryStore(path, capacity=capacity)
+    end_ts = store.last_ts()
+    tracemalloc.start()
+    started = time.perf_counter()
+    rows = export_history(store, end_ts - days * 86400 + 1, end_ts, out, fmt)
+    seconds = time.perf_counter() - started
+    # heap = numpy/python (tracemalloc) + arrow memory pool
+    # VmHWM รวมหน้า mmap ของไฟล์ที่อ่านผ่าน (page cache ที่ kernel คืนได้) จึงโตตามช่วงเวลา
+    heap = tracemalloc.get_traced_memory()[1] + pa.default_memory_pool().max_memory()
+    with open('/proc/self/status') as f:
+        hwm = next((int(line.split()[1]) for line in f if line.startswith('VmHWM')), 0)
+    return rows, seconds, heap / 2**20, hwm / 1024
+
+
+if __name__ == '__main__':
+    import argparse
+    import multiprocessing
+    from datetime import datetime
+
+    import pytz
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('what', nargs='?', choices=('history', 'logs'))
+    parser.add_argument('start', nargs='?', help='YYYY-MM-DD[ HH:MM] local time, inclusive')
+    parser.add_argument('end', nargs='?', help='YYYY-MM-DD[ HH:MM] local time, exclusive')
+    parser.add_argument('-o', '--output', help='.parquet or .csv (format from the extension)')
+    parser.add_argument('--store', help='history file (default: the dashboard history store)')
+    parser.add_argument('--bench', action='store_true', help='export benchmark on a year of synthetic 1 s data')
+    parser.add_argument('--dir', help='benchmark: directory for the ~2 GB synthetic store')
+    args = parser.parse_args()
+
+    if args.bench:
+        from history_store import HistoryStore
+
+        year = 365 * 86400
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            path = os.path.join(tmp, 'year.bin')
+            store = HistoryStore(path, capacity=year)
+            rng = np.random.default_rng(0)
+            t0 = 1_704_067_200.0
+            started = time.perf_counter()
+            for lo in range(0, year, 86400):
+                ts = t0 + np.arange(lo, lo + 86400, dtype=np.float64)
+                store.append_many(ts, 3.8 + 0.3 * np.sin(ts / 3600.0) + rng.normal(0, 0.02, 86400),
+                                  np.round(10 + 5 * np.sin(ts / 43200.0), 1), 1.4 + rng.normal(0, 0.05, 86400))
+            store.flush()
+            del store
+            print(f"synthetic store: {year:,} rows in {time.perf_counter() - started:.1f} s "
+                  f"({os.path.getsize(path) / 2**30:.1f} GiB)")
+            print(f"{'range':>8} {'format':>8} {'rows':>12} {'seconds':>8} {'rows/s':>11} {'MB out':>8} "
+                  f"{'heap MB':>8} {'RSS+mmap':>9}")
+            ctx = multiprocessing.get_context('spawn')
+            for days in (1, 30, 365):
+                for fmt in ('parquet', 'csv'):
+                    out = os.path.join(tmp, f'out.{fmt}')
+                    # process ใหม่ทุกครั้ง เพื่อให้ peak RSS ของแต่ละช่วงไม่ปนกัน
+                    with ctx.Pool(1) as pool:
+                        rows, seconds, heap, rss = pool.apply(_bench_child, (path, year, days, fmt, out))
+                    print(f"{days:>6} d {fmt:>8} {rows:>12,} {seconds:>8.2f} {rows / seconds:>11,.0f} "
+                          f"{os.path.getsize(out) / 2**20:>8.1f} {heap:>8.1f} {rss:>9.0f}")
+                    os.remove(out)
+        raise SystemExit
+
+    if not (args.what and args.start and args.end and args.output):
+        parser.error('what, start, end and -o are required (or --bench)')
+    tz = pytz.timezone(TIMEZONE)
+
+    def parse(text):
+        for pattern in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+            try:
+                return tz.localize(datetime.strptime(text, pattern)).timestamp()
+            except ValueError:
+                pass
+        parser.error(f'bad date: {text!r}')
+
+    start_ts, end_ts = parse(args.start), parse(args.end)
+    fmt = 'csv' if args.output.lower().endswith('.csv') else 'parquet'
+    started = time.perf_counter()
+    if args.what == 'history':
+        from history_store import DEFAULT_PATH, open_existing
+
+        path = args.store or DEFAULT_PATH
+        # เปิดด้วย capacity ตาม header ของไฟล์ที่มีอยู่ (เช่น ไฟล์ raw ของ ingest.py)
+        store = open_existing(path)
+        if store is None:
+            parser.error(f'no history store at {path}')
+        rows = export_history(store, start_ts, end_ts - 1e-6, args.output, fmt)
+    else:
+        import streamlit as st
+        import firebase_admin
+        from firebase_admin import credentials, db
+
+        fb_dict = dict(st.secrets["firebase"])
+        fb_dict["private_key"] = fb_dict["private_key"].replace("\\n", "\n")
+        firebase_admin.initialize_app(credentials.Certificate(fb_dict), {
+            'databaseURL': 'https://dbsensor-eb39d-default-rtdb.firebaseio.com'})
+        rows = export_logs(db.reference('activity_logs'), int(start_ts * 1000), int(end_ts * 1000) - 1,
+                           args.output, fmt)
+    print(f"{rows:,} rows -> {args.output} ({os.path.getsize(args.output) / 2**20:.1f} MB, "
+          f"{time.perf_counter() - started:.1f} s)")
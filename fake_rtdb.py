@@ -0,0 +1,389 @@
+"""In-process stand-in for the ``firebase_admin.db`` Reference API.
+
+Used by the load-test and benchmark scripts so the dashboard can run offline.
+Every call is counted together with the JSON bytes it would have moved over
+the wire, so read/write volume can be compared between changes.
+"""
+import copy
+import json
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from pushid import push_key
+
+READ_OPS = ('get', 'query', 'transaction_read')
+WRITE_OPS = ('set', 'update', 'push', 'delete', 'transaction_write')
+
+
+def _split(path):
+    return [p for p in (path or '').split('/') if p]
+
+
+def _nbytes(value):
+    return len(json.dumps(value, separators=(',', ':'), default=str).encode('utf-8'))
+
+
+def _normalize(value):
+    # RTDB ไม่เก็บ node ว่าง / None และคืน array เป็น list เมื่อ key เป็นเลขเรียงกัน
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            v = _normalize(v)
+            if v is not None:
+                out[str(k)] = v
+        if not out:
+            return None
+        if all(k.isdigit() for k in out):
+            idx = sorted(int(k) for k in out)
+            if idx == list(range(len(idx))):
+                return [out[str(i)] for i in idx]
+        return out
+    if isinstance(value, (list, tuple)):
+        return _normalize({str(i): v for i, v in enumerate(value)})
+    return value
+
+
+def _tidy(node):
+    # เหมือน _normalize แต่ดูแค่ชั้นเดียว ใช้กับ node บนเส้นทางที่เพิ่งเขียน
+    if isinstance(node, dict):
+        if not node:
+            return None
+        if all(k.isdigit() for k in node):
+            idx = sorted(int(k) for k in node)
+            if idx == list(range(len(idx))):
+                return [node[str(i)] for i in idx]
+    return node
+
+
+class Event:
+    def __init__(self, event_type, path, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+
+class ListenerRegistration:
+    def __init__(self, database, path, callback):
+        self._database = database
+        self.path = path
+        self.callback = callback
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self._database._remove_listener(self)
+
+
+class FakeDatabase:
+    """Thread-safe JSON tree with call and byte counters."""
+
+    def __init__(self, data=None, latency=0.0):
+        self._root = _normalize(copy.deepcopy(data or {})) or {}
+        self._lock = threading.RLock()
+        self._listeners = []
+        self.latency = latency   # หน่วงเวลาต่อ call (วินาที) เพื่อจำลองเครือข่าย
+        self.fail = False        # True = ทุก call โยน ConnectionError (จำลองออฟไลน์)
+        self.calls = Counter()
+        self.bytes = Counter()
+
+    # --- public API ---
+    def reference(self, path='/', app=None, url=None):
+        return FakeReference(self, path)
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.bytes.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'reads': sum(self.calls[op] for op in READ_OPS),
+                'writes': sum(self.calls[op] for op in WRITE_OPS),
+                'events': self.calls['event'],
+                'bytes_read': sum(self.bytes[op] for op in READ_OPS) + self.bytes['event'],
+                'bytes_written': sum(self.bytes[op] for op in WRITE_OPS),
+                'calls': dict(self.calls),
+            }
+
+    def snapshot(self, path='/'):
+        with self._lock:
+            return copy.deepcopy(self._get(_split(path)))
+
+    # --- internals ---
+    def _count(self, op, nbytes=0):
+        if self.fail:
+            raise ConnectionError('fake RTDB is offline')
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[op] += 1
+            self.bytes[op] += nbytes
+
+    def _get(self, keys):
+        node = self._root
+        for k in keys:
+            if isinstance(node, list):
+                node = node[int(k)] if k.isdigit() and int(k) < len(node) else None
+            elif isinstance(node, dict):
+                node = node.get(k)
+            else:
+                return None
+            if node is None:
+                return None
+        return node
+
+    def _set(self, keys, value):
+        value = _normalize(copy.deepcopy(value))
+        if not keys:
+            self._root = value if isinstance(value, dict) else {}
+            return
+        # แปลง list ตามทางให้เป็น dict ก่อนเขียน แล้ว normalize กลับ
+        chain = [self._root]
+        node = self._root
+        for k in keys[:-1]:
+            child = node.get(k) if isinstance(node, dict) else None
+            if isinstance(child, list):
+                child = {str(i): v for i, v in enumerate(child)}
+            if not isinstance(child, dict):
+                child = {}
+            node[k] = child
+            node = child
+            chain.append(node)
+        if value is None:
+            node.pop(keys[-1], None)
+        else:
+            node[keys[-1]] = value
+        for depth in range(len(keys) - 1, 0, -1):
+            parent, k = chain[depth - 1], keys[depth - 1]
+            tidy = _tidy(parent[k])
+            if tidy is None:
+                parent.pop(k)
+            else:
+                parent[k] = tidy
+
+    def _remove_listener(self, registration):
+        with self._lock:
+            if registration in self._listeners:
+                self._listeners.remove(registration)
+
+    def _notify(self, writes):
+        """Deliver put/patch events for ``writes`` = [(path_keys, value_or_dict, is_patch)]."""
+        with self._lock:
+            listeners = list(self._listeners)
+        for reg in listeners:
+            lkeys = _split(reg.path)
+            for keys, value, is_patch in writes:
+                if keys[:len(lkeys)] == lkeys:
+                    rel = '/' + '/'.join(keys[len(lkeys):])
+                    event = Event('patch' if is_patch else 'put', rel, copy.deepcopy(value))
+                elif lkeys[:len(keys)] == keys:
+                    if is_patch and lkeys[len(keys)] not in value:
+                        continue   # patch ไม่แตะ subtree ของ listener นี้
+                    event = Event('put', '/', self.snapshot('/'.join(lkeys)))
+                else:
+                    continue
+                with self._lock:
+                    self.calls['event'] += 1
+                    self.bytes['event'] += _nbytes(event.data)
+                if not reg.closed:
+                    reg.callback(event)
+
+
+class FakeReference:
+    def __init__(self, database, path='/'):
+        self._db = database
+        self.path = '/' + '/'.join(_split(path))
+
+    @property
+    def key(self):
+        keys = _split(self.path)
+        return keys[-1] if keys else None
+
+    @property
+    def parent(self):
+        keys = _split(self.path)
+        return FakeReference(self._db, '/'.join(keys[:-1])) if keys else None
+
+    def child(self, path):
+        return FakeReference(self._db, self.path + '/' + path)
+
+    def get(self, etag=False, shallow=False):
+        with self._db._lock:
+            value = copy.deepcopy(self._db._get(_split(self.path)))
+            if shallow and isinstance(value, (dict, list)):
+                keys = value.keys() if isinstance(value, dict) else map(str, range(len(value)))
+                value = {k: True for k in keys}
+        self._db._count('get', _nbytes(value))
+        if etag:
+            return value, self._etag(value)
+        return value
+
+    @staticmethod
+    def _etag(value):
+        return str(hash(json.dumps(value, sort_keys=True, default=str)))
+
+    def set(self, value):
+        self._db._count('set', _nbytes(value))
+        with self._db._lock:
+            self._db._set(_split(self.path), value)
+        self._db._notify([(_split(self.path), _normalize(copy.deepcopy(value)), False)])
+
+    def update(self, value):
+        if not isinstance(value, dict) or not value:
+            raise ValueError('Value argument must be a non-empty dictionary.')
+        self._db._count('update', _nbytes(value))
+        base = _split(self.path)
+        with self._db._lock:
+            for k, v in value.items():
+                self._db._set(base + _split(k), v)
+        if all('/' not in k for k in value):
+            writes = [(base, _normalize(copy.deepcopy(value)), True)]
+        else:
+            writes = [(base + _split(k), _normalize(copy.deepcopy(v)), False) for k, v in value.items()]
+        self._db._notify(writes)
+
+    def push(self, value=''):
+        self._db._count('push', _nbytes(value))
+        child = self.child(push_key())
+        with self._db._lock:
+            self._db._set(_split(child.path), value)
+        self._db._notify([(_split(child.path), _normalize(copy.deepcopy(value)), False)])
+        return child
+
+    def delete(self):
+        self._db._count('delete')
+        with self._db._lock:
+            self._db._set(_split(self.path), None)
+        self._db._notify([(_split(self.path), None, False)])
+
+    def set_if_unchanged(self, expected_etag, value):
+        with self._db._lock:
+            current = copy.deepcopy(self._db._get(_split(self.path)))
+            if self._etag(current) != expected_etag:
+                self._db._count('transaction_read', _nbytes(current))
+                return False, current, self._etag(current)
+            self._db._count('transaction_write', _nbytes(value))
+            self._db._set(_split(self.path), value)
+        self._db._notify([(_split(self.path), _normalize(copy.deepcopy(value)), False)])
+        return True, value, self._etag(_normalize(copy.deepcopy(value)))
+
+    def transaction(self, transaction_update):
+        data, etag = self.get(etag=True)
+        for _ in range(25):
+            new_data = transaction_update(data)
+            success, data, etag = self.set_if_unchanged(etag, new_data)
+            if success:
+                return new_data
+        raise RuntimeError('Transaction aborted after failed retries.')
+
+    def listen(self, callback):
+        self._db._count('listen')
+        registration = ListenerRegistration(self._db, self.path, callback)
+        with self._db._lock:
+            self._db._listeners.append(registration)
+        initial = self._db.snapshot(self.path)
+        with self._db._lock:
+            self._db.calls['event'] += 1
+            self._db.bytes['event'] += _nbytes(initial)
+        callback(Event('put', '/', initial))
+        return registration
+
+    def order_by_key(self):
+        return FakeQuery(self, order_by='$key')
+
+    def order_by_child(self, path):
+        return FakeQuery(self, order_by=path)
+
+    def order_by_value(self):
+        return FakeQuery(self, order_by='$value')
+
+
+class FakeQuery:
+    def __init__(self, reference, order_by):
+        self._ref = reference
+        self._order_by = order_by
+        self._start = self._end = self._equal = None
+        self._first = self._last = None
+
+    def limit_to_first(self, limit):
+        self._first = limit
+        return self
+
+    def limit_to_last(self, limit):
+        self._last = limit
+        return self
+
+    def start_at(self, start):
+        self._start = start
+        return self
+
+    def end_at(self, end):
+        self._end = end
+        return self
+
+    def equal_to(self, value):
+        self._equal = value
+        return self
+
+    def _index(self, key, value):
+        if self._order_by == '$key':
+            return key
+        if self._order_by == '$value':
+            return value
+        node = value
+        for k in _split(self._order_by):
+            node = node.get(k) if isinstance(node, dict) else None
+        return node
+
+    def get(self):
+        db = self._ref._db
+        with db._lock:
+            node = copy.deepcopy(db._get(_split(self._ref.path)))
+        if isinstance(node, list):
+            node = {str(i): v for i, v in enumerate(node)}
+        items = list((node or {}).items())
+
+        def sort_key(item):
+            idx = self._index(*item)
+            # ลำดับแบบ RTDB: null < bool < number < string < object
+            rank = (0 if idx is None else 1 if isinstance(idx, bool) else
+                    2 if isinstance(idx, (int, float)) else 3 if isinstance(idx, str) else 4)
+            return (rank, idx if rank in (1, 2, 3) else 0, item[0])
+
+        items.sort(key=sort_key)
+        if self._equal is not None:
+            items = [it for it in items if self._index(*it) == self._equal]
+        if self._start is not None:
+            items = [it for it in items if self._index(*it) is not None and self._index(*it) >= self._start]
+        if self._end is not None:
+            items = [it for it in items if self._index(*it) is not None and self._index(*it) <= self._end]
+        if self._first is not None:
+            items = items[:self._first]
+        if self._last is not None:
+            items = items[-self._last:] if self._last else []
+        result = dict(items)
+        db._count('query', _nbytes(result))
+        return result
+
+
+@contextmanager
+def installed(database):
+    """Route ``firebase_admin.db.reference`` to ``database`` for the duration."""
+    import firebase_admin
+    from firebase_admin import db
+
+    original = db.reference
+    had_app = '[DEFAULT]' in firebase_admin._apps
+    db.reference = database.reference
+    if not had_app:
+        # app.py ข้ามการ initialize_app เมื่อมี app อยู่แล้ว จึงไม่ต้องใช้ st.secrets
+        firebase_admin._apps['[DEFAULT]'] = object()
+    try:
+        yield database
+    finally:
+        db.reference = original
+        if not had_app:
+            firebase_admin._apps.pop('[DEFAULT]', None)
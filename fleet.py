@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from state_cache import TelemetryCache, _split_path
+
+# เปิด fleet mode ด้วย VALVE_FLEET_ROOT=valves (โครงสร้าง valves/<valve_id>/live_pressure ...)
+FLEET_ROOT = os.environ.get('VALVE_FLEET_ROOT', '')
+FLEET_FIELDS = ('live_pressure', 'valve_rotation', 'motor_load', 'auto_mode')
+
+
+class FleetState:
+    """Per-valve telemetry for every valve under one RTDB root, from a single listener.
+
+    One TelemetryCache streams the whole root; each event only touches the rows
+    of the valves in its path, so steady-state work grows with the number of
+    valves that changed, not with valves x sessions. Rows live in a numpy table
+    (one slot per valve) and ``frame()`` wraps it without copying per session.
+
+    A valve is online while its own telemetry is younger than ``stale_after``.
+    A root 'put' (first load, reconnect replay) is not fresh telemetry: it only
+    moves the timestamp of valves that are new or whose values changed.
+    """
+
+    def __init__(self, root_ref, fields=FLEET_FIELDS, stale_after=15.0, capacity=64):
+        self.fields = tuple(fields)
+        self.stale_after = stale_after
+        self._cache = TelemetryCache(root_ref, stale_after=stale_after, defaults={})
+        self._cache.subscribe(self._on_change, with_event=True)
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._ids = []
+        self._values = np.full((capacity, len(self.fields)), np.nan)
+        self._updated = np.full(capacity, np.nan)
+        self._frame = None
+        self.rows_applied = 0   # จำนวนแถวที่อัปเดตทั้งหมด (ใช้ใน benchmark)
+        self.version = 0
+
+    def start(self):
+        self._cache.start()
+        return self
+
+    def stop(self):
+        self._cache.stop()
+
+    # --- write side (listener thread) ---
+    def _slot(self, valve_id):
+        slot = self._slots.get(valve_id)
+        if slot is None:
+            slot = len(self._ids)
+            if slot == len(self._updated):
+                self._values = np.vstack([self._values, np.full_like(self._values, np.nan)])
+                self._updated = np.concatenate([self._updated, np.full_like(self._updated, np.nan)])
+            self._slots[valve_id] = slot
+            self._ids.append(valve_id)
+        return slot
+
+    def _telemetry_paths(self, paths):
+        """Valve ids whose sensor fields a set of (valve-relative) paths touches."""
+        valve_ids = []
+        for keys in paths:
+            if not keys or (len(keys) > 1 and keys[1] not in self.fields):
+                continue   # schedule / command ของ valve นั้นเปลี่ยน ไม่ใช่ค่าเซนเซอร์
+            if keys[0] not in valve_ids:
+                valve_ids.append(keys[0])
+        return valve_ids
+
+    def _on_change(self, path, state, event=None):
+        keys = _split_path(path)
+        replay = False
+        if keys:
+            valve_ids = self._telemetry_paths([keys])
+        elif event is not None and event.event_type == 'patch':
+            # multi-path update ที่ root เช่น {'v01/live_pressure': ...}: เฉพาะ valve ที่อยู่ใน key
+            valve_ids = self._telemetry_paths(_split_path(k) for k in (event.data or {}))
+        else:
+            # put ที่ root = โหลดครั้งแรกหรือ replay หลัง reconnect ไม่ใช่ค่าใหม่จาก valve
+            valve_ids, replay = list(state), True
+        if not valve_ids:
+            return
+        now = time.time()
+        with self._lock:
+            for valve_id in valve_ids:
+                node = state.get(valve_id)
+                if not isinstance(node, dict):
+                    continue
+                known = valve_id in self._slots
+                slot = self._slot(valve_id)
+                row = np.array([float(v) if isinstance(v, (int, float)) else np.nan
+                                for v in (node.get(field) for field in self.fields)])
+                if replay and known and np.array_equal(row, self._values[slot], equal_nan=True):
+                    continue
+                self._values[slot] = row
+                self._updated[slot] = now
+                self.rows_applied += 1
+            self._frame = None
+            self.version += 1
+
+    # --- read side ---
+    def frame(self):
+        """DataFrame indexed by valve id with the fleet fields plus ``updated_at``.
+
+        Built at most once per version per process; sessions share the result.
+        """
+        with self._lock:
+            if self._frame is None:
+                n = len(self._ids)
+                frame = pd.DataFrame(self._values[:n].copy(), index=pd.Index(self._ids, name='valve'),
+                                     columns=list(self.fields))
+                frame['updated_at'] = self._updated[:n].copy()
+                self._frame = frame
+            return self._frame
+
+    def overview(self, now=None):
+        """``frame()`` plus ``age_s`` and ``online`` computed for the current time."""
+        self._cache.ensure_fresh()
+        frame = self.frame()
+        age = (now or time.time()) - frame['updated_at'].to_numpy()
+        return frame.assign(age_s=age, online=(age < self.stale_after) & self._cache.is_online())
+
+
+# --- Benchmark: 100 valves, ต่อ tick มี k valve ที่ค่าเปลี่ยน ---
+if __name__ == '__main__':
+    import json
+    import random
+
+    from fake_rtdb import FakeDatabase
+
+    n_valves, sessions, ticks = 100, 50, 20
+    rng = random.Random(0)
+
+    def valve_node():
+        return {'live_pressure': round(rng.uniform(3, 5), 3), 'valve_rotation': 10.0, 'motor_load': 1.2,
+                'auto_mode': True, 'command': 'OPEN', 'last_command_time': '2024-01-01 00:00:00',
+                'schedule': [{'START_TIME': f'{h:02d}:00', 'TARGET': 3.5} for h in range(6)]}
+
+    tree = {f'v{i:03d}': valve_node() for i in range(n_valves)}
+    node_bytes = sum(len(json.dumps(node)) for node in tree.values())
+    print(f'{n_valves} valves, {sessions} sessions, refresh every 5 s')
+    print(f"before (one deployment per valve, each session polls its node): "
+          f"{n_valves * sessions} reads, {node_bytes * sessions / 1024:.0f} KB per refresh")
+
+    print(f"{'changed/tick':>12} {'events':>7} {'KB in':>7} {'rows applied':>12} {'apply ms':>9} {'session ms':>10}")
+    for changed in (1, 10, 100):
+        database = FakeDatabase({'valves': tree})
+        fleet = FleetState(database.reference('valves')).start()
+        root = database.reference('valves')
+        database.reset_counters()
+        rows_before = fleet.rows_applied
+        apply_s = session_s = 0.0
+        for _ in range(ticks):
+            t0 = time.perf_counter()
+            for i in rng.sample(range(n_valves), changed):
+                root.child(f'v{i:03d}').update({'live_pressure': round(rng.uniform(3, 5), 3),
+                                                'valve_rotation': round(rng.uniform(0, 20), 2)})
+            apply_s += time.perf_counter() - t0
+            t0 = time.perf_counter()
+            for _ in range(sessions):
+                fleet.overview()
+            session_s += time.perf_counter() - t0
+        stats = database.stats()
+        print(f"{changed:>12} {stats['events'] / ticks:>7.0f} {stats['bytes_read'] / 1024 / ticks:>7.2f} "
+              f"{(fleet.rows_applied - rows_before) / ticks:>12.0f} {apply_s * 1000 / ticks:>9.2f} "
+              f"{session_s * 1000 / ticks / sessions:>10.3f}")
+        fleet.stop()
@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+# คอลัมน์ที่เก็บในไฟล์ (columnar: แต่ละคอลัมน์เป็นช่วงหน่วยความจำต่อเนื่อง)
+COLUMNS = ('ts', 'live_pressure', 'valve_rotation', 'motor_load')
+SAMPLE_FIELDS = COLUMNS[1:]
+
+_MAGIC = 0x56414C5648495354  # "VALVHIST"
+_HEADER_SLOTS = 8            # magic, capacity, count, n_columns, resolution_us, ...
+_HEADER_BYTES = _HEADER_SLOTS * 8
+
+DEFAULT_CAPACITY = 30 * 24 * 3600   # 30 วันที่ความละเอียด 1 วินาที
+DEFAULT_PATH = os.environ.get(
+    'VALVE_HISTORY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'valve_history.bin'))
+# ไฟล์ full-resolution ที่ ingest.py เขียน (ทุก sample ไม่ใช่ 1 วินาที)
+INGEST_PATH = os.environ.get(
+    'VALVE_INGEST_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'ingest_raw.bin'))
+
+
+class HistoryStore:
+    """Append-only ring buffer of telemetry samples backed by a memory-mapped file.
+
+    Each column is stored twice back to back (the "mirrored" ring layout): sample
+    ``i`` lives at ``i % capacity`` and ``i % capacity + capacity``. That makes the
+    newest ``k`` samples a single contiguous slice, so window queries return
+    zero-copy NumPy views no matter where the ring has wrapped.
+
+    Samples closer than ``resolution`` seconds to the previous one overwrite it
+    instead of appending, which keeps the time span per capacity fixed.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, resolution=1.0):
+        self.path = path
+        self.capacity = int(capacity)
+        self.resolution = float(resolution)
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        ncol = len(COLUMNS)
+        size = _HEADER_BYTES + ncol * 2 * self.capacity * 8
+        fresh = not os.path.exists(self.path) or os.path.getsize(self.path) != size
+        if not fresh:
+            header = np.memmap(self.path, dtype=np.int64, mode='r+', shape=(_HEADER_SLOTS,))
+            fresh = header[0] != _MAGIC or header[1] != self.capacity or header[3] != ncol
+            del header
+        if fresh:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'wb') as f:
+                f.truncate(size)   # sparse file; หน้าใหม่ถูกจองเมื่อเขียนจริง
+        self._header = np.memmap(self.path, dtype=np.int64, mode='r+', shape=(_HEADER_SLOTS,))
+        self._data = np.memmap(self.path, dtype=np.float64, mode='r+', offset=_HEADER_BYTES,
+                               shape=(ncol, 2 * self.capacity))
+        if fresh:
+            self._header[:] = 0
+            self._header[0] = _MAGIC
+            self._header[1] = self.capacity
+            self._header[3] = ncol
+            self._header[4] = int(self.resolution * 1e6)
+            self._header.flush()
+
+    # --- write side ---
+    @property
+    def count(self):
+        """Total samples ever appended (monotonic; the ring keeps the last capacity)."""
+        return int(self._header[2])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def last_ts(self):
+        n = self.count
+        return None if n == 0 else float(self._data[0, (n - 1) % self.capacity])
+
+    def append(self, ts, live_pressure, valve_rotation, motor_load):
+        row = (ts, live_pressure, valve_rotation, motor_load)
+        with self._lock:
+            n = self.count
+            if n and ts - self._data[0, (n - 1) % self.capacity] < self.resolution:
+                if ts < self._data[0, (n - 1) % self.capacity]:
+                    return False   # เวลาย้อนหลัง: ทิ้ง เพื่อให้ ts เรียงจากน้อยไปมากเสมอ
+                i = (n - 1) % self.capacity
+                self._data[1:, i] = row[1:]
+                self._data[1:, i + self.capacity] = row[1:]
+                return True
+            i = n % self.capacity
+            self._data[:, i] = row
+            self._data[:, i + self.capacity] = row
+            # เขียนข้อมูลก่อนแล้วค่อยเพิ่ม count เพื่อให้ผู้อ่าน (รวมถึง process อื่น) เห็นแถวที่สมบูรณ์
+            self._header[2] = n + 1
+        return True
+
+    def append_many(self, ts, live_pressure, valve_rotation, motor_load):
+        """Bulk append of pre-sorted samples already at >= resolution spacing."""
+        block = np.vstack([np.asarray(c, dtype=np.float64)
+                           for c in (ts, live_pressure, valve_rotation, motor_load)])
+        with self._lock:
+            if block.shape[1] > self.capacity:
+                block = block[:, -self.capacity:]
+            n = self.count
+            start = n % self.capacity
+            m = block.shape[1]
+            first = min(m, self.capacity - start)
+            for offset in (0, self.capacity):
+                self._data[:, start + offset:start + offset + first] = block[:, :first]
+                self._data[:, offset:offset + m - first] = block[:, first:]
+            self._header[2] = n + m
+
+    def flush(self):
+        self._data.flush()
+        self._header.flush()
+
+    # --- read side ---
+    def tail(self, k=None):
+        """Newest ``k`` samples as zero-copy views, oldest first."""
+        n = self.count
+        size = min(n, self.capacity - 1)   # เว้น 1 แถวกันชนกับแถวที่ writer กำลังเขียนทับ
+        k = size if k is None else min(int(k), size)
+        if k <= 0:
+            return {c: self._data[j, :0] for j, c in enumerate(COLUMNS)}
+        end = (n - 1) % self.capacity + self.capacity + 1
+        return {c: self._data[j, end - k:end] for j, c in enumerate(COLUMNS)}
+
+    def window(self, start_ts, end_ts=None):
+        """Samples with start_ts <= ts <= end_ts as zero-copy column views."""
+        view = self.tail()
+        ts = view['ts']
+        lo = int(np.searchsorted(ts, start_ts, side='left'))
+        hi = len(ts) if end_ts is None else int(np.searchsorted(ts, end_ts, side='right'))
+        return {c: v[lo:hi] for c, v in view.items()}
+
+
+def open_existing(path):
+    """Open a store another process created, with its own capacity; None if it is not there yet."""
+    try:
+        header = np.array(np.memmap(path, dtype=np.int64, mode='r', shape=(_HEADER_SLOTS,)))
+    except (OSError, ValueError):
+        return None   # ยังไม่มีไฟล์ หรือไฟล์สั้นกว่า header
+    capacity = int(header[1])
+    # magic ยังไม่ถูกเขียน (writer กำลังสร้างไฟล์) หรือ layout ไม่ตรง: อย่าเปิด ไม่งั้น _open จะล้างไฟล์ทิ้ง
+    if header[0] != _MAGIC or header[3] != len(COLUMNS) or capacity <= 0:
+        return None
+    if os.path.getsize(path) != _HEADER_BYTES + len(COLUMNS) * 2 * capacity * 8:
+        return None
+    return HistoryStore(path, capacity=capacity, resolution=header[4] / 1e6)
+
+
+def telemetry_sink(store, fields=SAMPLE_FIELDS, also=()):
+    """TelemetryCache listener that appends one sample per sensor update.
+
+    ``also`` are extra ``callback(ts, values)`` consumers fed the same sample.
+    """
+    def on_update(path, state):
+        if path.strip('/').split('/')[0] not in fields:
+            return
+        try:
+            ts = time.time()
+            values = tuple(float(state.get(f) or 0.0) for f in fields)
+        except (TypeError, ValueError):
+            return
+        store.append(ts, *values)
+        for consumer in also:
+            consumer(ts, values)
+    return on_update
+
+
+# --- Benchmark: append และ query หน้าต่างของกราฟ ---
+if __name__ == '__main__':
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = HistoryStore(os.path.join(tmp, 'bench.bin'))
+        rng = np.random.default_rng(0)
+        t0 = 1_700_000_000.0
+
+        n = 200_000
+        p = rng.uniform(3.5, 4.5, n)
+        start = time.perf_counter()
+        for i in range(n):
+            store.append(t0 + i, p[i], 10.0, 1.5)
+        per_append = (time.perf_counter() - start) / n
+        print(f"append           : {per_append * 1e6:8.2f} us/sample ({1 / per_append:,.0f} samples/s)")
+
+        # เติมให้เต็ม 30 วันแล้ววนรอบเพื่อวัด query บน ring ที่ wrap แล้ว
+        m = store.capacity
+        ts = t0 + n + np.arange(m, dtype=np.float64)
+        start = time.perf_counter()
+        store.append_many(ts, rng.uniform(3.5, 4.5, m), np.full(m, 10.0), np.full(m, 1.5))
+        print(f"append_many      : {(time.perf_counter() - start) / m * 1e9:8.2f} ns/sample ({m:,} rows)")
+
+        end_ts = store.last_ts()
+        for label, span in (('1 h', 3600), ('3 days', 3 * 86400), ('30 days', 30 * 86400)):
+            reps = 2000
+            start = time.perf_counter()
+            for _ in range(reps):
+                w = store.window(end_ts - span, end_ts)
+            cost = (time.perf_counter() - start) / reps
+            zero_copy = np.shares_memory(w['live_pressure'], store._data)
+            print(f"window {label:<9} : {cost * 1e6:8.2f} us  rows={len(w['ts']):>9,}  zero-copy={zero_copy}")
+        print(f"file size        : {os.path.getsize(store.path) / 2**20:,.1f} MiB (capacity {store.capacity:,})")
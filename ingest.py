@@ -0,0 +1,460 @@
+"""Telemetry ingestion gateway: high-rate samples in, one coalesced RTDB write per tick out.
+
+The field controller (or anything else) sends samples to this process instead of
+writing ``valve_system`` directly:
+
+    HTTP  POST /samples   body: one JSON object, a JSON list, or NDJSON lines
+    UDP   one datagram = one JSON object / list / NDJSON lines
+
+    {"ts": 1700000000.25, "live_pressure": 3.92, "valve_rotation": 12.0, "motor_load": 1.4}
+
+``ts`` (epoch seconds) is optional; samples without it are stamped on arrival.
+Fields that are missing carry forward from the previous sample. Every accepted
+sample is appended at full resolution to a local HistoryStore (``--raw``; the
+dashboard on the same machine reads it for its last-minutes trend and the raw
+export), and only the latest value is published to the RTDB, at most ``rate`` times a second
+and only when it changed, so connected dashboards see one fan-out per tick
+instead of one per sample.
+
+Backpressure: samples wait in a bounded in-memory buffer. When it is full, HTTP
+answers ``503`` with ``Retry-After`` (the client resends) and UDP datagrams are
+dropped and counted. ``GET /stats`` returns counters as JSON and ``GET /metrics``
+returns the process metrics in Prometheus format.
+
+    python ingest.py                 # serve, publishing to the real database
+    python ingest.py --fake          # serve against an in-memory database
+    python ingest.py --client        # stand-in controller sending to a running gateway
+    python ingest.py --bench         # samples/s ingested vs RTDB writes issued
+"""
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+
+from history_store import INGEST_PATH, SAMPLE_FIELDS, HistoryStore
+from metrics import REGISTRY, instrument
+
+DEFAULT_RAW_PATH = INGEST_PATH
+DEFAULT_RAW_CAPACITY = 4_000_000   # ~22 ชั่วโมงที่ 50 Hz (ไฟล์ sparse ~256 MB)
+
+# ช่วงค่าที่เป็นไปได้ทางกายภาพ; นอกช่วงนี้ถือว่าเซนเซอร์/ข้อความเสีย
+LIMITS = {'live_pressure': (-1.0, 25.0), 'valve_rotation': (-1.0, 100.0), 'motor_load': (-1.0, 100.0)}
+MAX_BODY = 1 << 20
+
+
+def parse_sample(obj, now, max_age=3600.0, max_ahead=5.0):
+    """``(ts, {field: value})`` from one decoded sample; ValueError if it is unusable."""
+    if not isinstance(obj, dict):
+        raise ValueError('sample must be an object')
+    values = {}
+    for field in SAMPLE_FIELDS:
+        if obj.get(field) is None:
+            continue
+        value = obj[field]
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f'{field} is not a number')
+        lo, hi = LIMITS[field]
+        if not (math.isfinite(value) and lo <= value <= hi):
+            raise ValueError(f'{field} out of range: {value!r}')
+        values[field] = float(value)
+    if not values:
+        raise ValueError('no sensor fields')
+    ts = obj.get('ts')
+    if ts is None:
+        return now, values
+    if isinstance(ts, bool) or not isinstance(ts, (int, float)) or not math.isfinite(ts):
+        raise ValueError('ts is not a number')
+    if ts > 1e11:
+        ts = ts / 1000.0   # controller ส่งมาเป็น ms
+    if not now - max_age <= ts <= now + max_ahead:
+        raise ValueError(f'ts outside accepted window: {ts!r}')
+    return float(ts), values
+
+
+def decode_payload(data):
+    """Sample objects from a JSON object, JSON list or NDJSON payload."""
+    text = data.decode('utf-8') if isinstance(data, (bytes, bytearray)) else data
+    try:
+        decoded = json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return decoded if isinstance(decoded, list) else [decoded]
+
+
+class IngestGateway:
+    """Accepts samples, keeps full resolution locally, publishes the latest value per tick.
+
+    ``root_ref`` is the ``valve_system`` reference; ``store`` a HistoryStore
+    opened with ``resolution=0`` so every sample is kept.
+    """
+
+    def __init__(self, root_ref, store, rate=1.0, max_pending=50_000, batch_size=5000, also=()):
+        self.root_ref = root_ref
+        self.store = store
+        self.interval = 1.0 / rate
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.also = also              # callback(ts, values) เพิ่มเติม เช่น RollupEngine.add
+        self._pending = deque()       # (ts, values) ที่รอเขียนลง store
+        self._wakeup = None
+        self._latest = {}             # ค่าล่าสุดของแต่ละ field (carry-forward)
+        self._latest_ts = None
+        self._published = None
+        self._tasks = []
+        self._servers = []
+        self.counters = {'accepted': 0, 'rejected': 0, 'late': 0, 'dropped': 0, 'throttled': 0,
+                         'clamped': 0, 'stored': 0, 'published': 0, 'publish_failures': 0}
+        self.last_error = None
+        self.started_at = time.time()
+
+    # --- intake (runs on the event loop) ---
+    def offer(self, objects, now=None):
+        """Validate and buffer decoded samples: ``(accepted, rejected)``, or None if full."""
+        if len(self._pending) + len(objects) > self.max_pending:
+            return None
+        now = time.time() if now is None else now
+        accepted = rejected = 0
+        for obj in objects:
+            try:
+                self._pending.append(parse_sample(obj, now))
+                accepted += 1
+            except ValueError:
+                rejected += 1
+        self._count('accepted', accepted)
+        self._count('rejected', rejected)
+        if accepted:
+            self._wakeup.set()
+        return accepted, rejected
+
+    def _count(self, name, n=1):
+        if n:
+            self.counters[name] += n
+            REGISTRY.inc('ingest_samples_total', (('result', name),), n)
+
+    # --- workers ---
+    def _drain(self):
+        """Write one batch of buffered samples to the store; runs on the event loop."""
+        n = min(len(self._pending), self.batch_size)
+        batch = sorted((self._pending.popleft() for _ in range(n)), key=lambda s: s[0])
+        last = self.store.last_ts()
+        now = time.time()
+        rows = []
+        for ts, values in batch:
+            if ts > now:
+                # นาฬิกา controller เร็วกว่าเรา (parse_sample ยอมได้ถึง max_ahead): ใช้เวลาเครื่องนี้แทน
+                # ไม่งั้น watermark กระโดดไปอนาคตและ sample ตรงเวลาที่ตามมาจะถูกนับเป็น late ทั้งหมด
+                self._count('clamped')
+                ts = now
+            if last is not None and ts < last:
+                self._count('late')   # เก่ากว่าแถวล่าสุดใน store (ring ต้องเรียงตามเวลา)
+                continue
+            self._latest.update(values)
+            if len(self._latest) < len(SAMPLE_FIELDS):
+                continue              # ยังไม่เคยได้ครบทุก field
+            rows.append((ts,) + tuple(self._latest[f] for f in SAMPLE_FIELDS))
+            last = self._latest_ts = ts
+        if rows:
+            self.store.append_many(*zip(*rows))
+            self._count('stored', len(rows))
+            for consumer in self.also:
+                for ts, *values in rows:
+                    consumer(ts, tuple(values))
+
+    async def _writer(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                self._drain()
+                await asyncio.sleep(0)   # ให้ HTTP/UDP ได้รับข้อมูลระหว่าง batch
+
+    async def _publisher(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.interval
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            await self._publish()
+            # update ช้ากว่า 1 tick: ข้าม tick ที่เลยไปแล้ว ค่าล่าสุดจะไปกับรอบถัดไป (ไม่ส่งถี่ขึ้นเพื่อตามให้ทัน)
+            next_tick = max(next_tick, loop.time() - self.interval)
+
+    async def _publish(self):
+        if len(self._latest) < len(SAMPLE_FIELDS):
+            return
+        update = {f: self._latest[f] for f in SAMPLE_FIELDS}
+        if update == self._published:
+            return
+        try:
+            # update() เป็น blocking I/O: ทำใน thread เพื่อไม่ให้ event loop หยุดรับข้อมูล
+            await asyncio.to_thread(self.root_ref.update, update)
+            self._published = update
+            self._count('published')
+        except Exception as e:
+            self._count('publish_failures')
+            self.last_error = f'{type(e).__name__}: {e}'
+
+    # --- servers ---
+    async def _handle_http(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                method, path, _ = request.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, {'error': 'body too large'}, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                status, payload, extra = self._route(method, path.split('?')[0], body)
+                await self._respond(writer, status, payload, extra)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _route(self, method, path, body):
+        if method == 'POST' and path == '/samples':
+            try:
+                objects = decode_payload(body)
+            except ValueError:
+                return 400, {'error': 'invalid JSON'}, {}
+            result = self.offer(objects)
+            if result is None:
+                self._count('throttled', len(objects))
+                return 503, {'error': 'ingest buffer full'}, {'Retry-After': '1'}
+            return 202, {'accepted': result[0], 'rejected': result[1]}, {}
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats(), {}
+        if method == 'GET' and path == '/metrics':
+            return 200, REGISTRY.render(), {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        return 404, {'error': 'not found'}, {}
+
+    @staticmethod
+    async def _respond(writer, status, payload, extra=None, close=False):
+        reason = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found',
+                  413: 'Payload Too Large', 503: 'Service Unavailable'}[status]
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        headers = {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+        headers.update(extra or {})
+        if close:
+            headers['Connection'] = 'close'
+        head = f'HTTP/1.1 {status} {reason}\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n'
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+    def datagram_received(self, data, addr):
+        try:
+            objects = decode_payload(data)
+        except ValueError:
+            self._count('rejected')
+            return
+        if self.offer(objects) is None:
+            self._count('dropped', len(objects))   # UDP ไม่มีทางบอกให้ส่งช้าลง: ทิ้งและนับ
+
+    def connection_made(self, transport):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+    async def start(self, host='127.0.0.1', http_port=8787, udp_port=8788):
+        """Start the workers and listeners; a port of None disables that listener."""
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._writer()), asyncio.create_task(self._publisher())]
+        if http_port is not None:
+            server = await asyncio.start_server(self._handle_http, host, http_port)
+            self._servers.append(server)
+            http_port = server.sockets[0].getsockname()[1]
+        if udp_port is not None:
+            transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(host, udp_port))
+            self._servers.append(transport)
+            udp_port = transport.get_extra_info('sockname')[1]
+        return http_port, udp_port
+
+    async def stop(self):
+        for server in self._servers:
+            server.close()
+        while self._pending:
+            self._drain()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._publish()   # ค่าสุดท้ายก่อนปิด
+        self.store.flush()
+
+    def stats(self):
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        return dict(self.counters, pending=len(self._pending), latest_ts=self._latest_ts,
+                    samples_per_s=round(self.counters['accepted'] / elapsed, 1),
+                    writes_per_s=round(self.counters['published'] / elapsed, 3), last_error=self.last_error)
+
+
+# --- Stand-in controller ---
+def synthetic_samples(n, start_ts, hz, stamp=True):
+    for i in range(n):
+        t = start_ts + i / hz
+        sample = {'live_pressure': round(3.8 + 0.2 * math.sin(i / 500.0), 4),
+                  'valve_rotation': 12.0, 'motor_load': round(1.4 + 0.05 * math.sin(i / 7.0), 4)}
+        if stamp:
+            sample['ts'] = round(t, 4)
+        yield sample
+
+
+async def run_client(host='127.0.0.1', port=8787, hz=1000.0, seconds=10.0, batch=100, udp=False, stamp=True):
+    """Send ``hz`` samples/s for ``seconds`` in ``batch``-sized posts; returns sent/throttled counts.
+
+    ``stamp=False`` leaves ``ts`` out so the gateway stamps samples on arrival.
+    """
+    loop = asyncio.get_running_loop()
+    total = int(hz * seconds)
+    samples = synthetic_samples(total, time.time(), hz, stamp)
+    sent = throttled = 0
+    started = loop.time()
+    if udp:
+        transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while sent < total:
+            chunk = [next(samples) for _ in range(min(batch, total - sent))]
+            body = json.dumps(chunk).encode()
+            if udp:
+                transport.sendto(body)
+            else:
+                while True:
+                    writer.write(f'POST /samples HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+                    status = int((await reader.readline()).split()[1])
+                    length = 0
+                    while (line := await reader.readline()) not in (b'\r\n', b''):
+                        if line.lower().startswith(b'content-length:'):
+                            length = int(line.split(b':')[1])
+                    await reader.readexactly(length)
+                    if status != 503:
+                        break
+                    throttled += len(chunk)
+                    await asyncio.sleep(0.05)   # Retry-After แบบย่อสำหรับ benchmark
+            sent += len(chunk)
+            delay = started + sent / hz - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+    finally:
+        (transport if udp else writer).close()
+    return {'sent': sent, 'throttled': throttled, 'seconds': loop.time() - started}
+
+
+async def _bench(seconds, rate):
+    import tempfile
+    from fake_rtdb import FakeDatabase
+
+    print(f"{'mode':<30} {'samples/s in':>13} {'stored':>10} {'RTDB writes':>12} {'writes/s':>9} "
+          f"{'throttled':>10} {'dropped':>8} {'late':>6}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, hz, batch, udp, clients, max_pending in (
+                ('HTTP 1,000 Hz, batch 50', 1_000, 50, False, 1, 50_000),
+                ('UDP 5,000 Hz, batch 20', 5_000, 20, True, 1, 50_000),
+                ('HTTP max rate, batch 500', None, 500, False, 1, 50_000),
+                ('HTTP max rate, 8 clients', None, 500, False, 8, 50_000),
+                ('8 clients, 2,000-row buffer', None, 500, False, 8, 2_000)):
+            database = FakeDatabase({'valve_system': {'live_pressure': 0.0, 'valve_rotation': 0.0,
+                                                      'motor_load': 0.0}})
+            store = HistoryStore(os.path.join(tmp, f'{len(os.listdir(tmp))}.bin'), capacity=2_000_000,
+                                 resolution=0.0)
+            gateway = IngestGateway(database.reference('valve_system'), store, rate=rate, max_pending=max_pending)
+            http_port, udp_port = await gateway.start(http_port=0, udp_port=0)
+            if hz is None:   # max rate: ส่งให้เร็วที่สุดภายในเวลาที่กำหนด
+                # หลาย client ส่งพร้อมกัน: ให้ gateway ประทับเวลาเอง ไม่งั้นเวลาของแต่ละ client จะสลับกัน
+                senders = [asyncio.create_task(run_client(port=http_port, hz=1e7, seconds=60, batch=batch,
+                                                          stamp=clients == 1))
+                           for _ in range(clients)]
+                await asyncio.sleep(seconds)
+                for sender in senders:
+                    sender.cancel()
+                await asyncio.gather(*senders, return_exceptions=True)
+            else:
+                await run_client(port=udp_port if udp else http_port, hz=hz, seconds=seconds, batch=batch, udp=udp)
+            elapsed = time.time() - gateway.started_at
+            await gateway.stop()
+            c = gateway.counters
+            writes = database.stats()['calls'].get('update', 0)
+            print(f"{label:<30} {c['accepted'] / elapsed:>13,.0f} {c['stored']:>10,} {writes:>12} "
+                  f"{writes / elapsed:>9.2f} {c['throttled']:>10,} {c['dropped']:>8,} {c['late']:>6,}")
+            assert database.snapshot('valve_system/live_pressure') == store.tail(1)['live_pressure'][0]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--http', type=int, default=8787, help='HTTP port (0 = any free port)')
+    parser.add_argument('--udp', type=int, default=8788, help='UDP port (0 = any free port)')
+    parser.add_argument('--rate', type=float, default=1.0, help='RTDB publishes per second')
+    parser.add_argument('--max-pending', type=int, default=50_000, help='buffered samples before 503 / drop')
+    parser.add_argument('--raw', default=DEFAULT_RAW_PATH, help='full-resolution history file')
+    parser.add_argument('--capacity', type=int, default=DEFAULT_RAW_CAPACITY, help='raw history rows')
+    parser.add_argument('--fake', action='store_true', help='publish to an in-memory database')
+    parser.add_argument('--client', action='store_true', help='run the stand-in controller instead')
+    parser.add_argument('--via', choices=('http', 'udp'), default='http', help='client: transport')
+    parser.add_argument('--hz', type=float, default=100.0, help='client: samples per second')
+    parser.add_argument('--seconds', type=float, help='client (default 10) / bench (default 3) duration')
+    parser.add_argument('--batch', type=int, default=10, help='client: samples per request / datagram')
+    parser.add_argument('--bench', action='store_true', help='measure samples/s in vs RTDB writes out')
+    args = parser.parse_args()
+
+    if args.bench:
+        asyncio.run(_bench(args.seconds or 3.0, args.rate))
+        raise SystemExit
+    if args.client:
+        use_udp = args.via == 'udp'
+        print(asyncio.run(run_client(args.host, args.udp if use_udp else args.http, args.hz, args.seconds or 10.0,
+                                     args.batch, udp=use_udp)))
+        raise SystemExit
+
+    if args.fake:
+        from fake_rtdb import FakeDatabase
+        root = FakeDatabase({'valve_system': {}}).reference('valve_system')
+    else:
+        import streamlit as st
+        import firebase_admin
+        from firebase_admin import credentials, db
+
+        fb_dict = dict(st.secrets["firebase"])
+        fb_dict["private_key"] = fb_dict["private_key"].replace("\\n", "\n")
+        firebase_admin.initialize_app(credentials.Certificate(fb_dict), {
+            'databaseURL': 'https://dbsensor-eb39d-default-rtdb.firebaseio.com'})
+        root = db.reference('valve_system')
+
+    async def main():
+        gateway = IngestGateway(instrument(root, 'ingest'), HistoryStore(args.raw, capacity=args.capacity,
+                                                                         resolution=0.0),
+                                rate=args.rate, max_pending=args.max_pending)
+        ports = await gateway.start(args.host, args.http, args.udp)
+        print(f"ingest gateway: http={ports[0]} udp={ports[1]} publish {args.rate:g}/s")
+        try:
+            while True:
+                await asyncio.sleep(10)
+                print(json.dumps(gateway.stats()))
+        finally:
+            await gateway.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
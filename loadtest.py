@@ -0,0 +1,381 @@
+"""Offline load test: N simulated operators against a local fake RTDB.
+
+Each scale step builds a fresh FakeDatabase, logs N AppTest sessions into
+app.py and then plays ``--ticks`` refresh ticks. On every tick the simulated
+controller writes new telemetry, every session reruns the script and one
+admin flips the Auto Mode toggle (a DB write plus an audit log).
+
+AppTest can only run the whole script, so each rerun here includes every
+fragment. That is an upper bound on per-session work in the real server.
+
+    python loadtest.py --sessions 1,10,50,100,200 --ticks 3
+    python loadtest.py --json results.json      # เก็บผลไว้เทียบ regression
+    python loadtest.py --startup                # time-to-first-render ของ process ใหม่
+    python loadtest.py --workers 1,2,4          # session capacity vs worker processes (shared tier)
+"""
+import argparse
+import atexit
+import gc
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# ไฟล์ทุกตัวที่ app เขียนต้องไม่ใช่ data/ ของเครื่องจริง (spool/WAL ที่ค้างจะถูกส่งขึ้น Firebase จริง
+# และ shared state อาจชนะ election แข่งกับ dashboard ที่รันอยู่) ตั้ง env ก่อน import โมดูลที่อ่านค่าเหล่านี้
+SANDBOX_FILES = {'VALVE_HISTORY_PATH': 'history.bin', 'VALVE_LOG_SPOOL': 'activity_log.spool',
+                 'VALVE_WAL_PATH': 'control.wal', 'VALVE_SHARED_STATE': 'shared_state.bin',
+                 'VALVE_INGEST_PATH': 'ingest_raw.bin'}
+
+
+def sandbox_env(directory, prefix=''):
+    """Env that points every file the app writes (and its metrics port) away from production."""
+    env = {name: os.path.join(directory, prefix + filename) for name, filename in SANDBOX_FILES.items()}
+    env.update(VALVE_METRICS_PORT='0', VALVE_LOADTEST_DIR=directory)
+    return env
+
+
+if 'VALVE_LOADTEST_DIR' not in os.environ:
+    # process หลัก: temp dir ใหม่เสมอ ไม่สนค่าที่ตั้งไว้ใน shell; child ได้ env ของตัวเองจาก parent
+    os.environ.update(sandbox_env(tempfile.mkdtemp(prefix='valve-loadtest-')))
+    atexit.register(shutil.rmtree, os.environ['VALVE_LOADTEST_DIR'], True)
+SANDBOX_DIR = os.environ['VALVE_LOADTEST_DIR']
+
+from fake_rtdb import FakeDatabase, installed  # noqa: E402
+from activity_log import index_fields  # noqa: E402
+from pushid import push_key  # noqa: E402
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+
+def seed_data(n_users=50, n_logs=200):
+    users = {'admin': {'password': 'papak123', 'role': 'super_admin'}}
+    users.update({f'operator{i:03d}': {'password': 'x' * 10, 'role': 'user'} for i in range(n_users)})
+    entry = {'user': 'admin', 'role': 'super_admin', 'action': 'seed', 'timestamp': '2024-01-01 00:00:00'}
+    keys = (push_key(now_ms=1_704_067_200_000 + i * 1000) for i in range(n_logs))
+    logs = {key: dict(entry, **index_fields(key, entry)) for key in keys}
+    return {
+        'valve_system': {
+            'live_pressure': 3.9, 'valve_rotation': 12.0, 'motor_load': 1.4, 'auto_mode': True,
+            'schedule': [{'START_TIME': '06:00', 'TARGET': 3.5}, {'START_TIME': '18:00', 'TARGET': 4.0}],
+            'users': users,
+        },
+        'activity_logs': logs,
+    }
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] if ordered else 0.0
+
+
+def new_session(role='super_admin'):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.session_state.logged_in = True
+    at.session_state.username = 'admin' if role == 'super_admin' else 'operator000'
+    at.session_state.user_role = role
+    return at
+
+
+def run_scale(n_sessions, ticks, interval, rng):
+    import streamlit as st
+
+    database = FakeDatabase(seed_data())
+    with installed(database):
+        st.cache_resource.clear()
+        st.cache_data.clear()
+        # session แรกสร้าง resource ที่แชร์ทั้ง process (listener, rollups) ไม่นับเป็นหน่วยความจำต่อ session
+        new_session().run()
+        gc.collect()
+        tracemalloc.start()
+        mem_before = tracemalloc.get_traced_memory()[0]
+        sessions = [new_session('super_admin' if i == 0 else 'user') for i in range(n_sessions)]
+        for at in sessions:
+            at.run()
+        gc.collect()
+        mem_per_session = (tracemalloc.get_traced_memory()[0] - mem_before) / n_sessions
+        tracemalloc.stop()
+
+        database.reset_counters()
+        latencies = []
+        errors = 0
+        controller = database.reference('valve_system')
+        started = time.perf_counter()
+        for _ in range(ticks):
+            controller.update({'live_pressure': round(rng.uniform(3.5, 4.5), 3),
+                               'valve_rotation': round(rng.uniform(0, 20), 2),
+                               'motor_load': round(rng.uniform(0.5, 2.5), 2)})
+            for at in sessions:
+                t0 = time.perf_counter()
+                at.run()
+                latencies.append(time.perf_counter() - t0)
+                errors += len(at.exception)
+            admin = sessions[0]
+            if admin.toggle:
+                admin.toggle[0].set_value(not admin.toggle[0].value).run()
+        wall = time.perf_counter() - started
+        stats = database.stats()
+
+    simulated_minutes = ticks * interval / 60.0
+    return {
+        'sessions': n_sessions,
+        'reads_per_min': stats['reads'] / simulated_minutes,
+        'writes_per_min': stats['writes'] / simulated_minutes,
+        'events_per_min': stats['events'] / simulated_minutes,
+        'kb_read_per_min': stats['bytes_read'] / 1024 / simulated_minutes,
+        'rerun_p50_ms': percentile(latencies, 0.50) * 1000,
+        'rerun_p99_ms': percentile(latencies, 0.99) * 1000,
+        'mem_per_session_kb': mem_per_session / 1024,
+        'script_errors': errors,
+        'wall_s': wall,
+        'calls': stats['calls'],
+    }
+
+
+def worker_child(n_sessions, seconds):
+    """One worker process for --workers: sessions rerun back to back between 'go' and the deadline.
+
+    Only the process that won the shared-tier election has telemetry listeners;
+    it also plays the controller (one telemetry write per second). Prints JSON.
+    """
+    from streamlit import logger
+    from shared_state import DEFAULT_PATH as SHARED_PATH, SharedBuffer
+    logger.set_log_level('error')
+    database = FakeDatabase(seed_data())
+    rng = random.Random(os.getpid())
+    with installed(database):
+        new_session().run()   # resource ของ process (listener หรือ follower, rollups) ไม่นับต่อ session
+        gc.collect()
+        tracemalloc.start()
+        mem_before = tracemalloc.get_traced_memory()[0]
+        sessions = [new_session('super_admin' if i == 0 else 'user') for i in range(n_sessions)]
+        for at in sessions:
+            at.run()
+        gc.collect()
+        kb_per_session = (tracemalloc.get_traced_memory()[0] - mem_before) / n_sessions / 1024
+        tracemalloc.stop()
+        leader = SharedBuffer(SHARED_PATH).leader_pid() == os.getpid()
+        listens = database.stats()['calls'].get('listen', 0)   # listener ถูกเปิดตอน warm-up
+        database.reset_counters()
+        print('ready', flush=True)
+        sys.stdin.readline()
+
+        controller = database.reference('valve_system')
+        latencies, pressures, errors = [], set(), 0
+        deadline = time.perf_counter() + seconds
+        next_write = 0.0
+        while time.perf_counter() < deadline:
+            for at in sessions:
+                if leader and time.perf_counter() >= next_write:
+                    controller.update({'live_pressure': round(rng.uniform(3.5, 4.5), 3),
+                                       'valve_rotation': round(rng.uniform(0, 20), 2),
+                                       'motor_load': round(rng.uniform(0.5, 2.5), 2)})
+                    next_write = time.perf_counter() + 1.0
+                t0 = time.perf_counter()
+                at.run()
+                latencies.append(time.perf_counter() - t0)
+                errors += len(at.exception)
+                if at.metric:
+                    pressures.add(at.metric[0].value)
+        calls = database.stats()['calls']
+    print(json.dumps({'leader': leader, 'reruns': len(latencies), 'p50': percentile(latencies, 0.5),
+                      'p95': percentile(latencies, 0.95), 'errors': errors, 'pressures_seen': len(pressures),
+                      'listens': listens + calls.get('listen', 0), 'events': calls.get('event', 0),
+                      'kb_per_session': kb_per_session}), flush=True)
+
+
+def measure_workers(worker_counts, sessions, seconds, interval):
+    """Aggregate rerun throughput of W worker processes sharing one telemetry tier.
+
+    Capacity = reruns/s x ``interval``: how many sessions could each get one
+    full rerun per ``interval`` seconds. It scales with workers only up to the
+    number of CPU cores.
+    """
+    tmp = tempfile.mkdtemp(prefix='workers-', dir=SANDBOX_DIR)
+    print(f"{os.cpu_count()} CPU core(s), {sessions} sessions per worker, {seconds:.0f} s per step")
+    print(f"{'workers':>7} {'reruns/s':>9} {'capacity':>9} {'p50 ms':>7} {'p95 ms':>7} {'leaders':>7} "
+          f"{'listeners':>16} {'follower sees':>13} {'KB/session':>10} {'errors':>6}")
+    results = []
+    for workers in worker_counts:
+        procs = []
+        for i in range(workers):
+            # spool/WAL แยกต่อ worker, history กับ shared state ใช้ร่วมกันใน step เดียวกัน
+            env = dict(os.environ, **sandbox_env(tmp, f'w{workers}.{i}.'))
+            env.update(VALVE_SHARED_STATE=os.path.join(tmp, f'shared{workers}.bin'),
+                       VALVE_HISTORY_PATH=os.path.join(tmp, f'history{workers}.bin'))
+            procs.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--worker-child', str(sessions), '--seconds', str(seconds)],
+                env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=open(os.path.join(tmp, f'w{workers}.{i}.err'), 'w'), text=True))
+        for i, proc in enumerate(procs):
+            # 'ready': ทุก worker โหลด session เสร็จแล้วจึงเริ่มจับเวลาพร้อมกัน
+            line = proc.stdout.readline()
+            while line and line.strip() != 'ready':
+                line = proc.stdout.readline()
+            if not line:
+                raise RuntimeError(f'worker {i} exited, see {tmp}/w{workers}.{i}.err')
+        for proc in procs:
+            proc.stdin.write('go\n')
+            proc.stdin.flush()
+        runs = [json.loads(proc.communicate()[0].strip().splitlines()[-1]) for proc in procs]
+        reruns_per_s = sum(r['reruns'] for r in runs) / seconds
+        leaders = [r for r in runs if r['leader']]
+        followers = [r for r in runs if not r['leader']]
+        r = {
+            'workers': workers, 'reruns_per_s': reruns_per_s, 'capacity': reruns_per_s * interval,
+            'p50_ms': statistics.median(x['p50'] for x in runs) * 1000,
+            'p95_ms': max(x['p95'] for x in runs) * 1000, 'leaders': len(leaders),
+            'leader_listens': sum(x['listens'] for x in leaders),
+            'follower_listens': max((x['listens'] for x in followers), default=0),
+            'follower_pressures': min((x['pressures_seen'] for x in followers), default=None),
+            'kb_per_session': statistics.median(x['kb_per_session'] for x in runs),
+            'errors': sum(x['errors'] for x in runs),
+        }
+        results.append(r)
+        seen = '-' if r['follower_pressures'] is None else f"{r['follower_pressures']} values"
+        print(f"{workers:>7} {reruns_per_s:>9.1f} {r['capacity']:>9.0f} {r['p50_ms']:>7.0f} {r['p95_ms']:>7.0f} "
+              f"{r['leaders']:>7} {r['leader_listens']:>5} + {r['follower_listens']:>2}/follower {seen:>13} "
+              f"{r['kb_per_session']:>10.1f} {r['errors']:>6}")
+        sys.stdout.flush()
+    return results
+
+
+def startup_child(page, app_path):
+    """One cold start, run in a fresh interpreter; prints its timings as JSON."""
+    t0 = time.perf_counter()
+    from streamlit import logger
+    from streamlit.testing.v1 import AppTest
+    logger.set_log_level('error')
+    framework_s = time.perf_counter() - t0
+    # AppTest เองมีค่าใช้จ่ายต่อ instance (scan component); วัดจาก script เปล่าไว้หักออก
+    t0 = time.perf_counter()
+    AppTest.from_string('pass').run()
+    harness_s = time.perf_counter() - t0
+
+    def session():
+        at = AppTest.from_file(app_path, default_timeout=60)
+        if page != 'login':
+            at.session_state.logged_in = True
+            at.session_state.username = 'admin'
+            at.session_state.user_role = 'super_admin'
+        return at
+
+    with installed(FakeDatabase(seed_data())):
+        first = session()
+        if page == 'after-login':
+            # process ใหม่เปิดหน้า login ก่อนเสมอ: ผู้ใช้ใช้เวลากรอกรหัสสักพัก แล้วจึงเข้า dashboard
+            first.session_state.logged_in = False
+            first.run()
+            time.sleep(3.0)
+            first.session_state.logged_in = True
+        t0 = time.perf_counter()
+        first.run()
+        first_s = time.perf_counter() - t0
+        second = session()
+        t0 = time.perf_counter()
+        second.run()
+        warm_s = time.perf_counter() - t0
+    print(json.dumps({'framework_ms': framework_s * 1000, 'harness_ms': harness_s * 1000,
+                      'first_ms': first_s * 1000, 'warm_ms': warm_s * 1000,
+                      'errors': len(first.exception) + len(second.exception)}))
+
+
+def measure_startup(app_path, repeats):
+    """Median time-to-first-render of the login page and the dashboard over fresh processes.
+
+    "AppTest run" is the same harness running an empty script; the part of
+    "first render" / "2nd session" above it is the app's own work.
+    "after-login" is the realistic path: the login page first, then the
+    dashboard a few seconds later in the same fresh process.
+    """
+    tmp = tempfile.mkdtemp(prefix='startup-', dir=SANDBOX_DIR)
+    print(f"{'page':<11} {'streamlit import':>16} {'AppTest run':>11} {'first render':>12} {'2nd session':>11} "
+          f"{'errors':>6}   (median of {repeats} fresh processes, ms)")
+    results = {}
+    for page in ('login', 'dashboard', 'after-login'):
+        runs = []
+        for i in range(repeats):
+            # ไฟล์ history/spool/WAL/shared state แยกต่อรอบ ให้ทุกรอบเริ่มจากเครื่องเปล่าเหมือนกัน
+            env = dict(os.environ, **sandbox_env(tmp, f'{page}{i}.'))
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--startup-child', page,
+                                  '--app', app_path], env=env, capture_output=True, text=True, check=True)
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        keys = ('framework_ms', 'harness_ms', 'first_ms', 'warm_ms')
+        med = {key: statistics.median(r[key] for r in runs) for key in keys}
+        results[page] = dict(med, errors=sum(r['errors'] for r in runs))
+        r = results[page]
+        print(f"{page:<11} {r['framework_ms']:>16.0f} {r['harness_ms']:>11.0f} {r['first_ms']:>12.0f} "
+              f"{r['warm_ms']:>11.0f} {r['errors']:>6}")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', default='1,10,50,100,200', help='comma separated session counts')
+    parser.add_argument('--ticks', type=int, default=3, help='refresh ticks per scale step')
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='seconds of operator time one tick represents (for per-minute rates)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write raw results to this file')
+    parser.add_argument('--startup', action='store_true', help='measure cold-start time instead')
+    parser.add_argument('--repeats', type=int, default=5, help='fresh processes per page for --startup')
+    parser.add_argument('--app', default=APP_PATH, help='script for --startup (e.g. an older revision)')
+    parser.add_argument('--startup-child', choices=('login', 'dashboard', 'after-login'), help=argparse.SUPPRESS)
+    parser.add_argument('--workers', help='comma separated worker process counts (shared telemetry tier)')
+    parser.add_argument('--sessions-per-worker', type=int, default=5, help='sessions in each worker for --workers')
+    parser.add_argument('--seconds', type=float, default=15.0, help='measured seconds per --workers step')
+    parser.add_argument('--worker-child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.startup_child:
+        return startup_child(args.startup_child, args.app)
+    if args.worker_child:
+        return worker_child(args.worker_child, args.seconds)
+    if args.workers:
+        results = measure_workers([int(x) for x in args.workers.split(',')], args.sessions_per_worker,
+                                  args.seconds, args.interval)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+        return results
+    if args.startup:
+        results = measure_startup(args.app, args.repeats)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+        return results
+
+    # ปิด warning ของ streamlit ในโหมด bare (AppTest) ให้ตารางผลอ่านง่าย
+    from streamlit import logger
+    logger.set_log_level('error')
+
+    rng = random.Random(args.seed)
+    # รอบอุ่นเครื่อง: import โมดูล/สร้าง cache ครั้งแรก ไม่ให้ไปนับรวมในหน่วยความจำต่อ session
+    run_scale(1, 1, args.interval, rng)
+    results = []
+    header = (f"{'sessions':>8} {'reads/min':>10} {'writes/min':>10} {'events/min':>10} {'KB read/min':>11} "
+              f"{'p50 ms':>8} {'p99 ms':>8} {'KB/session':>10} {'errors':>6}")
+    print(header)
+    for n in (int(x) for x in args.sessions.split(',')):
+        r = run_scale(n, args.ticks, args.interval, rng)
+        results.append(r)
+        print(f"{r['sessions']:>8} {r['reads_per_min']:>10.1f} {r['writes_per_min']:>10.1f} "
+              f"{r['events_per_min']:>10.1f} {r['kb_read_per_min']:>11.1f} {r['rerun_p50_ms']:>8.1f} "
+              f"{r['rerun_p99_ms']:>8.1f} {r['mem_per_session_kb']:>10.1f} {r['script_errors']:>6}")
+        sys.stdout.flush()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
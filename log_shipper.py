@@ -0,0 +1,201 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+from pushid import push_key
+
+DEFAULT_SPOOL = os.environ.get(
+    'VALVE_LOG_SPOOL', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'activity_log.spool'))
+
+
+class LogShipper:
+    """Background writer for the activity log.
+
+    ``submit()`` only appends the entry to a local spool file (fsync'd) and a
+    bounded in-memory queue, so UI handlers never wait on the RTDB. A worker
+    thread drains the queue in batches, each shipped as one multi-path
+    ``update()`` keyed by client-generated push keys; a retry after a crash or
+    timeout rewrites the same paths instead of creating duplicates.
+
+    The spool is the source of truth: entries stay there until their batch is
+    acknowledged, and anything unacknowledged is shipped again on restart.
+    """
+
+    def __init__(self, log_ref, spool_path=DEFAULT_SPOOL, batch_size=200, max_queue=10000,
+                 flush_interval=0.5, max_backoff=30.0, on_flush=None, enrich=None):
+        self.log_ref = log_ref
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.on_flush = on_flush
+        self.enrich = enrich        # enrich(key, entry) -> field เพิ่มเติม เช่น index ของ log explorer
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._spool_lock = threading.Lock()
+        self._spool = None
+        self._pending = set()       # key ที่อยู่ใน spool แต่ยังไม่ได้รับ ack
+        self._overflow = False      # queue เต็ม: ต้องโหลด entry ที่ค้างจาก spool อีกรอบ
+        self._stop = threading.Event()
+        self._thread = None
+        self.shipped = 0
+        self.failures = 0
+        self.last_error = None
+        self._latencies = deque(maxlen=500)
+
+    # --- lifecycle ---
+    def start(self):
+        if self._thread is not None:
+            return
+        directory = os.path.dirname(self.spool_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        for key, entry in self._recover():
+            self._pending.add(key)
+            self._enqueue(key, entry)
+        self._spool = open(self.spool_path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='log-shipper', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._spool_lock:
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+
+    # --- write side ---
+    def submit(self, entry):
+        """Durably record ``entry`` and return its push key; never touches the network."""
+        key = push_key()
+        if self.enrich is not None:
+            entry = dict(entry, **self.enrich(key, entry))
+        self._append_spool({'k': key, 'e': entry}, pending=key)
+        self._enqueue(key, entry)
+        return key
+
+    def _enqueue(self, key, entry):
+        try:
+            self._queue.put_nowait((key, entry))
+        except queue.Full:
+            self._overflow = True
+
+    def _append_spool(self, record, pending=None):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._spool_lock:
+            self._spool.write(line)
+            self._spool.flush()
+            os.fsync(self._spool.fileno())
+            if pending is not None:
+                # เพิ่มใน lock เดียวกับการเขียน เพื่อไม่ให้ _compact ตัดไฟล์ทิ้งระหว่างนั้น
+                self._pending.add(pending)
+
+    def _recover(self):
+        """Unacknowledged (key, entry) pairs left in the spool, in submit order."""
+        if not os.path.exists(self.spool_path):
+            return []
+        entries, acked = {}, set()
+        with open(self.spool_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue   # บรรทัดสุดท้ายเขียนไม่ครบตอน process ตาย
+                if 'ack' in record:
+                    acked.update(record['ack'])
+                elif 'k' in record:
+                    entries[record['k']] = record['e']
+        return [(k, e) for k, e in entries.items() if k not in acked]
+
+    # --- worker ---
+    def _next_batch(self):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        backoff = 0.5
+        batch = []
+        while not (self._stop.is_set() and not batch and self._queue.empty()):
+            if not batch:
+                batch = self._next_batch()
+                if not batch:
+                    if self._overflow:
+                        self._reload_overflow()
+                    elif self._stop.is_set():
+                        break
+                    continue
+            started = time.perf_counter()
+            try:
+                self.log_ref.update({key: entry for key, entry in batch})
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f'{type(e).__name__}: {e}'
+                # retry batch เดิมแบบ exponential backoff (+jitter) จนกว่าจะสำเร็จ
+                if self._stop.wait(backoff * random.uniform(0.5, 1.0)):
+                    break
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self._latencies.append((time.perf_counter() - started) * 1000.0)
+            backoff = 0.5
+            keys = [key for key, _ in batch]
+            self._ack(keys)
+            self.shipped += len(keys)
+            batch = []
+            if self.on_flush is not None:
+                try:
+                    self.on_flush(keys)
+                except Exception:
+                    pass
+
+    def _ack(self, keys):
+        self._append_spool({'ack': keys})
+        with self._spool_lock:
+            self._pending.difference_update(keys)
+            idle = not self._pending
+        if idle:
+            self._compact()
+
+    def _reload_overflow(self):
+        self._overflow = False
+        with self._spool_lock:
+            self._spool.flush()
+        for key, entry in self._recover():
+            self._enqueue(key, entry)
+
+    def _compact(self, min_bytes=1 << 20):
+        # ทุก entry ได้รับ ack แล้ว: ตัดไฟล์ spool ทิ้งเมื่อใหญ่เกิน 1 MB
+        with self._spool_lock:
+            if self._pending or self._spool is None or self._spool.tell() < min_bytes:
+                return
+            self._spool.seek(0)
+            self._spool.truncate()
+            self._spool.flush()
+            os.fsync(self._spool.fileno())
+
+    # --- metrics ---
+    def stats(self):
+        latencies = sorted(self._latencies)
+        n = len(latencies)
+        return {
+            'queue_depth': self._queue.qsize(),
+            'pending': len(self._pending),
+            'shipped': self.shipped,
+            'failures': self.failures,
+            'flush_p50_ms': latencies[n // 2] if n else None,
+            'flush_p95_ms': latencies[min(n - 1, int(n * 0.95))] if n else None,
+            'last_error': self.last_error,
+        }
@@ -0,0 +1,450 @@
+"""Process-wide performance metrics: RTDB calls, listener events and script reruns.
+
+``instrument(ref, name)`` wraps a firebase_admin ``db.Reference`` so that every
+operation on it, on its children and on queries built from it records:
+
+- ``rtdb_request_duration_seconds{op,ref}``   latency histogram
+- ``rtdb_bytes_total{op,ref,direction}``      JSON bytes sent / received (estimated, see ``_nbytes``)
+- ``rtdb_errors_total{op,ref,type}``          exceptions by type (re-raised)
+- ``rtdb_events_total{ref}``                  listener events (+ bytes received)
+
+``ref`` is the name given to the wrapped root (e.g. ``telemetry``), so label
+cardinality stays fixed no matter how many child paths are touched. Calls made
+from a Streamlit script thread are also counted per session (``session_calls``)
+so a rerun's RTDB volume can be observed with ``rerun()``.
+
+Everything is exposed in Prometheus text format by ``render()``, which
+``serve()`` publishes on a local HTTP port at ``/metrics``.
+"""
+import bisect
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# ขอบบนของ bucket (วินาที) ตั้งแต่ 0.5 ms ถึง 30 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_SAMPLE = 16   # node ที่มีลูกมากกว่านี้ วัดจากตัวอย่างที่กระจายเท่า ๆ กันแล้วคูณกลับ
+
+
+def _nbytes(value):
+    """Approximate JSON size of ``value`` without serializing all of it.
+
+    Numbers and ASCII strings are sized directly. A dict or list with more than
+    ``SIZE_SAMPLE`` children is sized from that many evenly spaced children and
+    scaled to its length, which is close for the uniform nodes this app reads
+    (log pages, users, schedule rows) and keeps the cost per call bounded.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return len(repr(value))   # True/False ยาวเท่ากับ true/false
+    if isinstance(value, str) and value.isascii():
+        return len(value) + 2
+    try:
+        n = len(value) if isinstance(value, (dict, list)) else 0
+        if n <= SIZE_SAMPLE:
+            return len(json.dumps(value, separators=(',', ':'), default=str))
+        picks = [n * i // SIZE_SAMPLE for i in range(SIZE_SAMPLE)]
+        if isinstance(value, dict):
+            keys = list(value)
+            part = {keys[i]: value[keys[i]] for i in picks}
+        else:
+            part = [value[i] for i in picks]
+        body = len(json.dumps(part, separators=(',', ':'), default=str)) - 2 - (SIZE_SAMPLE - 1)
+        return round(body * n / SIZE_SAMPLE) + (n - 1) + 2
+    except (TypeError, ValueError):
+        return 0
+
+
+_get_ctx = None
+
+
+def _session_id():
+    global _get_ctx
+    if _get_ctx is None:
+        try:
+            from streamlit.runtime.scriptrunner import get_script_run_ctx
+            _get_ctx = lambda: get_script_run_ctx(suppress_warning=True)
+        except ImportError:
+            _get_ctx = lambda: None
+    ctx = _get_ctx()
+    return ctx.session_id if ctx is not None else None
+
+
+class Histogram:
+    """Fixed-bucket histogram (Prometheus ``le`` buckets plus +Inf)."""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate from the buckets (linear inside the bucket); None when empty."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = self.bounds[i - 1] if i > 0 else 0.0
+                hi = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+        return self.bounds[-1]
+
+
+class Registry:
+    """Counters and histograms keyed by ``(name, labels)``; all updates take one lock."""
+
+    def __init__(self, max_sessions=1000):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._sessions = OrderedDict()   # session_id -> จำนวน RTDB call (เก็บล่าสุดไม่เกิน max_sessions)
+        self.max_sessions = max_sessions
+        self.started_at = time.time()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, bounds=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram(bounds)
+            hist.observe(value)
+
+    def record_call(self, op, ref, seconds, sent=0, received=0, error=None):
+        """One RTDB operation; a single lock round trip for all of its series."""
+        labels = (('op', op), ('ref', ref))
+        session = _session_id()
+        with self._lock:
+            hist = self._histograms.get(('rtdb_request_duration_seconds', labels))
+            if hist is None:
+                hist = self._histograms[('rtdb_request_duration_seconds', labels)] = Histogram(LATENCY_BUCKETS)
+            hist.observe(seconds)
+            counters = self._counters
+            if sent:
+                key = ('rtdb_bytes_total', labels + (('direction', 'sent'),))
+                counters[key] = counters.get(key, 0) + sent
+            if received:
+                key = ('rtdb_bytes_total', labels + (('direction', 'received'),))
+                counters[key] = counters.get(key, 0) + received
+            if error is not None:
+                key = ('rtdb_errors_total', labels + (('type', error),))
+                counters[key] = counters.get(key, 0) + 1
+            if session is not None:
+                sessions = self._sessions
+                sessions[session] = sessions.get(session, 0) + 1
+                sessions.move_to_end(session)
+                if len(sessions) > self.max_sessions:
+                    sessions.popitem(last=False)
+
+    def session_calls(self, session_id=None):
+        session_id = session_id or _session_id()
+        with self._lock:
+            return self._sessions.get(session_id, 0)
+
+    def rerun(self, section, seconds, calls=None):
+        """One script (or fragment) run: duration and, if known, the RTDB calls it made."""
+        labels = (('section', section),)
+        self.observe('streamlit_rerun_duration_seconds', labels, seconds)
+        if calls is not None:
+            self.observe('streamlit_rerun_rtdb_calls', labels, calls, bounds=COUNT_BUCKETS)
+
+    # --- read side ---
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (h.bounds, list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+            sessions = len(self._sessions)
+        return counters, histograms, sessions
+
+    def summary(self):
+        """Rows per (name, labels) histogram with count, mean and p50/p95/p99 (for the UI)."""
+        _, histograms, _ = self.snapshot()
+        rows = []
+        for (name, labels), (bounds, counts, total, n) in sorted(histograms.items()):
+            hist = Histogram(bounds)
+            hist.counts, hist.sum, hist.count = counts, total, n
+            rows.append({'name': name, **dict(labels), 'count': n, 'mean': total / n if n else None,
+                         'p50': hist.quantile(0.50), 'p95': hist.quantile(0.95), 'p99': hist.quantile(0.99)})
+        return rows
+
+    def counters(self, name):
+        counters, _, _ = self.snapshot()
+        return {labels: value for (n, labels), value in sorted(counters.items()) if n == name}
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        counters, histograms, sessions = self.snapshot()
+        lines = []
+
+        def fmt(labels, extra=()):
+            pairs = tuple(labels) + tuple(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                                  for k, v in pairs) + '}'
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f'# HELP {name} {self._help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        last = None
+        for (name, labels), value in sorted(counters.items()):
+            if name != last:
+                header(name, 'counter')
+                last = name
+            lines.append(f'{name}{fmt(labels)} {value}')
+        last = None
+        for (name, labels), (bounds, counts, total, n) in sorted(histograms.items()):
+            if name != last:
+                header(name, 'histogram')
+                last = name
+            cumulative = 0
+            for bound, count in zip(bounds + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f'{name}_bucket{fmt(labels, (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{fmt(labels)} {total}')
+            lines.append(f'{name}_count{fmt(labels)} {n}')
+        header('streamlit_tracked_sessions', 'gauge')
+        lines.append(f'streamlit_tracked_sessions {sessions}')
+        header('process_start_time_seconds', 'gauge')
+        lines.append(f'process_start_time_seconds {self.started_at}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REGISTRY.describe('rtdb_request_duration_seconds', 'Latency of Realtime Database operations.')
+REGISTRY.describe('rtdb_bytes_total', 'JSON bytes sent to / received from the Realtime Database.')
+REGISTRY.describe('rtdb_errors_total', 'Realtime Database operations that raised, by exception type.')
+REGISTRY.describe('rtdb_events_total', 'Listener events received.')
+REGISTRY.describe('streamlit_rerun_duration_seconds', 'Script and fragment run time.')
+REGISTRY.describe('streamlit_rerun_rtdb_calls', 'RTDB calls made by one script or fragment run.')
+
+
+class _Instrumented:
+    __slots__ = ('_target', '_name', '_registry')
+
+    def __init__(self, target, name, registry):
+        self._target = target
+        self._name = name
+        self._registry = registry
+
+    def _call(self, op, fn, *args, sent=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._registry.record_call(op, self._name, time.perf_counter() - start,
+                                       sent=_nbytes(sent), error=type(e).__name__)
+            raise
+        elapsed = time.perf_counter() - start
+        received = _nbytes(result) if op in ('get', 'query', 'transaction') else 0
+        self._registry.record_call(op, self._name, elapsed, sent=_nbytes(sent), received=received)
+        return result
+
+    def __getattr__(self, attr):
+        return getattr(self._target, attr)   # อย่างอื่น (key, path, ...) ส่งต่อโดยไม่วัด
+
+
+class InstrumentedQuery(_Instrumented):
+    __slots__ = ()
+
+    def _wrap(self, query):
+        return InstrumentedQuery(query, self._name, self._registry)
+
+    def order_by_key(self):
+        return self._wrap(self._target.order_by_key())
+
+    def order_by_child(self, path):
+        return self._wrap(self._target.order_by_child(path))
+
+    def order_by_value(self):
+        return self._wrap(self._target.order_by_value())
+
+    def limit_to_first(self, limit):
+        return self._wrap(self._target.limit_to_first(limit))
+
+    def limit_to_last(self, limit):
+        return self._wrap(self._target.limit_to_last(limit))
+
+    def start_at(self, start):
+        return self._wrap(self._target.start_at(start))
+
+    def end_at(self, end):
+        return self._wrap(self._target.end_at(end))
+
+    def equal_to(self, value):
+        return self._wrap(self._target.equal_to(value))
+
+    def get(self):
+        return self._call('query', self._target.get)
+
+
+class InstrumentedReference(InstrumentedQuery):
+    """A db.Reference look-alike that measures every call; children stay instrumented."""
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return self._target.key
+
+    @property
+    def path(self):
+        return self._target.path
+
+    @property
+    def parent(self):
+        parent = self._target.parent
+        return None if parent is None else InstrumentedReference(parent, self._name, self._registry)
+
+    def child(self, path):
+        return InstrumentedReference(self._target.child(path), self._name, self._registry)
+
+    def get(self, etag=False, shallow=False):
+        return self._call('get', self._target.get, etag=etag, shallow=shallow)
+
+    def set(self, value):
+        return self._call('set', self._target.set, value, sent=value)
+
+    def update(self, value):
+        return self._call('update', self._target.update, value, sent=value)
+
+    def push(self, value=''):
+        pushed = self._call('push', self._target.push, value, sent=value)
+        return InstrumentedReference(pushed, self._name, self._registry)
+
+    def delete(self):
+        return self._call('delete', self._target.delete)
+
+    def transaction(self, transaction_update):
+        return self._call('transaction', self._target.transaction, transaction_update)
+
+    def listen(self, callback):
+        name, registry = self._name, self._registry
+
+        def on_event(event):
+            registry.inc('rtdb_events_total', (('ref', name),))
+            registry.inc('rtdb_bytes_total', (('op', 'event'), ('ref', name), ('direction', 'received')),
+                         _nbytes(getattr(event, 'data', None)))
+            return callback(event)
+
+        return self._call('listen', self._target.listen, on_event)
+
+
+def instrument(ref, name, registry=REGISTRY):
+    """Wrap ``ref`` (and everything derived from it) so its calls land in ``registry``."""
+    return InstrumentedReference(ref, name, registry)
+
+
+def serve(port, registry=REGISTRY, host='127.0.0.1'):
+    """Serve ``registry.render()`` at ``http://host:port/metrics`` from a daemon thread.
+
+    Returns the server, or None if the port is taken (e.g. another worker has it).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass   # ไม่ต้องเขียน access log ทุกครั้งที่ Prometheus scrape
+
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError:
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+# --- Benchmark: ต้นทุนของการวัดต่อ RTDB call เทียบกับ reference เปล่า ---
+if __name__ == '__main__':
+    from fake_rtdb import FakeDatabase
+
+    n = 200_000
+    database = FakeDatabase({'valve_system': {'live_pressure': 3.9, 'valve_rotation': 12.0, 'motor_load': 1.4,
+                                              'auto_mode': True}})
+    raw = database.reference('valve_system/live_pressure')
+    wrapped = instrument(database.reference('valve_system'), 'telemetry', Registry()).child('live_pressure')
+
+    def bench(label, fn):
+        fn()
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        per_call = (time.perf_counter() - t0) / n * 1e6
+        print(f"{label:<36} {per_call:7.2f} us/call")
+        return per_call
+
+    base = bench('fake get (no instrumentation)', raw.get)
+    inst = bench('fake get (instrumented)', wrapped.get)
+    base_u = bench('fake update (no instrumentation)', lambda: raw.parent.update({'auto_mode': True}))
+    inst_u = bench('fake update (instrumented)', lambda: wrapped.parent.update({'auto_mode': True}))
+    registry = Registry()
+    record = bench('record_call only', lambda: registry.record_call('get', 'telemetry', 0.004, received=12))
+    overhead = max(inst - base, inst_u - base_u)
+    print(f"overhead {overhead:.2f} us/call = {overhead / 20_000:.3%} of a 20 ms RTDB round trip; "
+          f"a rerun with 10 calls pays {overhead * 10:.0f} us")
+    print(f"render(): {len(registry.render().splitlines())} lines")
+
+    # ขนาด payload จริงของแอป: ค่า telemetry, แถวตาราง schedule, node users, หน้า log 1,000 รายการ
+    from activity_log import index_fields
+    from pushid import push_key
+
+    entry = {'user': 'operator007', 'role': 'user', 'action': 'Manual Command: OPEN',
+             'timestamp': '2024-01-01 00:00:00'}
+    logs = {key: dict(entry, **index_fields(key, entry))
+            for key in (push_key(now_ms=1_704_067_200_000 + i * 1000) for i in range(1000))}
+    users = {f'operator{i:03d}': {'password': 'x' * 10, 'role': 'user', 'display_name': f'ผู้ปฏิบัติงาน {i}'}
+             for i in range(200)}
+    rows = {f'row{i:03d}': {'START_TIME': f'{i // 2:02d}:{i % 2 * 30:02d}', 'TARGET': 3.5 + i / 100}
+            for i in range(48)}
+    payloads = (('telemetry float', 3.91), ('schedule row', rows['row001']), ('48 schedule rows', rows),
+                ('200 users', users), ('log page (1,000)', logs))
+    exact = lambda v: len(json.dumps(v, separators=(',', ':'), default=str))
+    print(f"{'payload':<18} {'bytes':>9} {'estimate':>9} {'error':>7} {'json.dumps':>11} {'_nbytes':>9}")
+    for label, value in payloads:
+        reps = max(20, 20_000 // max(1, exact(value) // 100))
+        costs = []
+        for fn in (exact, _nbytes):
+            t0 = time.perf_counter()
+            for _ in range(reps):
+                fn(value)
+            costs.append((time.perf_counter() - t0) / reps * 1e6)
+        size, estimate = exact(value), _nbytes(value)
+        print(f"{label:<18} {size:>9,} {estimate:>9,} {(estimate - size) / size:>7.1%} "
+              f"{costs[0]:>8.1f} us {costs[1]:>6.1f} us")
@@ -0,0 +1,46 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import streamlit as st
+
+from metrics import REGISTRY
+
+_KEY = '_perf_timings'
+
+
+def record(section, seconds, calls=None, maxlen=200):
+    """Keep the last ``maxlen`` durations per section in this session.
+
+    Also exported process-wide (``streamlit_rerun_*`` in metrics), with the
+    number of RTDB calls the run made when ``calls`` is given.
+    """
+    REGISTRY.rerun(section, seconds, calls)
+    timings = st.session_state.setdefault(_KEY, {})
+    timings.setdefault(section, deque(maxlen=maxlen)).append(seconds * 1000.0)
+
+
+@contextmanager
+def timed(section):
+    start = time.perf_counter()
+    calls = REGISTRY.session_calls()
+    try:
+        yield
+    finally:
+        record(section, time.perf_counter() - start, REGISTRY.session_calls() - calls)
+
+
+def timing_report():
+    """Rows of (section, runs, last/p50/p95/max ms) for the per-rerun timing table."""
+    rows = []
+    for section, values in sorted(st.session_state.get(_KEY, {}).items()):
+        ordered = sorted(values)
+        n = len(ordered)
+        rows.append({
+            'section': section, 'runs': n,
+            'last ms': round(values[-1], 2),
+            'p50 ms': round(ordered[n // 2], 2),
+            'p95 ms': round(ordered[min(n - 1, int(n * 0.95))], 2),
+            'max ms': round(ordered[-1], 2),
+        })
+    return rows
@@ -0,0 +1,51 @@
+import random
+import threading
+import time
+
+# ตัวอักษรเดียวกับที่ Firebase ใช้สร้าง push key (เรียงตามเวลาได้แบบ lexicographic)
+_PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_rand = [0] * 12
+
+
+def push_key(now_ms=None):
+    """Firebase-compatible, time-ordered 20 character push key generated locally.
+
+    Lets callers pick the key before the write reaches the database, so retries
+    of the same record land on the same path instead of creating duplicates.
+    """
+    global _last_ms
+    with _lock:
+        now = int(time.time() * 1000) if now_ms is None else int(now_ms)
+        if now == _last_ms:
+            # เวลาเดียวกัน: เพิ่มส่วนสุ่มทีละหนึ่งเพื่อให้ key ยังเรียงต่อกัน
+            for i in range(11, -1, -1):
+                if _last_rand[i] != 63:
+                    _last_rand[i] += 1
+                    break
+                _last_rand[i] = 0
+        else:
+            _last_ms = now
+            for i in range(12):
+                _last_rand[i] = random.randrange(64)
+        stamp = []
+        for _ in range(8):
+            stamp.append(_PUSH_CHARS[now % 64])
+            now //= 64
+        return ''.join(reversed(stamp)) + ''.join(_PUSH_CHARS[r] for r in _last_rand)
+
+
+def key_bound(ms, upper=False):
+    """Smallest (or largest, with ``upper``) push key that could be generated at ``ms``.
+
+    Push keys sort by creation time, so a time range maps to a key range usable
+    with ``start_at``/``end_at`` on ``order_by_key()`` or key-suffixed indexes.
+    """
+    now = int(ms)
+    stamp = []
+    for _ in range(8):
+        stamp.append(_PUSH_CHARS[now % 64])
+        now //= 64
+    return ''.join(reversed(stamp)) + (_PUSH_CHARS[-1] if upper else _PUSH_CHARS[0]) * 12
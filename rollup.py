@@ -0,0 +1,267 @@
+import math
+import threading
+
+import numpy as np
+
+from history_store import SAMPLE_FIELDS
+
+# (ความกว้าง bucket วินาที, จำนวน bucket ที่เก็บ)
+TIERS = (
+    (1, 6 * 3600),          # 1 s   ย้อนหลัง 6 ชั่วโมง
+    (60, 7 * 24 * 60),      # 1 min ย้อนหลัง 7 วัน
+    (900, 90 * 24 * 4),     # 15 min ย้อนหลัง 90 วัน
+    (3600, 366 * 24),       # 1 h   ย้อนหลัง 1 ปี
+)
+CHART_MAX_POINTS = 2000
+_OVERSAMPLE = 8   # ยอมให้ tier มี bucket เกินงบได้กี่เท่าก่อนเลื่อนไป tier ที่หยาบกว่า
+
+_START, _COUNT = 0, 1
+_MIN, _MAX, _SUM, _LAST = range(4)
+
+
+class RollupTier:
+    """Fixed-width min/max/sum/last buckets in a mirrored ring (see HistoryStore)."""
+
+    def __init__(self, width, capacity, n_metrics):
+        self.width = float(width)
+        self.capacity = int(capacity)
+        self.n_metrics = n_metrics
+        self._data = np.full((2 + 4 * n_metrics, 2 * self.capacity), np.nan)
+        self.n = 0             # bucket ที่เปิดไปแล้วทั้งหมด
+        self._current = None   # หมายเลข bucket (ts // width) ที่กำลังสะสมอยู่
+
+    def _rows(self, stat):
+        return slice(2 + stat, 2 + 4 * self.n_metrics, 4)
+
+    def _write(self, i, column):
+        self._data[:, i] = column
+        self._data[:, i + self.capacity] = column
+
+    def add(self, ts, values):
+        b = math.floor(ts / self.width)
+        if self._current is not None and b < self._current:
+            return   # sample มาช้ากว่า bucket ปัจจุบัน: ข้าม
+        if b == self._current:
+            i = (self.n - 1) % self.capacity
+            col = self._data[:, i]
+            col[_COUNT] += 1
+            col[self._rows(_MIN)] = np.minimum(col[self._rows(_MIN)], values)
+            col[self._rows(_MAX)] = np.maximum(col[self._rows(_MAX)], values)
+            col[self._rows(_SUM)] += values
+            col[self._rows(_LAST)] = values
+            self._data[:, i + self.capacity] = col
+            return
+        col = np.empty(self._data.shape[0])
+        col[_START] = b * self.width
+        col[_COUNT] = 1
+        for stat in (_MIN, _MAX, _SUM, _LAST):
+            col[self._rows(stat)] = values
+        self._write(self.n % self.capacity, col)
+        self.n += 1
+        self._current = b
+
+    def add_many(self, ts, values):
+        """Vectorized aggregation of sorted samples; ``values`` is (n_metrics, n)."""
+        if len(ts) == 0:
+            return
+        buckets = np.floor(ts / self.width).astype(np.int64)
+        if self._current is not None:
+            keep = buckets >= self._current
+            ts, values, buckets = ts[keep], values[:, keep], buckets[keep]
+            head = buckets == self._current
+            for j in np.flatnonzero(head):
+                self.add(ts[j], values[:, j])
+            ts, values, buckets = ts[~head], values[:, ~head], buckets[~head]
+            if len(ts) == 0:
+                return
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(ts)]
+        block = np.empty((self._data.shape[0], len(starts)))
+        block[_START] = buckets[starts] * self.width
+        block[_COUNT] = ends - starts
+        block[self._rows(_MIN)] = np.minimum.reduceat(values, starts, axis=1)
+        block[self._rows(_MAX)] = np.maximum.reduceat(values, starts, axis=1)
+        block[self._rows(_SUM)] = np.add.reduceat(values, starts, axis=1)
+        block[self._rows(_LAST)] = values[:, ends - 1]
+        if block.shape[1] > self.capacity:
+            block = block[:, -self.capacity:]
+        m = block.shape[1]
+        start = self.n % self.capacity
+        first = min(m, self.capacity - start)
+        for offset in (0, self.capacity):
+            self._data[:, start + offset:start + offset + first] = block[:, :first]
+            self._data[:, offset:offset + m - first] = block[:, first:]
+        self.n += m
+        self._current = int(buckets[-1])
+
+    def view(self):
+        """All retained buckets, oldest first, as a zero-copy slice."""
+        k = min(self.n, self.capacity)
+        end = (self.n - 1) % self.capacity + self.capacity + 1 if self.n else 0
+        return self._data[:, end - k:end]
+
+    def select(self, metric, start_ts, end_ts):
+        """(start, count, min, max, mean, last) arrays for buckets in [start_ts, end_ts]."""
+        v = self.view()
+        starts = v[_START]
+        lo = int(np.searchsorted(starts, start_ts - self.width, side='right'))
+        hi = int(np.searchsorted(starts, end_ts, side='right'))
+        row = 2 + 4 * metric
+        count = v[_COUNT, lo:hi]
+        return (starts[lo:hi], count, v[row + _MIN, lo:hi], v[row + _MAX, lo:hi],
+                v[row + _SUM, lo:hi] / count, v[row + _LAST, lo:hi])
+
+    def oldest(self):
+        v = self.view()
+        return v[_START, 0] if v.shape[1] else None
+
+
+def minmax_downsample(ts, mins, maxs, n_groups, width=0.0):
+    """Peak-preserving reduction to at most 2 * n_groups points.
+
+    Buckets are split into equal groups; each group contributes its minimum and its
+    maximum at their own timestamps, in time order, so spikes always survive.
+    """
+    n = len(ts)
+    if n == 0:
+        return ts, mins
+    g = max(1, math.ceil(n / max(1, n_groups)))
+    pad = (-n) % g
+    if pad:
+        ts = np.r_[ts, np.full(pad, np.nan)]
+        mins = np.r_[mins, np.full(pad, np.nan)]
+        maxs = np.r_[maxs, np.full(pad, np.nan)]
+    T, Lo, Hi = ts.reshape(-1, g), mins.reshape(-1, g), maxs.reshape(-1, g)
+    rows = np.arange(T.shape[0])
+    imin, imax = np.nanargmin(Lo, axis=1), np.nanargmax(Hi, axis=1)
+    tmin, tmax = T[rows, imin], T[rows, imax]
+    vmin, vmax = Lo[rows, imin], Hi[rows, imax]
+    # min/max ใน bucket เดียวกัน: วาง max ไว้กลาง bucket ให้เส้นกราฟยังเห็นยอด
+    tmax = np.where(tmin == tmax, tmax + width / 2, tmax)
+    min_first = tmin <= tmax
+    out_t = np.column_stack([np.where(min_first, tmin, tmax), np.where(min_first, tmax, tmin)]).ravel()
+    out_v = np.column_stack([np.where(min_first, vmin, vmax), np.where(min_first, vmax, vmin)]).ravel()
+    # กลุ่มที่ min == max (เช่น bucket มี sample เดียว) เหลือจุดเดียวพอ
+    keep = np.ones(len(out_v), dtype=bool)
+    keep[1::2] = out_v[1::2] != out_v[0::2]
+    return out_t[keep], out_v[keep]
+
+
+class RollupEngine:
+    """Incremental multi-resolution rollups shared by every chart on the page."""
+
+    def __init__(self, tiers=TIERS, fields=SAMPLE_FIELDS):
+        self.fields = tuple(fields)
+        self.tiers = [RollupTier(w, c, len(self.fields)) for w, c in tiers]
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def add(self, ts, values):
+        values = np.asarray(values, dtype=np.float64)
+        with self._lock:
+            for tier in self.tiers:
+                tier.add(ts, values)
+            self.version += 1
+
+    def backfill(self, store):
+        """Rebuild every tier from the raw history in one vectorized pass per tier."""
+        window = store.tail()
+        ts = np.asarray(window['ts'])
+        values = np.vstack([np.asarray(window[f]) for f in self.fields])
+        with self._lock:
+            for tier in self.tiers:
+                tier.add_many(ts, values)
+            self.version += 1
+
+    def pick_tier(self, start_ts, end_ts, budget):
+        span = max(end_ts - start_ts, 1.0)
+        for tier in self.tiers:
+            oldest = tier.oldest()
+            covers = oldest is not None and oldest <= start_ts + tier.width
+            if covers and span / tier.width <= budget * _OVERSAMPLE:
+                return tier
+        # ไม่มี tier ไหนครอบคลุมทั้งช่วง: ใช้ tier ที่ละเอียดที่สุดที่ยังอยู่ในงบ
+        for tier in self.tiers:
+            if span / tier.width <= budget * _OVERSAMPLE:
+                return tier
+        return self.tiers[-1]
+
+    def series(self, field, start_ts, end_ts, width_px=None, max_points=CHART_MAX_POINTS):
+        """(ts, value) arrays for a chart, never longer than the point budget."""
+        budget = max_points if width_px is None else min(max_points, 2 * int(width_px))
+        metric = self.fields.index(field)
+        with self._lock:
+            tier = self.pick_tier(start_ts, end_ts, budget)
+            starts, count, lo, hi, mean, last = (np.array(a) for a in tier.select(metric, start_ts, end_ts))
+        if len(starts) * 2 <= budget and tier.width == self.tiers[0].width:
+            return starts, mean
+        return minmax_downsample(starts, lo, hi, budget // 2, width=tier.width)
+
+    def means(self, start_ts, end_ts, width=60):
+        """(bucket starts, {field: mean}) from the tier of the given width, e.g. for what-if replays."""
+        tier = next(t for t in self.tiers if t.width == width)
+        with self._lock:
+            columns = {f: tier.select(i, start_ts, end_ts) for i, f in enumerate(self.fields)}
+            starts = np.array(columns[self.fields[0]][0])
+            return starts, {f: np.array(c[4]) for f, c in columns.items()}
+
+    def chart_frame(self, field, start_ts, end_ts, width_px=None, max_points=CHART_MAX_POINTS,
+                    tz=None, label='Pressure'):
+        ts, values = self.series(field, start_ts, end_ts, width_px, max_points)
+        return _frame(ts, values, tz, label)
+
+
+def raw_chart_frame(store, field, start_ts, end_ts, width_px=None, max_points=CHART_MAX_POINTS,
+                    tz=None, label='Pressure'):
+    """Chart frame straight from a full-resolution HistoryStore (e.g. the ingest file), min/max reduced."""
+    budget = max_points if width_px is None else min(max_points, 2 * int(width_px))
+    view = store.window(start_ts, end_ts)
+    ts, values = np.array(view['ts']), np.array(view[field])
+    if len(ts) > budget:
+        ts, values = minmax_downsample(ts, values, values, budget // 2)
+    return _frame(ts, values, tz, label)
+
+
+def _frame(ts, values, tz, label):
+    import pandas as pd
+
+    index = pd.to_datetime(ts, unit='s', utc=True)
+    if tz is not None:
+        index = index.tz_convert(tz)
+    return pd.DataFrame({label: values}, index=index)
+
+
+# --- Benchmark: ค่าใช้จ่ายต่อ sample และจำนวนจุดต่อกราฟ ---
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(0)
+    n = 30 * 86400
+    t0 = 1_700_000_000.0
+    ts = t0 + np.arange(n, dtype=np.float64)
+    p = 4.0 + 0.2 * np.sin(ts / 3600) + rng.normal(0, 0.02, n)
+    p[n - 2 * 86400] = 9.5   # spike 2 วันก่อน: ต้องยังเห็นในกราฟ 3 วัน
+    values = np.vstack([p, np.full(n, 10.0), np.full(n, 1.5)])
+
+    engine = RollupEngine()
+    start = time.perf_counter()
+    for i in range(100_000):
+        engine.add(ts[i], values[:, i])
+    print(f"incremental add : {(time.perf_counter() - start) / 100_000 * 1e6:8.2f} us/sample (4 tiers)")
+
+    engine = RollupEngine()
+    start = time.perf_counter()
+    for tier in engine.tiers:
+        tier.add_many(ts, values)
+    print(f"backfill 30 days: {time.perf_counter() - start:8.3f} s ({n:,} samples)")
+
+    end_ts = ts[-1]
+    for label, span in (('10 min', 600), ('6 h', 6 * 3600), ('3 days', 3 * 86400), ('30 days', 30 * 86400)):
+        reps = 200
+        start = time.perf_counter()
+        for _ in range(reps):
+            out_t, out_v = engine.series('live_pressure', end_ts - span, end_ts, width_px=1000)
+        cost = (time.perf_counter() - start) / reps
+        tier = engine.pick_tier(end_ts - span, end_ts, 2000)
+        print(f"window {label:<8} : {cost * 1e3:7.2f} ms  tier={int(tier.width):>5}s  "
+              f"points={len(out_t):>5,}  max={out_v.max():.2f}")
@@ -0,0 +1,181 @@
+"""Row-keyed schedule with optimistic concurrency.
+
+Layout under ``valve_system``::
+
+    schedule_rows/<row key> = {START_TIME, TARGET}   # ที่เก็บหลัก แก้ทีละแถว
+    schedule_version        = int                    # เพิ่มทีละ 1 ทุกครั้งที่ Apply
+    schedule                = [{START_TIME, TARGET}, ...]   # array เดิม (เรียงตามเวลา) ให้ controller อ่าน
+
+Apply diffs the edited table against the version it was loaded from and
+builds one multi-path update: the changed rows, the changed indexes of the
+legacy array and ``schedule_version`` + 1. It is written with a single
+transaction on ``valve_system`` that first checks ``schedule_version`` is
+still the loaded version (ScheduleConflict otherwise), so the version never
+moves without its rows: a failure at any point leaves both unchanged.
+The transaction reads the whole node once per Apply (users included); Apply
+is a rare, manual action, and a concurrent telemetry write only causes a retry.
+
+While offline, ``queue_schedule`` puts the same update in the write-ahead
+log, guarded on the loaded version (see write_ahead.py).
+"""
+import math
+
+import pandas as pd
+
+from pushid import push_key
+from state_cache import apply_event
+
+SCHEDULE_FIELDS = ('START_TIME', 'TARGET')
+DEFAULT_ROWS = [{'START_TIME': '00:00', 'TARGET': 0.0}]
+
+
+class ScheduleConflict(Exception):
+    """The schedule was applied by someone else since the editor loaded it."""
+
+    def __init__(self, expected, current):
+        super().__init__(f'schedule version is {current}, editor was based on {expected}')
+        self.expected = expected
+        self.current = current
+
+
+def normalize_row(row):
+    """``{START_TIME, TARGET}`` with canonical types, or None for an empty editor row."""
+    start = row.get('START_TIME')
+    if start is None or (isinstance(start, float) and math.isnan(start)) or not str(start).strip():
+        return None
+    target = row.get('TARGET')
+    try:
+        target = float(target)
+    except (TypeError, ValueError):
+        target = 0.0
+    if math.isnan(target):
+        target = 0.0
+    return {'START_TIME': str(start).strip(), 'TARGET': target}
+
+
+def legacy_list(rows):
+    return sorted(rows.values(), key=lambda r: (r['START_TIME'], r['TARGET']))
+
+
+def load_schedule(state):
+    """What the editor is based on, from a TelemetryCache snapshot.
+
+    Returns a dict with ``version``, ``rows`` (key -> row), ``legacy`` (the
+    array as stored) and ``stored``. ``stored`` is False while only the legacy
+    array exists; the rows then get stable provisional keys and are written
+    out as keyed records on the first Apply.
+    """
+    legacy = state.get('schedule') or []
+    if isinstance(legacy, dict):
+        legacy = list(legacy.values())
+    legacy = [normalize_row(row) for row in legacy if isinstance(row, dict)]
+    stored = state.get('schedule_rows')
+    if isinstance(stored, dict) and stored:
+        rows = {key: normalize_row(row) for key, row in stored.items() if isinstance(row, dict)}
+    else:
+        stored = None
+        rows = {f'row{i:03d}': row for i, row in enumerate(legacy or DEFAULT_ROWS)}
+    return {'version': state.get('schedule_version') or 0, 'rows': {k: r for k, r in rows.items() if r},
+            'legacy': legacy, 'stored': stored is not None}
+
+
+def fingerprint(state):
+    """Cheap key that changes whenever the editor table would change.
+
+    The version alone is not enough: each field has its own listener, so the
+    cache can see the new version a moment before the rows of the same Apply.
+    """
+    rows = state.get('schedule_rows')
+    if isinstance(rows, dict) and rows:
+        return state.get('schedule_version') or 0, tuple(sorted(
+            (key, row.get('START_TIME'), row.get('TARGET')) for key, row in rows.items() if isinstance(row, dict)))
+    return state.get('schedule_version') or 0, repr(state.get('schedule'))
+
+
+def editor_frame(rows):
+    """DataFrame for st.data_editor; the row key lives in a hidden ``key`` column."""
+    ordered = sorted(rows.items(), key=lambda item: (item[1]['START_TIME'], item[0]))
+    return pd.DataFrame([dict(row, key=key) for key, row in ordered], columns=('key',) + SCHEDULE_FIELDS)
+
+
+def load_editor(state):
+    """``(loaded, frame)``: load_schedule() plus the editor DataFrame built from it."""
+    loaded = load_schedule(state)
+    return loaded, editor_frame(loaded['rows'])
+
+
+def diff_rows(base, edited_records):
+    """``(new_rows, upserts, deletes)`` between ``base`` rows and the editor output."""
+    new_rows, upserts = {}, {}
+    for record in edited_records:
+        row = normalize_row(record)
+        if row is None:
+            continue
+        key = record.get('key')
+        if not isinstance(key, str) or not key or key not in base or key in new_rows:
+            key = push_key()   # แถวที่เพิ่มใหม่ (หรือ key ซ้ำจากการคัดลอกแถว)
+        new_rows[key] = row
+        if base.get(key) != row:
+            upserts[key] = row
+    deletes = [key for key in base if key not in new_rows]
+    return new_rows, upserts, deletes
+
+
+def build_update(base, new_rows, upserts, deletes, stored, legacy_before):
+    """Multi-path update relative to ``valve_system`` for one Apply."""
+    update = {}
+    if not stored:
+        upserts = new_rows   # ย้ายจาก array เดิมมาเป็น keyed records ครั้งแรก
+    for key, row in upserts.items():
+        update[f'schedule_rows/{key}'] = row
+    for key in deletes:
+        if stored:
+            update[f'schedule_rows/{key}'] = None
+    legacy_after = legacy_list(new_rows)
+    for i, row in enumerate(legacy_after):
+        if i >= len(legacy_before) or legacy_before[i] != row:
+            update[f'schedule/{i}'] = row
+    for i in range(len(legacy_after), len(legacy_before)):
+        update[f'schedule/{i}'] = None
+    return update
+
+
+def apply_schedule(root_ref, loaded, edited_records):
+    """Apply the editor output on top of ``loaded`` (from load_schedule).
+
+    Returns ``(new_version, update)`` where ``update`` is the multi-path dict
+    that was written together with ``schedule_version`` (empty when nothing
+    changed). Raises ScheduleConflict when ``schedule_version`` moved past the
+    loaded version; nothing is written then.
+    """
+    base_version, base, stored = loaded['version'], loaded['rows'], loaded['stored']
+    new_rows, upserts, deletes = diff_rows(base, edited_records)
+    if stored and not upserts and not deletes:
+        return base_version, {}
+    update = build_update(base, new_rows, upserts, deletes, stored, loaded['legacy'])
+
+    def apply(current):
+        current = current if isinstance(current, dict) else {}
+        version = current.get('schedule_version') or 0
+        if version != base_version:
+            raise ScheduleConflict(base_version, version)
+        return apply_event(current, '/', dict(update, schedule_version=base_version + 1), merge=True)
+
+    root_ref.transaction(apply)
+    return base_version + 1, update
+
+
+def queue_schedule(wal, loaded, edited_records):
+    """Offline Apply: queue the same update in a WriteAheadLog, guarded on the loaded version.
+
+    Returns ``(seq, update)``; seq is None when nothing changed. On replay the
+    update is only sent if ``schedule_version`` is still the loaded version.
+    """
+    base_version, base, stored = loaded['version'], loaded['rows'], loaded['stored']
+    new_rows, upserts, deletes = diff_rows(base, edited_records)
+    if stored and not upserts and not deletes:
+        return None, {}
+    update = build_update(base, new_rows, upserts, deletes, stored, loaded['legacy'])
+    if not update:
+        return None, {}
+    return wal.submit(update, label='schedule', guard=('schedule_version', base_version)), update
@@ -0,0 +1,360 @@
+"""Shared telemetry tier for several dashboard worker processes on one machine.
+
+One worker is elected (an exclusive ``flock`` on ``<path>.lock``, released by
+the kernel when the process dies) and becomes the only process that listens to
+the RTDB. It writes the telemetry snapshot into a memory-mapped file guarded by
+a sequence counter (seqlock) and appends to the shared HistoryStore. The other
+workers read that snapshot without touching Firebase, and decode it again only
+when the counter has moved. They feed their own rollups / detectors from rows
+the leader appended to the history file. When the leader exits, the next worker
+to try the lock takes over within ``poll`` seconds.
+
+Only what the leader's TelemetryCache watches is shared (the dashboard adds
+``command_ack`` so CommandChannel needs no listener of its own); the users
+listener, log queries and log/command writes stay in each worker (see cluster.py).
+
+A single-process deployment simply wins the election and behaves like a plain
+TelemetryCache.
+"""
+import copy
+import fcntl
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from history_store import SAMPLE_FIELDS
+from state_cache import DEFAULT_STATE, TelemetryCache
+
+DEFAULT_PATH = os.environ.get(
+    'VALVE_SHARED_STATE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'shared_state.bin'))
+
+_MAGIC = 0x56414C5653484152  # "VALVSHAR"
+_HEADER_SLOTS = 8            # magic, capacity, seq, length, leader pid, heartbeat ms, ...
+_CAPACITY, _SEQ, _LENGTH, _LEADER, _HEARTBEAT = 1, 2, 3, 4, 5
+_HEADER_BYTES = _HEADER_SLOTS * 8
+
+
+class SharedBuffer:
+    """A JSON document in a memory-mapped file: one writer, any number of reader processes.
+
+    The writer makes ``seq`` odd, writes the payload, then makes it even again;
+    a reader that sees an odd or changed ``seq`` around its copy retries. Each
+    reader keeps the last decoded document and reuses it while ``seq`` is unchanged.
+    One writer means one process (the elected leader) and, inside it, one thread
+    at a time: ``publish`` holds a lock so concurrent callers cannot interleave
+    their seq updates and leave it odd.
+    """
+
+    def __init__(self, path, capacity=1 << 20):
+        self.path = path
+        self.capacity = int(capacity)
+        size = _HEADER_BYTES + self.capacity
+        fresh = not os.path.exists(path) or os.path.getsize(path) != size
+        if fresh:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self._header = np.memmap(path, dtype=np.int64, mode='r+', shape=(_HEADER_SLOTS,))
+        self._payload = np.memmap(path, dtype=np.uint8, mode='r+', offset=_HEADER_BYTES, shape=(self.capacity,))
+        if self._header[0] != _MAGIC or self._header[_CAPACITY] != self.capacity:
+            self._header[:] = 0
+            self._header[_CAPACITY] = self.capacity
+            self._header[0] = _MAGIC
+        self._last = (None, None)   # (seq, document) ที่ decode แล้วล่าสุดใน process นี้
+        self._write_lock = threading.Lock()
+
+    @property
+    def seq(self):
+        return int(self._header[_SEQ])
+
+    def publish(self, document):
+        payload = json.dumps(document, separators=(',', ':'), default=str).encode('utf-8')
+        if len(payload) > self.capacity:
+            raise ValueError(f'shared document is {len(payload)} bytes, capacity {self.capacity}')
+        header = self._header
+        with self._write_lock:
+            seq = int(header[_SEQ])
+            header[_SEQ] = seq + 1   # คี่ = กำลังเขียน
+            self._payload[:len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+            header[_LENGTH] = len(payload)
+            header[_SEQ] = seq + 2
+
+    def read(self, retries=100):
+        """The latest complete document (None before the first publish)."""
+        header = self._header
+        for _ in range(retries):
+            seq = int(header[_SEQ])
+            if seq == self._last[0]:
+                return self._last[1]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            raw = self._payload[:int(header[_LENGTH])].tobytes()
+            if int(header[_SEQ]) != seq:
+                continue   # writer เขียนทับระหว่าง copy
+            document = json.loads(raw) if raw else None
+            self._last = (seq, document)
+            return document
+        return self._last[1]
+
+    def beat(self):
+        self._header[_LEADER] = os.getpid()
+        self._header[_HEARTBEAT] = int(time.time() * 1000)
+
+    def heartbeat_age(self):
+        beat = int(self._header[_HEARTBEAT])
+        return None if not beat else time.time() - beat / 1000.0
+
+    def leader_pid(self):
+        return int(self._header[_LEADER]) or None
+
+
+_HELD = {}                  # lock path -> [fd, owner] ที่ process นี้ถืออยู่
+_HELD_LOCK = threading.Lock()
+
+
+class LeaderElection:
+    """Exclusive, non-blocking ``flock`` on ``path``; the kernel releases it if the holder dies.
+
+    Inside one process the lock is held once; a newer election object for the
+    same path (e.g. after ``st.cache_resource.clear()``) takes it over and the
+    older one stops being leader.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def try_acquire(self):
+        with _HELD_LOCK:
+            held = _HELD.get(self.path)
+            if held is not None:
+                held[1] = self
+                return True
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            _HELD[self.path] = [fd, self]
+            return True
+
+    def is_leader(self):
+        held = _HELD.get(self.path)
+        return held is not None and held[1] is self
+
+    def release(self):
+        with _HELD_LOCK:
+            held = _HELD.get(self.path)
+            if held is None or held[1] is not self:
+                return
+            del _HELD[self.path]
+        fcntl.flock(held[0], fcntl.LOCK_UN)
+        os.close(held[0])
+
+
+class HistoryTail:
+    """Feeds ``consumers(ts, values)`` with rows appended to a HistoryStore by another process."""
+
+    def __init__(self, store, consumers):
+        self.store = store
+        self.consumers = tuple(consumers)
+        self._seen = store.count
+
+    def poll(self):
+        count = self.store.count
+        new = min(count - self._seen, self.store.capacity - 1)
+        self._seen = count
+        if new <= 0:
+            return 0
+        rows = self.store.tail(new)
+        values = np.column_stack([rows[f] for f in SAMPLE_FIELDS])
+        for ts, row in zip(rows['ts'].tolist(), values.tolist()):
+            for consumer in self.consumers:
+                consumer(ts, tuple(row))
+        return new
+
+
+class SharedTelemetry:
+    """TelemetryCache drop-in whose listener runs in exactly one process.
+
+    ``subscribe()`` callbacks run only in the leader (e.g. the history sink, so
+    rows are appended once). ``follow(store, consumers)`` names per-process
+    consumers (rollups, detectors) that followers feed from the shared history
+    file instead.
+    """
+
+    def __init__(self, source_ref, fields=None, path=DEFAULT_PATH, stale_after=15.0, poll=0.5, defaults=None):
+        self.source_ref = source_ref
+        self.fields = fields
+        self.stale_after = stale_after
+        self.poll = poll
+        self.buffer = SharedBuffer(path)
+        self.election = LeaderElection(path + '.lock')
+        self._defaults = copy.deepcopy(defaults if defaults is not None else DEFAULT_STATE)
+        self._subscribers = []
+        self._on_poll = []
+        self._follow = None
+        self._tail = None
+        self._cache = None
+        self._published = None
+        self._publish_lock = threading.Lock()   # listener thread ทุก field + poll thread เรียก _publish พร้อมกันได้
+        self._stop = threading.Event()
+        self._thread = None
+        self.elections_won = 0
+
+    def subscribe(self, callback):
+        """Register ``callback(path, state)``; called in the leader process only."""
+        self._subscribers.append(callback)
+        cache = self._cache
+        if cache is not None:
+            cache.subscribe(callback)   # เป็น leader อยู่แล้ว: ต่อเข้า listener ที่รันอยู่เลย
+
+    def follow(self, store, consumers):
+        self._follow = (store, tuple(consumers))
+
+    def on_poll(self, callback):
+        """Register ``callback()`` to run every ``poll`` seconds in every process (leader or not)."""
+        self._on_poll.append(callback)
+
+    # --- lifecycle ---
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._step()   # ลองเป็น leader ทันที: process เดียวได้ข้อมูลจริงตั้งแต่ snapshot แรก
+        self._thread = threading.Thread(target=self._run, name='shared-telemetry', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        cache, self._cache = self._cache, None
+        if cache is not None:
+            cache.stop()
+        self.election.release()
+
+    def _run(self):
+        while not self._stop.wait(self.poll):
+            try:
+                self._step()
+            except Exception:
+                pass   # ลองใหม่รอบหน้า; snapshot ยังคืนค่าล่าสุดที่มี
+            for callback in self._on_poll:
+                try:
+                    callback()
+                except Exception:
+                    pass
+
+    def _step(self):
+        if self._cache is not None:
+            if not self.election.is_leader():
+                self.stop()   # instance ใหม่ใน process เดียวกันรับช่วงไปแล้ว
+                return
+            self._cache.ensure_fresh()
+            self._publish()
+            return
+        if self.election.try_acquire():
+            self._lead()
+        elif self._follow is not None:
+            if self._tail is None:
+                self._tail = HistoryTail(*self._follow)
+            self._tail.poll()
+
+    def _lead(self):
+        self.elections_won += 1
+        self._tail = None
+        cache = TelemetryCache(self.source_ref, fields=self.fields, stale_after=self.stale_after,
+                               defaults=self._defaults)
+        for callback in self._subscribers:
+            cache.subscribe(callback)
+        cache.subscribe(lambda path, state: self._publish())
+        self._cache = cache
+        cache.start()
+        self._publish()
+
+    def _publish(self):
+        cache = self._cache
+        if cache is None:
+            return
+        with self._publish_lock:
+            self.buffer.beat()
+            key = (cache.version, cache.is_online())
+            if key == self._published:
+                return
+            data = cache.snapshot()
+            self.buffer.publish({'state': {k: v for k, v in data.items() if k not in ('updated_at', 'age', 'online')},
+                                 'updated_at': data['updated_at'], 'online': data['online']})
+            self._published = key
+
+    # --- read side (same interface as TelemetryCache) ---
+    def is_leader(self):
+        return self._cache is not None
+
+    def snapshot(self):
+        cache = self._cache
+        if cache is not None:
+            return cache.snapshot()
+        document = self.buffer.read() or {}
+        data = dict(self._defaults)
+        data.update(document.get('state') or {})
+        updated_at = document.get('updated_at')
+        age = None if updated_at is None else time.time() - updated_at
+        beat = self.buffer.heartbeat_age()
+        data['updated_at'] = updated_at
+        data['age'] = age
+        # leader ที่หยุดส่ง heartbeat (ตาย/ค้าง) = ออฟไลน์ จนกว่า worker อื่นจะรับช่วง
+        data['online'] = (bool(document.get('online')) and age is not None and age < self.stale_after
+                          and beat is not None and beat < self.stale_after)
+        return data
+
+    def get(self, key, default=None):
+        cache = self._cache
+        if cache is not None:
+            return cache.get(key, default)
+        return copy.deepcopy(((self.buffer.read() or {}).get('state') or {}).get(key, default))
+
+    def age(self):
+        return self.snapshot()['age']
+
+    def is_online(self):
+        cache = self._cache
+        return cache.is_online() if cache is not None else self.snapshot()['online']
+
+
+# --- Benchmark: ต้นทุนการอ่าน snapshot ของ follower เทียบกับ leader ---
+if __name__ == '__main__':
+    import tempfile
+    from fake_rtdb import FakeDatabase
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'shared.bin')
+        database = FakeDatabase({'valve_system': {
+            'live_pressure': 3.9, 'valve_rotation': 12.0, 'motor_load': 1.4, 'auto_mode': True,
+            'schedule_rows': {f'row{i:03d}': {'START_TIME': f'{i:02d}:00', 'TARGET': 3.5} for i in range(24)}}})
+        root = database.reference('valve_system')
+        leader = SharedTelemetry(root, fields=('live_pressure', 'valve_rotation', 'motor_load', 'auto_mode',
+                                               'schedule_rows'), path=path).start()
+        follower = SharedTelemetry(root, path=path)   # ไม่ start: อ่านอย่างเดียวเหมือน worker อื่น
+        n = 100_000
+        for label, source in (('leader snapshot()', leader), ('follower snapshot(), unchanged', follower)):
+            source.snapshot()
+            t0 = time.perf_counter()
+            for _ in range(n):
+                source.snapshot()
+            print(f"{label:<34} {(time.perf_counter() - t0) / n * 1e6:7.2f} us")
+        t0 = time.perf_counter()
+        for i in range(2000):
+            root.update({'live_pressure': 3.0 + i * 1e-4})
+            follower.snapshot()
+        print(f"{'publish + follower re-decode':<34} {(time.perf_counter() - t0) / 2000 * 1e6:7.2f} us")
+        print('follower sees', follower.snapshot()['live_pressure'], 'online', follower.snapshot()['online'],
+              f"document {leader.buffer._header[_LENGTH]} bytes")
+        leader.stop()
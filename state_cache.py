@@ -0,0 +1,273 @@
+import copy
+import threading
+import time
+
+# ค่าเริ่มต้นก่อนได้รับข้อมูลชุดแรกจาก Firebase
+DEFAULT_STATE = {
+    'live_pressure': 0.0, 'valve_rotation': 0.0, 'auto_mode': True,
+    'motor_load': 0.0, 'schedule': [],
+}
+
+# เฉพาะ field ที่ dashboard ใช้ ไม่ดึง valve_system/users มาด้วย
+TELEMETRY_FIELDS = ('live_pressure', 'valve_rotation', 'motor_load', 'auto_mode', 'schedule',
+                    'schedule_rows', 'schedule_version')
+
+
+def _close_quietly(registration):
+    try:
+        registration.close()
+    except Exception:
+        pass
+
+
+def _split_path(path):
+    return [p for p in (path or '/').split('/') if p]
+
+
+def _as_list(node):
+    # RTDB แปลง object ที่ key เป็นเลขเรียงกันกลับเป็น array เหมือนฝั่ง server
+    if isinstance(node, dict) and node and all(k.isdigit() for k in node):
+        idx = sorted(int(k) for k in node)
+        if idx == list(range(len(idx))):
+            return [node[str(i)] for i in idx]
+    return node
+
+
+def apply_event(tree, path, data, merge=False):
+    """Apply one RTDB stream event ('put' or 'patch') to a nested dict in place.
+
+    Returns the (possibly replaced) root so a put at '/' can swap the whole tree.
+    """
+    keys = _split_path(path)
+    if not keys:
+        if merge:
+            root = tree if isinstance(tree, dict) else {}
+            for k, v in (data or {}).items():
+                if '/' in k:
+                    root = apply_event(root, k, v)   # multi-path update เช่น {'v01/live_pressure': ...}
+                elif v is None:
+                    root.pop(k, None)
+                else:
+                    root[k] = v
+            return root
+        return data if isinstance(data, dict) else {}
+
+    if not isinstance(tree, dict):
+        tree = {}
+    node = tree
+    converted = []
+    for k in keys[:-1]:
+        child = node.get(k)
+        if not isinstance(child, dict):
+            # RTDB ส่ง array มาเป็น list แต่ patch อ้างอิงด้วย index แบบ string
+            if isinstance(child, list):
+                child = {str(i): v for i, v in enumerate(child)}
+                converted.append((node, k))
+            else:
+                child = {}
+            node[k] = child
+        node = child
+
+    last = keys[-1]
+    if merge:
+        target = node.get(last)
+        if not isinstance(target, dict):
+            target = {}
+        node[last] = apply_event(target, '/', data, merge=True)
+    elif data is None:
+        node.pop(last, None)
+    else:
+        node[last] = data
+    for parent, k in reversed(converted):
+        parent[k] = _as_list(parent[k])
+    return tree
+
+
+class TelemetryCache:
+    """Process-wide snapshot of a RTDB node kept current by streaming listeners.
+
+    Every Streamlit session reads from the same in-memory copy, so the number of
+    RTDB reads does not depend on how many browsers are open. With ``fields`` set,
+    one listener is opened per child instead of one on the whole node, so sibling
+    subtrees (e.g. ``users``) are never transferred.
+    """
+
+    def __init__(self, source_ref, fields=None, stale_after=15.0, defaults=None):
+        self.source_ref = source_ref
+        self.fields = tuple(fields) if fields else None
+        self.stale_after = stale_after
+        self._defaults = copy.deepcopy(defaults if defaults is not None else DEFAULT_STATE)
+        self._state = {}
+        self._lock = threading.Lock()
+        self._restart_lock = threading.Lock()
+        self._registrations = []
+        self._started_at = 0.0
+        self._last_event = None   # time.time() ของ event ล่าสุดจาก listener
+        self._last_error = None
+        self._subscribers = []
+        self.version = 0
+
+    def subscribe(self, callback, with_event=False):
+        """Register ``callback(path, state)`` to run after every applied event.
+
+        With ``with_event`` it is called as ``callback(path, state, event)`` and
+        can tell a root 'put' (load / reconnect replay) from a multi-path 'patch'.
+        """
+        self._subscribers.append((callback, with_event))
+
+    # --- listener lifecycle ---
+    def start(self):
+        with self._lock:
+            if self._registrations:
+                return
+            self._started_at = time.time()
+        registrations = []
+        try:
+            if self.fields is None:
+                registrations.append(self.source_ref.listen(self._on_event))
+            else:
+                for field in self.fields:
+                    registrations.append(
+                        self.source_ref.child(field).listen(self._field_callback(field)))
+        except Exception as e:
+            self._last_error = e
+            for registration in registrations:
+                _close_quietly(registration)
+            return
+        with self._lock:
+            self._registrations = registrations
+
+    def stop(self):
+        with self._lock:
+            registrations, self._registrations = self._registrations, []
+        for registration in registrations:
+            _close_quietly(registration)
+
+    def _listener_alive(self):
+        registrations = self._registrations
+        if not registrations:
+            return False
+        for registration in registrations:
+            thread = getattr(registration, '_thread', None)
+            if thread is not None and not thread.is_alive():
+                return False
+        return True
+
+    def ensure_fresh(self):
+        """Restart the stream if it died or has been quiet longer than stale_after.
+
+        A fresh connection replays the full node as its first 'put', so this also
+        acts as a heartbeat resync; it costs one read per process, not per session.
+        """
+        if time.time() - self._started_at < self.stale_after:
+            return  # ให้เวลา listener ที่เพิ่งเริ่มส่ง event แรก
+        age = self.age()
+        if self._listener_alive() and age is not None and age < self.stale_after:
+            return
+        if not self._restart_lock.acquire(blocking=False):
+            return  # session อื่นกำลัง restart อยู่
+        try:
+            self.stop()
+            self.start()
+        finally:
+            self._restart_lock.release()
+
+    def _field_callback(self, field):
+        def callback(event):
+            self._on_event(event, prefix='/' + field)
+        return callback
+
+    def _on_event(self, event, prefix=''):
+        try:
+            merge = event.event_type == 'patch'
+            path = prefix + (event.path if event.path != '/' else '')
+            with self._lock:
+                self._state = apply_event(self._state, path or '/', event.data, merge=merge)
+                self._last_event = time.time()
+                self.version += 1
+                state = dict(self._state)
+        except Exception as e:
+            self._last_error = e
+            return
+        for callback, with_event in self._subscribers:
+            try:
+                if with_event:
+                    callback(path or '/', state, event)
+                else:
+                    callback(path or '/', state)
+            except Exception as e:
+                self._last_error = e
+
+    # --- read side ---
+    def get(self, key, default=None):
+        """One top-level child of the cached node (no defaults or metadata merged in)."""
+        with self._lock:
+            return copy.deepcopy(self._state.get(key, default))
+
+    def age(self):
+        last = self._last_event
+        return None if last is None else time.time() - last
+
+    def is_online(self):
+        age = self.age()
+        return self._listener_alive() and age is not None and age < self.stale_after
+
+    def snapshot(self):
+        self.ensure_fresh()
+        with self._lock:
+            data = dict(self._defaults)
+            data.update(self._state)
+            data['updated_at'] = self._last_event
+        data['age'] = self.age()
+        data['online'] = self.is_online()
+        return data
+
+
+# --- Payload measurement: full-node poll vs field-scoped stream ---
+def measure_refresh_bytes(n_users, n_schedule=6, window=60.0, refresh=5.0, sensor_interval=1.0, stale_after=15.0):
+    """RTDB bytes per ``window`` seconds before and after scoping, read from FakeDatabase counters.
+
+    ``before`` is one session polling the whole node every ``refresh`` seconds.
+    The two ``after`` figures are for one process however many sessions it
+    serves: one event per sensor write every ``sensor_interval`` seconds, or,
+    while the sensors are steady, the reconnect ``ensure_fresh`` makes every
+    ``stale_after`` seconds (a replay of every watched field).
+    Returns ``(before, after_changing, after_steady, startup)``.
+    """
+    from fake_rtdb import FakeDatabase
+
+    schedule = [{'START_TIME': f'{h:02d}:00', 'TARGET': 3.5} for h in range(n_schedule)]
+    database = FakeDatabase({'valve_system': {
+        'live_pressure': 3.87, 'valve_rotation': 12.5, 'motor_load': 1.8,
+        'auto_mode': True, 'command': 'OPEN', 'last_command_time': '2024-01-01 00:00:00',
+        'schedule': schedule, 'schedule_rows': {f'row{i:03d}': row for i, row in enumerate(schedule)},
+        'schedule_version': 1,
+        'users': {f'user{i:05d}': {'password': 'x' * 12, 'role': 'user'} for i in range(n_users)},
+    }})
+    root = database.reference('valve_system')
+
+    def bytes_read(action):
+        start = database.stats()['bytes_read']
+        action()
+        return database.stats()['bytes_read'] - start
+
+    poll = bytes_read(root.get)
+    cache = TelemetryCache(root, fields=TELEMETRY_FIELDS, stale_after=stale_after)
+    startup = bytes_read(cache.start)
+    sample = bytes_read(lambda: root.update({'live_pressure': 3.91, 'valve_rotation': 12.6, 'motor_load': 1.81}))
+    # ค่านิ่งไม่มี event: ย้อนเวลา event ล่าสุดให้เกิน stale_after แล้วให้ ensure_fresh ต่อ listener ใหม่จริง
+    cache._started_at -= stale_after
+    cache._last_event -= stale_after
+    resync = bytes_read(cache.ensure_fresh)
+    cache.stop()
+    return (round(poll * window / refresh), round(sample * window / sensor_interval),
+            round(resync * window / stale_after), startup)
+
+
+if __name__ == '__main__':
+    # before: ต่อ session / after: ต่อ process (ทุก session ใช้ร่วมกัน) ไบต์ต่อนาทีจากตัวนับของ FakeDatabase
+    print(f"{'users':>8} {'before B/min/session':>21} {'after B/min (1 Hz)':>19} "
+          f"{'after B/min (steady)':>21} {'startup B':>10}")
+    for n in (1, 10, 100, 1000, 10000):
+        before, changing, steady, startup = measure_refresh_bytes(n)
+        print(f"{n:>8} {before:>21,} {changing:>19,} {steady:>21,} {startup:>10,}")
@@ -0,0 +1,68 @@
+import os
+import time
+
+from command_channel import SENDING, SUPERSEDED, CommandChannel
+from fake_rtdb import FakeDatabase
+
+
+def _wait(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.001)
+    assert predicate()
+
+
+def test_stop_preempts_an_open_that_is_still_retrying():
+    database = FakeDatabase({'valve_system': {'command': 'CLOSE'}})
+    database.fail = True
+    channel = CommandChannel(database.reference('valve_system'), send_retries=10)
+    channel.start()
+    try:
+        opened = channel.submit('OPEN', 'operator')
+        _wait(lambda: opened.status == SENDING and opened.error is not None)
+        stop = channel.submit('STOP', 'operator')
+        database.fail = False
+        _wait(lambda: stop.sent_at is not None)
+        # backoff ของ OPEN รอบแรกคือ 0.2 s: STOP ต้องออกไปก่อนหมด backoff
+        assert stop.sent_at - stop.submitted_at < 0.15
+        assert opened.status == SUPERSEDED and opened.sent_at is None
+        assert database.snapshot('valve_system/command') == 'STOP'
+        assert database.snapshot('valve_system/emergency') is True
+    finally:
+        channel.stop()
+
+
+def test_follower_workers_get_acks_through_the_shared_tier(tmp_path):
+    from command_channel import ACKED, SimulatedController
+    from shared_state import SharedTelemetry
+
+    database = FakeDatabase({'valve_system': {'live_pressure': 3.9, 'command': 'CLOSE'}})
+    root = database.reference('valve_system')
+    controller = SimulatedController(root, delay=0.01).start()
+    path = os.path.join(tmp_path, 'shared.bin')
+    fields = ('live_pressure', 'command_ack')
+    # worker ละ process: ใน process เดียวกัน instance ใหม่จะรับช่วง leader จึง start เฉพาะ leader
+    # และเรียก on_poll ของ follower เองแทน poll thread
+    leader = SharedTelemetry(root, fields=fields, path=path).start()
+    workers = [leader] + [SharedTelemetry(root, fields=fields, path=path) for _ in range(2)]
+    channels, polls = [], []
+    try:
+        for cache in workers:
+            channel = CommandChannel(root, listen=False)
+            channel.start()
+            cache.subscribe(lambda path, state, channel=channel: channel.ack(state.get('command_ack'))
+                            if path.strip('/').split('/')[0] == 'command_ack' else None)
+            polls.append(lambda cache=cache, channel=channel: channel.ack(cache.get('command_ack')))
+            channels.append(channel)
+        assert [cache.is_leader() for cache in workers] == [True, False, False]
+        listens = database.stats()['calls']['listen']
+        for i, channel in enumerate(channels):
+            state = channel.submit('OPEN', 'operator')
+            _wait(lambda: (i and polls[i]()) or state.status == ACKED)   # poll คืน None
+        # leader ได้ ack ทันทีจาก listener ของ state cache; follower ไม่เปิด listener ของตัวเอง
+        assert database.stats()['calls']['listen'] == listens
+    finally:
+        for channel in channels:
+            channel.stop()
+        leader.stop()
+        controller.stop()
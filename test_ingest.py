@@ -0,0 +1,34 @@
+import os
+import time
+
+from fake_rtdb import FakeDatabase
+from history_store import HistoryStore, open_existing
+from ingest import IngestGateway
+
+SAMPLE = {'live_pressure': 3.9, 'valve_rotation': 12.0, 'motor_load': 1.4}
+
+
+def test_future_stamped_sample_does_not_make_later_samples_late(tmp_path):
+    database = FakeDatabase({'valve_system': {}})
+    store = HistoryStore(os.path.join(tmp_path, 'raw.bin'), capacity=1000, resolution=0.0)
+    gateway = IngestGateway(database.reference('valve_system'), store)
+    now = time.time()
+    gateway._pending.append((now + 4.0, dict(SAMPLE)))   # นาฬิกา controller เร็วไป 4 วินาที
+    gateway._drain()
+    for i in range(1, 4):
+        time.sleep(0.01)
+        gateway._pending.append((time.time(), dict(SAMPLE, live_pressure=3.9 + i / 10)))
+        gateway._drain()
+    assert gateway.counters['late'] == 0 and gateway.counters['clamped'] == 1
+    assert gateway.counters['stored'] == 4
+    assert store.last_ts() <= time.time()
+
+
+def test_open_existing_uses_the_writer_capacity(tmp_path):
+    path = os.path.join(tmp_path, 'raw.bin')
+    assert open_existing(path) is None
+    writer = HistoryStore(path, capacity=123, resolution=0.0)
+    writer.append_many([1.0, 1.5, 2.0], [3.0, 3.1, 3.2], [10.0] * 3, [1.4] * 3)
+    reader = open_existing(path)
+    assert (reader.capacity, reader.resolution, reader.count) == (123, 0.0, 3)
+    assert list(reader.window(1.2, 2.0)['live_pressure']) == [3.1, 3.2]
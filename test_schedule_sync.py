@@ -0,0 +1,108 @@
+import pytest
+
+import fake_rtdb
+from fake_rtdb import FakeDatabase
+from schedule_sync import ScheduleConflict, apply_schedule, load_schedule
+
+
+def _database():
+    return FakeDatabase({'valve_system': {
+        'live_pressure': 3.9, 'users': {'admin': {'role': 'super_admin'}},
+        'schedule': [{'START_TIME': '06:00', 'TARGET': 3.5}, {'START_TIME': '18:00', 'TARGET': 4.0}],
+        'schedule_rows': {'a': {'START_TIME': '06:00', 'TARGET': 3.5}, 'b': {'START_TIME': '18:00', 'TARGET': 4.0}},
+        'schedule_version': 7,
+    }})
+
+
+def _edit(loaded, key, target):
+    return [dict(row, key=k, TARGET=target if k == key else row['TARGET']) for k, row in loaded['rows'].items()]
+
+
+def test_apply_writes_rows_legacy_and_version_together():
+    database = _database()
+    root = database.reference('valve_system')
+    loaded = load_schedule(database.snapshot('valve_system'))
+    version, update = apply_schedule(root, loaded, _edit(loaded, 'b', 4.5))
+    state = database.snapshot('valve_system')
+    assert version == 8 and state['schedule_version'] == 8
+    assert update == {'schedule_rows/b': {'START_TIME': '18:00', 'TARGET': 4.5},
+                      'schedule/1': {'START_TIME': '18:00', 'TARGET': 4.5}}
+    assert state['schedule_rows']['b']['TARGET'] == 4.5
+    assert state['schedule'] == [{'START_TIME': '06:00', 'TARGET': 3.5}, {'START_TIME': '18:00', 'TARGET': 4.5}]
+    assert state['users'] == {'admin': {'role': 'super_admin'}}
+
+
+def test_second_editor_on_the_same_version_conflicts_and_writes_nothing():
+    database = _database()
+    root = database.reference('valve_system')
+    first = load_schedule(database.snapshot('valve_system'))
+    second = load_schedule(database.snapshot('valve_system'))
+    apply_schedule(root, first, _edit(first, 'a', 3.0))
+    after_first = database.snapshot('valve_system')
+    with pytest.raises(ScheduleConflict) as conflict:
+        apply_schedule(root, second, _edit(second, 'b', 5.0))
+    assert (conflict.value.expected, conflict.value.current) == (7, 8)
+    assert database.snapshot('valve_system') == after_first
+
+
+def test_failed_write_leaves_version_and_rows_unchanged(monkeypatch):
+    database = _database()
+    root = database.reference('valve_system')
+    before = database.snapshot('valve_system')
+    loaded = load_schedule(before)
+
+    def offline(self, expected_etag, value):
+        raise ConnectionError('connection lost during Apply')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(fake_rtdb.FakeReference, 'set_if_unchanged', offline)
+        with pytest.raises(ConnectionError):
+            apply_schedule(root, loaded, _edit(loaded, 'a', 2.0))
+    assert database.snapshot('valve_system') == before
+    # version ไม่ขยับ: Apply เดิม (หรือของ editor อื่นที่โหลด version เดียวกัน) ส่งซ้ำได้โดยไม่ conflict
+    assert apply_schedule(root, loaded, _edit(loaded, 'a', 2.0))[0] == 8
+    assert database.snapshot('valve_system/schedule_rows/a/TARGET') == 2.0
+
+
+def test_concurrent_telemetry_write_retries_without_losing_it(monkeypatch):
+    database = _database()
+    root = database.reference('valve_system')
+    loaded = load_schedule(database.snapshot('valve_system'))
+    original = fake_rtdb.FakeReference.set_if_unchanged
+    raced = []
+
+    def racing(self, expected_etag, value):
+        if not raced:
+            raced.append(True)
+            root.update({'live_pressure': 4.2})   # controller เขียนระหว่าง read กับ write ของ transaction
+        return original(self, expected_etag, value)
+
+    monkeypatch.setattr(fake_rtdb.FakeReference, 'set_if_unchanged', racing)
+    apply_schedule(root, loaded, _edit(loaded, 'a', 3.1))
+    state = database.snapshot('valve_system')
+    assert state['live_pressure'] == 4.2
+    assert state['schedule_rows']['a']['TARGET'] == 3.1 and state['schedule_version'] == 8
+
+
+def test_connection_lost_after_the_first_write_never_moves_the_version_alone(monkeypatch):
+    database = _database()
+    root = database.reference('valve_system')
+    loaded = load_schedule(database.snapshot('valve_system'))
+    original = FakeDatabase._count
+    writes = []
+
+    def drop_after_first_write(self, op, nbytes=0):
+        if op in fake_rtdb.WRITE_OPS:
+            if writes:
+                raise ConnectionError('connection lost')
+            writes.append(op)
+        return original(self, op, nbytes)
+
+    monkeypatch.setattr(FakeDatabase, '_count', drop_after_first_write)
+    try:
+        apply_schedule(root, loaded, _edit(loaded, 'b', 4.8))
+    except ConnectionError:
+        pass
+    state = database.snapshot('valve_system')
+    assert (state['schedule_version'] == 8) == (state['schedule_rows']['b']['TARGET'] == 4.8)
+    assert (state['schedule_version'] == 8) == (state['schedule'][1]['TARGET'] == 4.8)
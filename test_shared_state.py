@@ -0,0 +1,61 @@
+import os
+import threading
+
+from fake_rtdb import FakeDatabase
+from shared_state import SharedBuffer, SharedTelemetry
+
+
+def test_concurrent_publishers_keep_the_seqlock_consistent(tmp_path):
+    buffer = SharedBuffer(os.path.join(tmp_path, 'shared.bin'))
+    reader = SharedBuffer(buffer.path)
+    writers, per_writer = 3, 5000
+    torn = []
+    done = threading.Event()
+
+    def publish(k):
+        for i in range(per_writer):
+            buffer.publish({'k': k, 'i': i, 'check': k * 1_000_003 + i})
+
+    def read():
+        while not done.is_set():
+            document = reader.read()
+            if document is not None and document['check'] != document['k'] * 1_000_003 + document['i']:
+                torn.append(document)
+
+    threads = [threading.Thread(target=publish, args=(k,)) for k in range(writers)]
+    watcher = threading.Thread(target=read)
+    watcher.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    watcher.join()
+    assert buffer.seq == 2 * writers * per_writer   # ไม่มี increment หาย และไม่ค้างเป็นเลขคี่
+    assert torn == []
+    assert reader.read()['i'] == per_writer - 1
+
+
+def test_listener_threads_publish_through_one_writer(tmp_path):
+    fields = ('live_pressure', 'valve_rotation', 'motor_load')
+    database = FakeDatabase({'valve_system': {field: 0.0 for field in fields}})
+    root = database.reference('valve_system')
+    path = os.path.join(tmp_path, 'shared.bin')
+    leader = SharedTelemetry(root, fields=fields, path=path, poll=0.01).start()
+    follower = SharedTelemetry(root, fields=fields, path=path)
+    try:
+        def write(field):
+            for i in range(500):
+                root.update({field: float(i)})
+
+        threads = [threading.Thread(target=write, args=(field,)) for field in fields]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        leader._publish()
+        assert leader.buffer.seq % 2 == 0
+        snapshot = follower.snapshot()
+        assert [snapshot[field] for field in fields] == [499.0] * 3
+    finally:
+        leader.stop()
@@ -0,0 +1,59 @@
+import os
+import time
+
+import pytest
+
+from fake_rtdb import FakeDatabase
+from write_ahead import WriteAheadLog
+
+
+def _offline_wal(tmp_path, drops):
+    database = FakeDatabase({'valve_system': {'command': 'CLOSE', 'auto_mode': True}})
+    database.fail = True
+    wal = WriteAheadLog(database.reference('valve_system'), path=os.path.join(tmp_path, 'control.wal'),
+                        on_drop=lambda record, reason: drops.append((record['s'], reason)))
+    wal._file = open(wal.path, 'a', encoding='utf-8')   # ไม่ start worker: เรียก replay เอง
+    return database, wal
+
+
+def test_expired_records_are_dropped_once_while_offline(tmp_path):
+    drops = []
+    database, wal = _offline_wal(tmp_path, drops)
+    stale = [wal.submit({'command': c}, label='manual', ttl=-1) for c in ('OPEN', 'CLOSE', 'OPEN')]
+    wal.submit({'auto_mode': False})
+    for _ in range(20):
+        with pytest.raises(ConnectionError):
+            wal.replay()
+    assert sorted(drops) == [(seq, 'expired') for seq in stale]
+    assert wal.stats()['expired'] == 3
+    assert len(wal) == 1
+
+    # tombstone อยู่ในไฟล์: process ใหม่ไม่แจ้ง drop ซ้ำ และส่งเฉพาะรายการที่ยังไม่หมดอายุ
+    wal._file.close()
+    database.fail = False
+    restarted = []
+    wal = WriteAheadLog(database.reference('valve_system'), path=wal.path,
+                        on_drop=lambda record, reason: restarted.append(record['s'])).start()
+    deadline = time.time() + 5
+    while len(wal) and time.time() < deadline:
+        time.sleep(0.01)
+    wal.stop()
+    assert restarted == []
+    assert database.snapshot('valve_system') == {'command': 'CLOSE', 'auto_mode': False}
+
+
+def test_superseded_paths_are_counted_once(tmp_path):
+    drops = []
+    database, wal = _offline_wal(tmp_path, drops)
+    for i in range(5):
+        wal.submit({'auto_mode': i % 2 == 0})
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            wal.replay()
+    assert wal.stats()['superseded'] == 4
+    assert wal.overlay() == {'auto_mode': True}
+    database.fail = False
+    wal.replay()
+    assert len(wal) == 0 and drops == []
+    assert database.snapshot('valve_system/auto_mode') is True
+    wal._file.close()
@@ -0,0 +1,197 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import deque
+
+from state_cache import TelemetryCache
+
+# จำนวนรอบของ PBKDF2 ปรับได้ผ่าน env; ค่าเก่ากว่าจะถูก rehash ตอน login สำเร็จ
+KDF_ITERATIONS = int(os.environ.get('VALVE_KDF_ITERATIONS', 240_000))
+_ALGORITHM = 'pbkdf2_sha256'
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode('ascii')
+
+
+def hash_password(password, iterations=None, salt=None):
+    """Salted PBKDF2-SHA256 hash as ``pbkdf2_sha256$<iterations>$<salt>$<hash>``."""
+    iterations = iterations or KDF_ITERATIONS
+    salt = salt if salt is not None else secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f'{_ALGORITHM}${iterations}${_b64(salt)}${_b64(digest)}'
+
+
+def verify_password(record, password, iterations=None):
+    """Return ``(ok, needs_rehash)`` for a user record from ``valve_system/users``.
+
+    Records created before hashing still carry a plaintext ``password``; they
+    verify with a constant-time compare and always need a rehash.
+    """
+    iterations = iterations or KDF_ITERATIONS
+    stored = record.get('password_hash') if isinstance(record, dict) else None
+    if not stored:
+        legacy = record.get('password') if isinstance(record, dict) else None
+        if not isinstance(legacy, str):
+            return False, False
+        return hmac.compare_digest(legacy.encode('utf-8'), password.encode('utf-8')), True
+    try:
+        algorithm, rounds, salt, digest = stored.split('$')
+        rounds = int(rounds)
+        salt, digest = base64.b64decode(salt), base64.b64decode(digest)
+    except ValueError:
+        return False, False
+    if algorithm != _ALGORITHM:
+        return False, False
+    candidate = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, rounds)
+    return hmac.compare_digest(candidate, digest), rounds < iterations
+
+
+class LoginRateLimiter:
+    """Per-username sliding window of failed logins.
+
+    After ``max_failures`` failures inside ``window`` seconds further attempts
+    for that username are refused (without hashing or touching the RTDB) until
+    the oldest failure leaves the window.
+    """
+
+    def __init__(self, max_failures=5, window=60.0, max_tracked=10000):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_tracked = max_tracked
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def retry_after(self, username):
+        now = time.time()
+        with self._lock:
+            failures = self._failures.get(username)
+            if not failures:
+                return 0.0
+            while failures and now - failures[0] >= self.window:
+                failures.popleft()
+            if len(failures) < self.max_failures:
+                return 0.0
+            return self.window - (now - failures[0])
+
+    def failure(self, username):
+        now = time.time()
+        with self._lock:
+            if username not in self._failures and len(self._failures) >= self.max_tracked:
+                self._prune(now)
+            failures = self._failures.setdefault(username, deque(maxlen=self.max_failures))
+            failures.append(now)
+
+    def success(self, username):
+        with self._lock:
+            self._failures.pop(username, None)
+
+    def _prune(self, now):
+        # ลบ username ที่ไม่มีความผิดพลาดในช่วง window แล้ว ไม่ให้ dict โตไม่จำกัด
+        for name in [n for n, f in self._failures.items() if not f or now - f[-1] >= self.window]:
+            del self._failures[name]
+
+
+class UserDirectory:
+    """Process-wide, listener-backed copy of ``valve_system/users`` for logins.
+
+    The node is loaded once and kept current by a stream listener, so a login
+    click costs no RTDB read. ``ttl`` bounds how long the copy may go without
+    an event before the listener is reopened (which replays the node once).
+    """
+
+    def __init__(self, user_ref, ttl=300.0, limiter=None, iterations=None, load_timeout=3.0):
+        self.user_ref = user_ref
+        self.iterations = iterations or KDF_ITERATIONS
+        self.load_timeout = load_timeout
+        self.limiter = limiter or LoginRateLimiter()
+        self._cache = TelemetryCache(user_ref, stale_after=ttl, defaults={})
+        # ใช้เทียบเวลาเมื่อไม่มี username นี้ ไม่ให้เดาชื่อผู้ใช้จากเวลาตอบกลับได้
+        self._dummy = {'password_hash': hash_password('', self.iterations)}
+
+    def start(self):
+        self._cache.start()
+        return self
+
+    def stop(self):
+        self._cache.stop()
+
+    def ensure_default_admin(self, username='admin', password='papak123', role='super_admin'):
+        """Seed the first super admin (hashed) when the users node is empty."""
+        if self.user_ref.get(shallow=True) is None:
+            self.user_ref.child(username).set({'password_hash': hash_password(password, self.iterations),
+                                               'role': role})
+
+    def lookup(self, username):
+        self._cache.ensure_fresh()
+        deadline = time.time() + self.load_timeout
+        while self._cache.age() is None and time.time() < deadline:
+            time.sleep(0.05)   # รอ event แรกของ listener หลัง start
+        if self._cache.age() is None:
+            try:
+                return self.user_ref.child(username).get()   # listener ใช้ไม่ได้: อ่านตรงเฉพาะคนนี้
+            except ValueError:
+                return None   # ชื่อมีอักขระที่ใช้เป็น path ของ RTDB ไม่ได้
+        return self._cache.get(username)
+
+    def authenticate(self, username, password):
+        """Return ``(user, retry_after)``.
+
+        ``user`` is the record without secrets (e.g. ``{'role': ...}``) or None;
+        ``retry_after`` > 0 means the username is rate limited right now.
+        """
+        wait = self.limiter.retry_after(username)
+        if wait > 0:
+            return None, wait
+        record = self.lookup(username) if username else None
+        ok, needs_rehash = verify_password(record if isinstance(record, dict) else self._dummy,
+                                           password, self.iterations)
+        if not ok or not isinstance(record, dict):
+            self.limiter.failure(username)
+            return None, 0.0
+        self.limiter.success(username)
+        if needs_rehash:
+            try:
+                self.user_ref.child(username).update({
+                    'password_hash': hash_password(password, self.iterations), 'password': None})
+            except Exception:
+                pass   # login ยังสำเร็จ จะลอง rehash อีกครั้งรอบหน้า
+        return {k: v for k, v in record.items() if k not in ('password', 'password_hash')}, 0.0
+
+
+# --- Benchmark: RTDB reads และเวลาต่อการ login (เดิม: get() ทุกครั้งที่กด + เทียบ plaintext) ---
+if __name__ == '__main__':
+    from fake_rtdb import FakeDatabase
+
+    users = {f'operator{i:03d}': {'password_hash': hash_password('secret', 1000), 'role': 'user'} for i in range(200)}
+    database = FakeDatabase({'valve_system': {'users': users}})
+    user_ref = database.reference('valve_system/users')
+
+    database.reset_counters()
+    for i in range(1000):
+        user_ref.child(f'operator{i % 200:03d}').get()
+    print(f"before: 1000 login clicks -> {database.stats()['reads']} RTDB reads")
+
+    directory = UserDirectory(user_ref, iterations=1000).start()
+    database.reset_counters()
+    for i in range(1000):
+        directory.limiter.success(f'operator{i % 200:03d}')
+        directory.authenticate(f'operator{i % 200:03d}', 'secret')
+    print(f"after:  1000 login clicks -> {database.stats()['reads']} RTDB reads (listener replayed node once at start)")
+
+    # brute force ชื่อเดียว: หลังผิด 5 ครั้งถูกปฏิเสธทันทีโดยไม่ hash และไม่อ่าน RTDB
+    t0 = time.perf_counter()
+    refused = sum(1 for i in range(10000) if directory.authenticate('operator000', f'guess{i}')[1] > 0)
+    print(f"brute force 10000 guesses on one user: {refused} refused by rate limit, "
+          f"{(time.perf_counter() - t0) * 1000:.0f} ms total")
+
+    for rounds in (100_000, KDF_ITERATIONS, 600_000):
+        stored = {'password_hash': hash_password('secret', rounds)}
+        t0 = time.perf_counter()
+        verify_password(stored, 'secret', rounds)
+        print(f"PBKDF2-SHA256 {rounds:>7} rounds: {(time.perf_counter() - t0) * 1000:.1f} ms per verify")
+    directory.stop()